@@ -1,19 +1,169 @@
 #!/usr/bin/env python
+import hashlib
 import os
 import subprocess
 import re
+import sys
 import tarfile
 import tempfile
+from cStringIO import StringIO
 from UserDict import UserDict
 
+import shell
+
+# Package keys and the PKGBUILD variables they are read from. The type
+# determines how the value is converted, mirroring parsepkgbuild.sh.
+PKGBUILD_FIELDS = (
+    ('name', 'pkgname', 'var'),
+    ('version', 'pkgver', 'var'),
+    ('release', 'pkgrel', 'int'),
+    ('description', 'pkgdesc', 'var'),
+    ('url', 'url', 'var'),
+    ('licenses', 'license', 'array'),
+    ('groups', 'groups', 'array'),
+    ('arch', 'arch', 'array'),
+    ('depends', 'depends', 'array'),
+    ('makedepends', 'makedepends', 'array'),
+    ('provides', 'provides', 'array'),
+    ('conflicts', 'conflicts', 'array'),
+    ('replaces', 'replaces', 'array'),
+    ('install', 'install', 'array'),
+    ('source', 'source', 'array'),
+    ('md5sums', 'md5sums', 'array'),
+    ('sha1sums', 'sha1sums', 'array'),
+    ('sha256sums', 'sha256sums', 'array'),
+    ('sha384sums', 'sha384sums', 'array'),
+    ('sha512sums', 'sha512sums', 'array'),
+)
+
+# Valid values for the *parser* argument of Package
+PARSERS = ('auto', 'python', 'bash')
+
+# Hashes computed for the files of a package, and the size of the chunks
+# files are read in to compute them
+HASH_TYPES = ('md5', 'sha1', 'sha256', 'sha384', 'sha512')
+HASH_CHUNK_SIZE = 64 * 1024
+
 class InvalidPackage(Exception):
     pass
 
 
+class _PrefixedStream(object):
+    """A file-like object returning *prefix* before reading from *fileobj*,
+    so that a stream can be inspected before handing it to tarfile"""
+    def __init__(self, prefix, fileobj):
+        self._prefix = prefix
+        self._fileobj = fileobj
+
+    def read(self, size=-1):
+        if not self._prefix:
+            return self._fileobj.read(size)
+        if size < 0:
+            data = self._prefix + self._fileobj.read()
+            self._prefix = ''
+            return data
+        data = self._prefix[:size]
+        self._prefix = self._prefix[size:]
+        if len(data) < size:
+            data += self._fileobj.read(size - len(data))
+        return data
+
+def compute_hashes(fileobj):
+    """Return a dictionary mapping each of :data:`HASH_TYPES` to the hex
+    digest of the contents of *fileobj*, which is read once, in chunks"""
+    digests = [(hash_type, hashlib.new(hash_type))
+            for hash_type in HASH_TYPES]
+    while True:
+        chunk = fileobj.read(HASH_CHUNK_SIZE)
+        if not chunk:
+            break
+        for hash_type, digest in digests:
+            digest.update(chunk)
+    return dict([(hash_type, digest.hexdigest())
+        for hash_type, digest in digests])
+
+def is_tar_header(header):
+    """Determine whether *header*, the first block of a file, starts a
+    (compressed) tar file"""
+    if header.startswith('\x1f\x8b') or header.startswith('BZh'):
+        return True
+    try:
+        tarfile.TarInfo.frombuf(header)
+    except Exception:
+        return False
+    return True
+
+
+def parse_with_python(script):
+    """Parse the contents of a PKGBUILD without running bash
+
+    Raises :exc:`shell.UnsupportedSyntax` if the script uses shell features
+    which require bash to be evaluated.
+    """
+    variables = shell.parse(script)
+    fields = {}
+    for key, variable, type in PKGBUILD_FIELDS:
+        value = variables.get(variable)
+        if type == 'array':
+            if value is None:
+                value = []
+            elif not isinstance(value, list):
+                value = [value]
+            # bash reports an array with an empty first element as empty
+            if value and not value[0]:
+                value = []
+        else:
+            if isinstance(value, list):
+                value = value and value[0] or None
+            if not value:
+                value = None
+            elif type == 'int':
+                try:
+                    value = int(value)
+                except ValueError:
+                    try:
+                        value = float(value)
+                    except ValueError:
+                        raise InvalidPackage('%s must be a number' % variable)
+        fields[key] = value
+    return fields
+
+def parse_with_bash(file):
+    """Parse a PKGBUILD by sourcing it in a restricted bash shell"""
+    script_dir = os.path.abspath(os.path.dirname(__file__))
+    # Find the current directory and filename
+    working_dir = os.path.dirname(file)
+    if working_dir == '':
+        working_dir = None
+    filename = os.path.basename(file)
+
+    # Let's parse the PKGBUILD
+    process = subprocess.Popen([
+        os.path.join(script_dir, 'parsepkgbuild.sh'), filename],
+        stdout=subprocess.PIPE, cwd=working_dir)
+    output = process.communicate()[0]
+
+    # "Import" variables into local namespace
+    fields = {}
+    for expression in output.splitlines():
+        exec 'temp = dict(' + expression.rstrip() + ')'
+        fields.update(temp)
+    return fields
+
+
 class Package(UserDict):
-    """Representation of an Archlinux package"""
-    def __init__(self, file):
+    """Representation of an Archlinux package
+
+    *parser* selects how the PKGBUILD is evaluated. ``'python'`` only uses
+    the built-in parser, ``'bash'`` always sources the PKGBUILD in a
+    restricted shell, and ``'auto'`` (the default) uses the built-in parser
+    and falls back to bash for scripts it can't handle.
+    """
+    def __init__(self, file, parser='auto', max_size=None):
         UserDict.__init__(self)
+        if parser not in PARSERS:
+            raise ValueError('unknown parser "%s"' % parser)
+        self._parser = parser
         self._required_fields = (
             'name', 'description', 'version', 'release',
             'licenses', 'arch',
@@ -22,64 +172,194 @@ class Package(UserDict):
         self._is_valid = False
         self._errors = []
         self._warnings = []
+        self._path = None
+        self._archive = None
+        self._members = {}
+        self._directory = ''
+        self._pkgbuild = None
+        self._contents = {}
+        self._hashes = {}
+
+        self.load(file, max_size)
 
-        self.load(file)
+    def load(self, file, max_size=None):
+        """Parse a PKGBUILD (can be within a tar file) and import the variables
 
-    def load(self, file):
-        """Parse a PKGBUILD (can be within a tar file) and import the variables"""
+        Tar files are opened once and kept open, the PKGBUILD and any other
+        files are read from the archive members without being extracted.
+
+        *file* may also be a file-like object, e.g. an upload, which is read
+        once from start to end. The files of a tar file are then kept in
+        memory, and *max_size* limits their total size, or the size of a
+        plain PKGBUILD.
+        """
+        if hasattr(file, 'read'):
+            self._read_stream(file, max_size)
+            self._parse(None)
+            return
         if not os.path.exists(file):
             raise Exception("file does not exist")
-        script_dir = os.path.dirname(__file__)
-        if not script_dir:
-            script_dir = os.path.abspath(script_dir)
-        is_temporary = False
+        self._path = file
 
-        # Check if it's a tarballed PKGBUILD and extract it
         try:
             tar = tarfile.open(file, "r")
         except:
             if os.path.basename(file) != "PKGBUILD":
                 raise
+            fp = open(file, "r")
+            try:
+                self._pkgbuild = fp.read()
+            finally:
+                fp.close()
         else:
-            to_extract = None
-            for member in tar.getnames():
-                if member.find("PKGBUILD") >= 0:
-                    to_extract = member
-                    break
-            if not to_extract:
+            pkgbuild = None
+            for member in tar.getmembers():
+                if not member.isfile():
+                    continue
+                self._members[member.name] = member
+                if not pkgbuild and os.path.basename(member.name) == "PKGBUILD":
+                    pkgbuild = member
+            if not pkgbuild:
+                tar.close()
                 raise InvalidPackage('tar file does not contain a PKGBUILD')
-            # Create a temporary directory and extract to it
-            directory = tempfile.mkdtemp()
-            tar.extract(to_extract, directory)
-            file = os.path.join(directory, to_extract)
-            is_temporary = True
-
-        # Find the current directory and filename
-        working_dir = os.path.dirname(file)
-        if working_dir == '':
-            working_dir = None
-        filename = os.path.basename(file)
-
-        # Let's parse the PKGBUILD
-        process = subprocess.Popen([
-            os.path.join(script_dir, 'parsepkgbuild.sh'), filename],
-            stdout=subprocess.PIPE, cwd=working_dir)
-        process.wait()
-
-        # "Import" variables into local namespace
-        for expression in process.stdout.readlines():
-            exec 'temp = dict(' + expression.rstrip() + ')'
-            self.update(temp)
-
-        # Remove the temporary file since we don't need it
-        if is_temporary:
-            for root, dirs, files in os.walk(directory, topdown=False):
-                for name in files:
-                    os.remove(os.path.join(root, name))
-                for name in dirs:
-                    os.rmdir(os.path.join(root, name))
+            self._archive = tar
+            self._directory = os.path.dirname(pkgbuild.name)
+            self._pkgbuild = tar.extractfile(pkgbuild).read()
+            # bash needs a file to source, which only the fallback requires
+            file = None
+        self._parse(file)
+
+    def _read_stream(self, fileobj, max_size=None):
+        """Read a PKGBUILD or tar file from *fileobj* in a single pass"""
+        header = fileobj.read(tarfile.BLOCKSIZE)
+        if not is_tar_header(header):
+            if os.path.basename(getattr(fileobj, 'name', '')) != "PKGBUILD":
+                raise InvalidPackage('file is neither a tar file nor a PKGBUILD')
+            if not max_size:
+                self._pkgbuild = header + fileobj.read()
+                return
+            # Read one byte more than allowed, to tell whether there's more
+            data = header
+            if len(data) <= max_size:
+                data += fileobj.read(max_size + 1 - len(data))
+            if len(data) > max_size:
+                raise InvalidPackage('PKGBUILD exceeds %d bytes' % max_size)
+            self._pkgbuild = data
+            return
+        tar = tarfile.open(mode="r|*", fileobj=_PrefixedStream(header,
+            fileobj))
+        try:
+            pkgbuild = None
+            size = 0
+            for member in tar:
+                if not member.isfile():
+                    continue
+                size += member.size
+                if max_size and size > max_size:
+                    raise InvalidPackage('contents of the tar file exceed %d '
+                            'bytes' % max_size)
+                self._members[member.name] = member
+                self._contents[member.name] = tar.extractfile(member).read()
+                if not pkgbuild and os.path.basename(member.name) == "PKGBUILD":
+                    pkgbuild = member
+        finally:
+            tar.close()
+        if not pkgbuild:
+            raise InvalidPackage('tar file does not contain a PKGBUILD')
+        self._directory = os.path.dirname(pkgbuild.name)
+        self._pkgbuild = self._contents[pkgbuild.name]
+
+    def _parse(self, file):
+        """Parse the PKGBUILD, *file* is its path if it's available on disk"""
+        if self._parser != 'bash':
+            try:
+                self.update(parse_with_python(self._pkgbuild))
+                return
+            except shell.UnsupportedSyntax:
+                if self._parser == 'python':
+                    raise InvalidPackage(sys.exc_info()[1])
+                # Let bash deal with anything the parser doesn't know
+        if file:
+            self.update(parse_with_bash(file))
+            return
+        directory = tempfile.mkdtemp()
+        try:
+            file = os.path.join(directory, "PKGBUILD")
+            fp = open(file, "w")
+            try:
+                fp.write(self._pkgbuild)
+            finally:
+                fp.close()
+            self.update(parse_with_bash(file))
+        finally:
+            if os.path.exists(file):
+                os.remove(file)
             os.rmdir(directory)
 
+    def is_tarball(self):
+        """Determine whether the package was loaded from a tar file"""
+        return bool(self._members)
+
+    def get_pkgbuild(self):
+        """Retrieve the contents of the PKGBUILD"""
+        return self._pkgbuild
+
+    def has_file(self, filename):
+        """Determine whether the tar file contains *filename*, relative to
+        the PKGBUILD"""
+        return os.path.join(self._directory, filename) in self._members
+
+    def get_file(self, filename):
+        """Retrieve the contents of *filename*, relative to the PKGBUILD, from
+        the tar file, or None if it doesn't exist"""
+        member = self._members.get(os.path.join(self._directory, filename))
+        if member is None:
+            return None
+        if member.name in self._contents:
+            return self._contents[member.name]
+        if self._archive is None:
+            # Unpickled packages reopen the tar file on demand
+            self._archive = tarfile.open(self._path, "r")
+        return self._archive.extractfile(member).read()
+
+    def get_hashes(self, filename=None):
+        """Return the hashes of *filename*, relative to the PKGBUILD, as
+        returned by :func:`compute_hashes`, or None if it doesn't exist
+
+        The hashes of the PKGBUILD itself are returned if *filename* is
+        None. Hashes are computed once and remembered.
+        """
+        if filename in self._hashes:
+            return self._hashes[filename]
+        if filename is None:
+            fp = StringIO(self._pkgbuild)
+        else:
+            member = self._members.get(os.path.join(self._directory,
+                filename))
+            if member is None:
+                return None
+            if member.name in self._contents:
+                fp = StringIO(self._contents[member.name])
+            else:
+                if self._archive is None:
+                    self._archive = tarfile.open(self._path, "r")
+                fp = self._archive.extractfile(member)
+        self._hashes[filename] = compute_hashes(fp)
+        return self._hashes[filename]
+
+    def close(self):
+        """Close the tar file the package was loaded from"""
+        if self._archive is not None:
+            self._archive.close()
+            self._archive = None
+
+    def __getstate__(self):
+        # Open tar files can't be pickled, e.g. to pass packages between
+        # processes, so they are reopened by get_file() when needed
+        state = self.__dict__.copy()
+        state['_archive'] = None
+        return state
+
     def validate(self):
         """Validate PKGBUILD for missing or invalid fields"""
         # Search for missing fields
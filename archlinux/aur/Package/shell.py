@@ -0,0 +1,328 @@
+"""A parser for the subset of bash used by PKGBUILDs
+
+Most PKGBUILDs consist of nothing but variable assignments and function
+definitions, which can be evaluated without running bash at all. This module
+implements that subset: scalar and array assignments (including ``+=``),
+single and double quoting, simple ``$var`` and ``${var}`` expansion, comments
+and line continuations. Function bodies are skipped.
+
+Anything outside of that subset, e.g. command substitution, parameter
+expansion operators, brace expansion, globbing or top level commands, raises
+:class:`UnsupportedSyntax`, so that the caller can fall back to bash.
+"""
+import re
+
+__all__ = ['UnsupportedSyntax', 'parse']
+
+_name_re = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+_assignment_re = re.compile(r'([A-Za-z_][A-Za-z0-9_]*)(\+?=)')
+_function_re = re.compile(
+        r'(?:function\s+)?([A-Za-z_][A-Za-z0-9_-]*)\s*\(\s*\)\s*(?=\{)'
+        r'|function\s+([A-Za-z_][A-Za-z0-9_-]*)\s*(?=\{)')
+_heredoc_re = re.compile(r'<<(-?)\s*([\'"]?)([A-Za-z0-9_]+)\2')
+
+# Characters which terminate an unquoted word
+_metacharacters = ' \t\n;&|<>()'
+
+
+class UnsupportedSyntax(Exception):
+    """Raised when a script uses bash features the parser doesn't handle"""
+    pass
+
+
+class _Parser(object):
+    def __init__(self, text):
+        self.text = text
+        self.pos = 0
+        self.variables = {}
+
+    def error(self, message):
+        line = self.text.count('\n', 0, self.pos) + 1
+        raise UnsupportedSyntax('%s on line %d' % (message, line))
+
+    def peek(self, offset=0):
+        index = self.pos + offset
+        if index < len(self.text):
+            return self.text[index]
+        return ''
+
+    def skip_blanks(self):
+        """Skip spaces, tabs, escaped newlines and comments"""
+        while self.pos < len(self.text):
+            char = self.text[self.pos]
+            if char in ' \t':
+                self.pos += 1
+            elif char == '\\' and self.peek(1) == '\n':
+                self.pos += 2
+            elif char == '#':
+                end = self.text.find('\n', self.pos)
+                if end < 0:
+                    end = len(self.text)
+                self.pos = end
+            else:
+                break
+
+    def parse(self):
+        while True:
+            self.skip_blanks()
+            if self.pos >= len(self.text):
+                break
+            char = self.text[self.pos]
+            if char in '\n;':
+                self.pos += 1
+                continue
+            match = _function_re.match(self.text, self.pos)
+            if match:
+                self.pos = match.end()
+                self.skip_function_body()
+                continue
+            match = _assignment_re.match(self.text, self.pos)
+            if not match:
+                self.error('unsupported statement')
+            self.pos = match.end()
+            self.assign(match.group(1), match.group(2) == '+=')
+            # Several assignments may share a line, but anything else would
+            # be a command run with a modified environment
+            self.skip_blanks()
+            if self.peek() not in ('', '\n', ';') and \
+                    not _assignment_re.match(self.text, self.pos):
+                self.error('unsupported statement')
+        return self.variables
+
+    def assign(self, name, append):
+        if self.peek() == '(':
+            self.pos += 1
+            value = self.parse_array()
+            if append:
+                value = self.get_list(name) + value
+        else:
+            value = self.parse_word(split=False)
+            if value is None:
+                value = ''
+            if append:
+                current = self.variables.get(name, '')
+                if isinstance(current, list):
+                    # var+=value on an array appends to its first element
+                    current = list(current) or ['']
+                    current[0] += value
+                    value = current
+                else:
+                    value = current + value
+        self.variables[name] = value
+
+    def parse_array(self):
+        values = []
+        while True:
+            self.skip_blanks()
+            char = self.peek()
+            if char == '':
+                self.error('unterminated array')
+            elif char == '\n':
+                self.pos += 1
+            elif char == ')':
+                self.pos += 1
+                return values
+            else:
+                word = self.parse_word(split=True)
+                if word is None:
+                    self.error('unexpected "%s"' % char)
+                values.extend(word)
+
+    def parse_word(self, split):
+        """Parse a single shell word at the current position
+
+        If *split* is true, a list of words is returned, applying the word
+        splitting bash performs on unquoted expansions. Otherwise the value
+        is returned as a string. ``None`` is returned if there is no word at
+        the current position.
+        """
+        start = self.pos
+        parts = []
+        while self.pos < len(self.text):
+            char = self.text[self.pos]
+            if char in _metacharacters:
+                if char in '&|<>(':
+                    self.error('unsupported "%s"' % char)
+                break
+            elif char == "'":
+                end = self.text.find("'", self.pos + 1)
+                if end < 0:
+                    self.error('unterminated quote')
+                parts.append(self.text[self.pos + 1:end])
+                self.pos = end + 1
+            elif char == '"':
+                self.pos += 1
+                parts.append(self.parse_double_quoted())
+            elif char == '\\':
+                if self.peek(1) == '\n':
+                    self.pos += 2
+                else:
+                    parts.append(self.peek(1))
+                    self.pos += 2
+            elif char == '$':
+                value = self.parse_expansion()
+                if split and (' ' in value or '\t' in value or
+                        '\n' in value):
+                    self.error('word splitting of an unquoted expansion')
+                parts.append(value)
+            elif char == '`':
+                self.error('command substitution')
+            elif char in '*?[{':
+                self.error('unquoted "%s"' % char)
+            else:
+                parts.append(char)
+                self.pos += 1
+        if self.pos == start:
+            return None
+        value = ''.join(parts)
+        if split:
+            return [value]
+        return value
+
+    def parse_double_quoted(self):
+        parts = []
+        while True:
+            if self.pos >= len(self.text):
+                self.error('unterminated quote')
+            char = self.text[self.pos]
+            if char == '"':
+                self.pos += 1
+                return ''.join(parts)
+            elif char == '\\':
+                next_char = self.peek(1)
+                if next_char in '$`"\\':
+                    parts.append(next_char)
+                elif next_char != '\n':
+                    parts.append(char + next_char)
+                self.pos += 2
+            elif char == '$':
+                parts.append(self.parse_expansion())
+            elif char == '`':
+                self.error('command substitution')
+            else:
+                parts.append(char)
+                self.pos += 1
+
+    def parse_expansion(self):
+        """Expand the variable reference at the current position"""
+        self.pos += 1
+        char = self.peek()
+        if char == '{':
+            end = self.text.find('}', self.pos)
+            if end < 0:
+                self.error('unterminated parameter expansion')
+            name = self.text[self.pos + 1:end]
+            if not _name_re.match(name) or \
+                    _name_re.match(name).end() != len(name):
+                self.error('unsupported parameter expansion')
+            self.pos = end + 1
+        else:
+            match = _name_re.match(self.text, self.pos)
+            if not match:
+                if char in '(\'"' or char in '0123456789@*#?$!-':
+                    self.error('unsupported expansion')
+                # A lone dollar sign is taken literally
+                return '$'
+            name = match.group(0)
+            self.pos = match.end()
+        return self.get_string(name)
+
+    def skip_function_body(self):
+        """Skip a brace delimited function body, including any heredocs"""
+        depth = 0
+        heredocs = []
+        while self.pos < len(self.text):
+            char = self.text[self.pos]
+            if char == '\\':
+                self.pos += 2
+                continue
+            elif char == "'":
+                end = self.text.find("'", self.pos + 1)
+                if end < 0:
+                    self.error('unterminated quote')
+                self.pos = end + 1
+                continue
+            elif char == '"':
+                self.skip_double_quoted()
+                continue
+            elif char == '#' and (self.pos == 0 or
+                    self.text[self.pos - 1] in ' \t\n;'):
+                end = self.text.find('\n', self.pos)
+                if end < 0:
+                    end = len(self.text)
+                self.pos = end
+                continue
+            elif char == '<':
+                match = _heredoc_re.match(self.text, self.pos)
+                if match:
+                    heredocs.append((match.group(3), match.group(1) == '-'))
+                    self.pos = match.end()
+                    continue
+            elif char == '\n' and heredocs:
+                self.pos += 1
+                for delimiter, strip_tabs in heredocs:
+                    self.skip_heredoc(delimiter, strip_tabs)
+                heredocs = []
+                continue
+            elif char == '{':
+                depth += 1
+            elif char == '}':
+                depth -= 1
+                if depth == 0:
+                    self.pos += 1
+                    return
+            self.pos += 1
+        self.error('unterminated function')
+
+    def skip_double_quoted(self):
+        self.pos += 1
+        while self.pos < len(self.text):
+            char = self.text[self.pos]
+            if char == '\\':
+                self.pos += 2
+            elif char == '"':
+                self.pos += 1
+                return
+            else:
+                self.pos += 1
+        self.error('unterminated quote')
+
+    def skip_heredoc(self, delimiter, strip_tabs):
+        while self.pos < len(self.text):
+            end = self.text.find('\n', self.pos)
+            if end < 0:
+                end = len(self.text)
+            line = self.text[self.pos:end]
+            self.pos = end + 1
+            if strip_tabs:
+                line = line.lstrip('\t')
+            if line == delimiter:
+                return
+        self.error('unterminated here-document')
+
+    def get_string(self, name):
+        value = self.variables.get(name, '')
+        if isinstance(value, list):
+            # $array refers to the first element
+            if value:
+                return value[0]
+            return ''
+        return value
+
+    def get_list(self, name):
+        value = self.variables.get(name)
+        if value is None:
+            return []
+        if isinstance(value, list):
+            return list(value)
+        return [value]
+
+
+def parse(text):
+    """Evaluate the assignments in a PKGBUILD and return them as a dictionary
+
+    Scalars are returned as strings and arrays as lists of strings.
+    :class:`UnsupportedSyntax` is raised if the script can't be evaluated
+    without bash.
+    """
+    return _Parser(text).parse()
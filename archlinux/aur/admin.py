@@ -3,12 +3,15 @@ from django.contrib import admin
 
 admin.site.register(Architecture)
 admin.site.register(Comment)
+admin.site.register(DependencySpec)
 admin.site.register(Group)
 admin.site.register(License)
+admin.site.register(NotificationPreference)
 admin.site.register(Package)
 admin.site.register(PackageFile)
 admin.site.register(PackageHash)
 admin.site.register(PackageNotification)
 admin.site.register(Provision)
+admin.site.register(QueuedNotification)
 admin.site.register(Repository)
 admin.site.register(Vote)
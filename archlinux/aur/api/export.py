@@ -0,0 +1,79 @@
+"""Streaming export of the whole package catalog
+
+Piston builds the complete response in memory, which doesn't scale to every
+package in the database. :func:`export_packages` instead reads the packages
+in chunks, loads the related objects of each chunk in bulk and writes the
+JSON incrementally, so memory use doesn't grow with the number of packages.
+
+The response is only iterated after the view has returned, when Django has
+already closed the connection of the request and ended its transaction. The
+chunks are therefore read on a new connection, each in a transaction of its
+own which is ended right away, and the connection is closed by the next
+request of the same thread, like any other.
+"""
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.http import HttpResponse
+from aur.models import Package
+from aur.api.handlers import BasePackageInfoHandler, \
+        pkg_info_fields, preload_packages
+
+# Number of packages read from the database at a time
+EXPORT_CHUNK_SIZE = getattr(settings, 'AUR_API_EXPORT_CHUNK_SIZE', 500)
+
+def read_chunk(queryset):
+    """Return the packages of *queryset* with their related objects, read in
+    a transaction which is ended before returning."""
+    transaction.enter_transaction_management()
+    transaction.managed(True)
+    try:
+        return preload_packages(queryset)
+    finally:
+        # Nothing was written, rolling back just ends the transaction
+        transaction.rollback()
+        transaction.leave_transaction_management()
+
+def iter_packages(queryset, chunk_size=None):
+    """Yield the packages of *queryset* ordered by id, reading *chunk_size*
+    packages per query and preloading their related objects."""
+    chunk_size = chunk_size or EXPORT_CHUNK_SIZE
+    queryset = queryset.select_related('repository').order_by('id')
+    last_id = None
+    while True:
+        chunk = queryset
+        if last_id is not None:
+            chunk = chunk.filter(id__gt=last_id)
+        chunk = read_chunk(chunk[:chunk_size])
+        for pkg in chunk:
+            yield pkg
+        if len(chunk) < chunk_size:
+            break
+        last_id = chunk[-1].id
+
+def serialize_package(pkg, fields=pkg_info_fields):
+    """Return a dictionary of *fields* of *pkg*, as presented by
+    :class:`BasePackageInfoHandler`."""
+    data = {}
+    for field in fields:
+        method = getattr(BasePackageInfoHandler, field, None)
+        if callable(method):
+            data[field] = method(pkg)
+        else:
+            data[field] = getattr(pkg, field)
+    return data
+
+def iter_json(packages):
+    """Yield a JSON array of *packages* piece by piece."""
+    encoder = DjangoJSONEncoder()
+    yield '['
+    separator = ''
+    for pkg in packages:
+        yield separator + encoder.encode(serialize_package(pkg))
+        separator = ',\n'
+    yield ']\n'
+
+def export_packages(request):
+    """Return all packages as a JSON array, streamed to the client."""
+    return HttpResponse(iter_json(iter_packages(Package.objects.all())),
+            mimetype='application/json; charset=utf-8')
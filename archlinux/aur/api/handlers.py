@@ -4,7 +4,17 @@ from piston.handler import BaseHandler, AnonymousBaseHandler
 from piston.utils import rc
 from django.shortcuts import get_object_or_404
 from django.contrib.sites.models import Site
-from archlinux.aur.models import Package
+from django.conf import settings
+from django.db.models import signals
+from aur.cache import get_generation
+from aur.models import Package, PackageFile, PackageHash, \
+        get_related_names
+from aur.pagination import KeysetPaginator, InvalidCursor
+
+# Maximum number of packages listed per page
+API_PAGE_SIZE = getattr(settings, 'AUR_API_PAGE_SIZE', 100)
+# Maximum number of packages looked up at once by name
+API_BATCH_LIMIT = getattr(settings, 'AUR_API_BATCH_LIMIT', 250)
 
 # Fields of interest when retrieving package information via the API.
 pkg_info_fields = ('name', 'version', 'release', 'description', 'url',
@@ -14,13 +24,118 @@ pkg_info_fields = ('name', 'version', 'release', 'description', 'url',
           'added', 'updated', 'groups',
           'sources', 'md5', 'sha1', 'permalink', 'comments')
 
+# Many-to-many fields presented as lists of names, and the attribute used
+# as the name of the related objects.
+related_name_fields = (
+    ('maintainers', 'username'),
+    ('licenses', 'name'),
+    ('architectures', 'name'),
+    ('depends', 'name'),
+    ('make_depends', 'name'),
+    ('provides', 'name'),
+    ('conflicts', 'name'),
+    ('replaces', 'name'),
+    ('groups', 'name'),
+)
+
 # A helper function.
 def get_hashes(pkg, hash_type):
     """Return the hashes of a package's source files, where each hash
     must be of hash_type.  hash_type is presently one of md5 or sha1."""
-    return [x.hash
-            for y in pkg.packagefile_set.all()
-            for x in y.packagehash_set.filter(type=hash_type)]
+    if hasattr(pkg, '_api_hashes'):
+        return pkg._api_hashes.get(hash_type, [])
+    return list(PackageHash.objects.filter(file__package=pkg,
+        type=hash_type).order_by('file', 'id').values_list('hash', flat=True))
+
+def preload_packages(packages):
+    """Load the related objects presented by the API for all *packages* at
+    once, instead of with several queries per package.
+
+    The resource methods of :class:`BasePackageInfoHandler` use the loaded
+    values when they are present."""
+    packages = list(packages)
+    if not packages:
+        return packages
+    ids = [pkg.id for pkg in packages]
+    related = dict([(pkg.id, {}) for pkg in packages])
+    for field, attr in related_name_fields:
+        names = get_related_names(ids, field, attr)
+        for id in ids:
+            related[id][field] = names[id]
+    sources = dict([(id, []) for id in ids])
+    for file in PackageFile.objects.filter(package__in=ids).order_by('id'):
+        sources[file.package_id].append(file.get_absolute_url())
+    hashes = dict([(id, {}) for id in ids])
+    rows = PackageHash.objects.filter(file__package__in=ids).order_by('file',
+            'id').values_list('file__package', 'type', 'hash')
+    for id, type, hash in rows:
+        hashes[id].setdefault(type, []).append(hash)
+    for pkg in packages:
+        pkg._api_related = related[pkg.id]
+        pkg._api_sources = sources[pkg.id]
+        pkg._api_hashes = hashes[pkg.id]
+    return packages
+
+_site_domain = None
+
+def get_site_domain():
+    """Return the domain of the current site, which is only queried once."""
+    global _site_domain
+    if _site_domain is None:
+        _site_domain = Site.objects.get_current().domain
+    return _site_domain
+
+def _reset_site_domain(sender, **kwargs):
+    global _site_domain
+    _site_domain = None
+
+signals.post_save.connect(_reset_site_domain, sender=Site,
+        dispatch_uid='aur.api.handlers._reset_site_domain')
+signals.post_delete.connect(_reset_site_domain, sender=Site,
+        dispatch_uid='aur.api.handlers._reset_site_domain')
+
+def get_related(pkg, field, attr='name'):
+    """Return the names of the objects related to *pkg* through *field*,
+    using the values loaded by :func:`preload_packages` if present."""
+    if hasattr(pkg, '_api_related'):
+        return pkg._api_related[field]
+    return [getattr(x, attr) for x in getattr(pkg, field).all()]
+
+def get_package_info_state(request, object_id=None, emitter_format=None):
+    """Return a tuple of the last modification time of the package info
+    response, or None if it isn't known, and a string which changes with its
+    content, or None if there's nothing to respond with.
+
+    A single package takes a single query, whose result is kept on *request*
+    so that it serves both :func:`package_info_etag` and
+    :func:`package_info_last_modified`. The listing would have to aggregate
+    every package, so it's validated by the cache generation instead, which
+    changes whenever a package, comment or vote does."""
+    if not hasattr(request, '_package_info_state'):
+        state = None
+        if object_id:
+            rows = Package.objects.filter(name=object_id).values_list(
+                    'updated', 'revision', 'comment_count')[:1]
+            if rows:
+                updated, revision, comments = rows[0]
+                state = (updated, '%s-%d-%d' % (updated.isoformat(),
+                    revision, comments))
+        else:
+            state = (None, 'generation-%d' % get_generation())
+        request._package_info_state = state
+    return request._package_info_state
+
+def package_info_etag(request, object_id=None, emitter_format=None):
+    state = get_package_info_state(request, object_id)
+    if state is None:
+        return None
+    return state[1]
+
+def package_info_last_modified(request, object_id=None, emitter_format=None):
+    state = get_package_info_state(request, object_id)
+    if state is None:
+        return None
+    return state[0]
 
 class BasePackageInfoHandler(BaseHandler):
     """Defines methods shared between PackageInfoHandler and
@@ -51,43 +166,45 @@ class BasePackageInfoHandler(BaseHandler):
     @classmethod
     def maintainers(cls, pkg):
         """Return the usernames of the package's maintainers."""
-        return [x.username for x in pkg.maintainers.all()]
+        return get_related(pkg, 'maintainers', 'username')
 
     @classmethod
     def licenses(cls, pkg):
-        return [x.name for x in pkg.licenses.all()]
+        return get_related(pkg, 'licenses')
 
     @classmethod
     def architectures(cls, pkg):
-        return [x.name for x in pkg.architectures.all()]
+        return get_related(pkg, 'architectures')
 
     @classmethod
     def depends(cls, pkg):
-        return [x.name for x in pkg.depends.all()]
+        return get_related(pkg, 'depends')
 
     @classmethod
     def make_depends(cls, pkg):
-        return [x.name for x in pkg.make_depends.all()]
+        return get_related(pkg, 'make_depends')
 
     @classmethod
     def provides(cls, pkg):
-        return [x.name for x in pkg.provides.all()]
+        return get_related(pkg, 'provides')
 
     @classmethod
     def conflicts(cls, pkg):
-        return [x.name for x in pkg.conflicts.all()]
+        return get_related(pkg, 'conflicts')
 
     @classmethod
     def replaces(cls, pkg):
-        return [x.name for x in pkg.replaces.all()]
+        return get_related(pkg, 'replaces')
 
     @classmethod
     def groups(cls, pkg):
-        return [x.name for x in pkg.groups.all()]
+        return get_related(pkg, 'groups')
 
     @classmethod
     def sources(cls, pkg):
         """Return a list of the URLs of the source files for this package."""
+        if hasattr(pkg, '_api_sources'):
+            return pkg._api_sources
         return [x.get_absolute_url()
                 for x in pkg.packagefile_set.all()]
 
@@ -115,33 +232,57 @@ class BasePackageInfoHandler(BaseHandler):
 
     @classmethod
     def tarball(cls, pkg):
-        """Return the URL of the tarball that contains this package's PKGBUILD."""
+        """Return the URL of the tarball that contains this package's PKGBUILD,
+        or None if it has none."""
+        if not pkg.tarball:
+            return None
         return pkg.tarball.url
 
     @classmethod
     def permalink(cls, pkg):
         """Return the URL for the AUR package page."""
-        domain = Site.objects.get_current().domain
+        domain = get_site_domain()
         base = 'http://%s' % (domain,)
         return urlparse.urljoin(base, pkg.get_absolute_url())
 
     @classmethod
     def comments(cls, pkg):
         """Return the number of comments for the given package."""
-        return pkg.comment_set.count()
+        return pkg.comment_count
 
     def read(self, request, object_id=None):
         """Handle GET requests.  If object_id is not None,
         then return the corresponding package object from the database.
-        Otherwise, look at the query from the request, and return
-        all matching packages.  Right now, this just returns all packages
-        in the database."""
+        Otherwise, return a page of all packages, most recently updated
+        first.  The page is selected with the opaque ``cursor`` parameter,
+        taken from the ``next`` or ``previous`` values of another page, and
+        its size with the ``limit`` parameter."""
         if not object_id:
             # Handle /api/packages.
-            return Package.objects.all()
+            try:
+                limit = int(request.GET.get('limit', API_PAGE_SIZE))
+            except ValueError:
+                limit = API_PAGE_SIZE
+            limit = min(max(limit, 1), API_PAGE_SIZE)
+            paginator = KeysetPaginator(
+                    Package.objects.select_related('repository'), limit,
+                    ('-updated', 'name'))
+            try:
+                page = paginator.page(request.GET.get('cursor'))
+            except InvalidCursor:
+                resp = rc.BAD_REQUEST
+                resp.write('\nInvalid cursor.')
+                return resp
+            return {
+                'packages': preload_packages(page.object_list),
+                'next': page.next_cursor,
+                'previous': page.previous_cursor,
+            }
         else:
             try:
-                return Package.objects.get(name=object_id)
+                pkg = Package.objects.select_related('repository').get(
+                        name=object_id)
+                return preload_packages([pkg])[0]
             except Package.DoesNotExist:
                 # We can't use get_object_or_404!
                 resp = rc.NOT_FOUND
@@ -175,3 +316,52 @@ class PackageInfoHandler(BasePackageInfoHandler):
         """Handle DELETE requests."""
         return rc.NOT_IMPLEMENTED
 
+
+
+def get_requested_names(request):
+    """Return the package names requested with repeated ``name`` parameters
+    or the comma separated ``names`` parameter, without duplicates."""
+    names = request.GET.getlist('name')
+    for value in request.GET.getlist('names'):
+        names.extend(value.split(','))
+    unique = []
+    seen = set()
+    for name in names:
+        name = name.strip()
+        if name and name not in seen:
+            seen.add(name)
+            unique.append(name)
+    return unique
+
+class BasePackageBatchHandler(BaseHandler):
+    """Looks up several packages by name in one request.
+
+    Packages are presented like the package info API, or, with the
+    ``versions`` parameter, as a mapping of names to versions for update
+    checks. Names which don't exist are left out."""
+
+    def read(self, request):
+        names = get_requested_names(request)
+        if not names:
+            resp = rc.BAD_REQUEST
+            resp.write('\nNo package names given.')
+            return resp
+        if len(names) > API_BATCH_LIMIT:
+            resp = rc.BAD_REQUEST
+            resp.write('\nAt most %d packages can be requested at once.'
+                    % (API_BATCH_LIMIT,))
+            return resp
+        packages = Package.objects.filter(name__in=names)
+        if request.GET.get('versions'):
+            return dict([(name, u'%s-%s' % (version, release))
+                for name, version, release in packages.values_list('name',
+                    'version', 'release')])
+        return preload_packages(packages.select_related('repository'))
+
+class AnonymousPackageBatchHandler(BasePackageBatchHandler,
+        AnonymousBaseHandler):
+    allowed_methods = ('GET',)
+
+class PackageBatchHandler(BasePackageBatchHandler):
+    anonymous = AnonymousPackageBatchHandler
+    allowed_methods = ('GET',)
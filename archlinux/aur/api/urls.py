@@ -1,12 +1,32 @@
 from django.conf.urls.defaults import *
 from piston.resource import Resource
 from piston.authentication import HttpBasicAuthentication
-from archlinux.aur.api.handlers import PackageInfoHandler
+from django.views.decorators.http import condition
+from aur.cache import cache_anonymous
+from aur.api.handlers import PackageInfoHandler, \
+        PackageBatchHandler, package_info_etag, package_info_last_modified
 
 auth = HttpBasicAuthentication(realm='AUR API')
-package_info_handler = Resource(handler=PackageInfoHandler, authentication=auth)
+package_info_resource = Resource(handler=PackageInfoHandler,
+        authentication=auth)
+
+package_batch_handler = Resource(handler=PackageBatchHandler,
+        authentication=auth)
+
+# Resource instances can't be decorated directly
+@condition(etag_func=package_info_etag,
+        last_modified_func=package_info_last_modified)
+@cache_anonymous('api')
+def package_info_handler(request, *args, **kwargs):
+    return package_info_resource(request, *args, **kwargs)
 
 urlpatterns = patterns('',
+    url(r'^packages/export(?:\.json)?$',
+        'aur.api.export.export_packages', name='aur-api_export'),
+    url(r'^packages/info\.(?P<emitter_format>[a-zA-Z]+)$',
+        package_batch_handler),
+    url(r'^packages/info$', package_batch_handler,
+        {'emitter_format' : 'json'}),
     url(r'^packages\.(?P<emitter_format>[a-zA-Z]+)$', package_info_handler),
     url(r'^packages$', package_info_handler, {'emitter_format' : 'json'}),
     url(r'^package/(?P<object_id>[\w_-]+)\.(?P<emitter_format>[a-zA-Z]+)$', package_info_handler),
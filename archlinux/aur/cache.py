@@ -0,0 +1,107 @@
+"""Caching of rendered pages and API responses for anonymous users
+
+Responses are stored in the cache configured by ``CACHE_BACKEND``, so any
+backend Django supports (local memory, files, memcached) can be used. How
+long the responses of each view are kept is set per view in the
+``AUR_CACHE_POLICIES`` setting, a dictionary mapping policy names to
+timeouts in seconds; views without a policy, or with a timeout of 0, aren't
+cached.
+
+Rather than tracking which entries a change affects, every key contains a
+generation number which :func:`invalidate_cache` increments whenever a
+package, comment or vote changes, so stale entries are simply never read
+again and expire on their own. A second generation number is only
+incremented by :func:`invalidate_packages`, when packages change, for data
+which depends on the packages alone, such as :mod:`aur.graph`.
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.functional import wraps
+from django.utils.hashcompat import md5_constructor
+
+GENERATION_KEY = 'aur:generation'
+PACKAGES_GENERATION_KEY = 'aur:packages-generation'
+
+def get_generation(key=GENERATION_KEY):
+    """Return the current cache generation, or the generation stored under
+    *key*"""
+    generation = cache.get(key)
+    if generation is None:
+        # Start from the time, so that generations used before the counter
+        # was evicted aren't reused
+        cache.add(key, int(time.time()))
+        generation = cache.get(key, int(time.time()))
+    return generation
+
+def _increment_generation(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        # The counter doesn't exist (anymore)
+        cache.set(key, int(time.time()))
+
+def invalidate_cache(*args, **kwargs):
+    """Invalidate all cached responses
+
+    This can be connected to signals directly.
+    """
+    _increment_generation(GENERATION_KEY)
+
+def invalidate_packages(*args, **kwargs):
+    """Invalidate all cached responses and the data loaded from packages
+
+    This can be connected to signals directly.
+    """
+    _increment_generation(GENERATION_KEY)
+    _increment_generation(PACKAGES_GENERATION_KEY)
+
+def invalidate_after_commit(invalidate=invalidate_cache):
+    """Decorate a view which commits its changes itself, e.g. with
+    ``transaction.commit_on_success``, to call *invalidate* again once it
+    has returned
+
+    The signals invalidating the cache are sent before the transaction is
+    committed, so concurrent requests may cache responses from before the
+    commit under the new generation in the meantime.
+    """
+    def decorator(view):
+        def wrapper(request, *args, **kwargs):
+            try:
+                return view(request, *args, **kwargs)
+            finally:
+                invalidate()
+        return wraps(view)(wrapper)
+    return decorator
+
+def get_timeout(policy):
+    """Return the cache timeout of *policy*, 0 if it isn't cached"""
+    return getattr(settings, 'AUR_CACHE_POLICIES', {}).get(policy, 0)
+
+def get_cache_key(policy, request):
+    """Return the cache key of the response to *request* under *policy*"""
+    path = md5_constructor(request.get_full_path()).hexdigest()
+    return 'aur:%s:%s:%s' % (policy, get_generation(), path)
+
+def cache_anonymous(policy):
+    """Decorate a view to cache its successful responses to anonymous GET
+    requests, according to *policy*"""
+    def decorator(view):
+        def wrapper(request, *args, **kwargs):
+            timeout = get_timeout(policy)
+            if not timeout or request.method != 'GET' or \
+                    request.user.is_authenticated() or \
+                    'HTTP_AUTHORIZATION' in request.META:
+                return view(request, *args, **kwargs)
+            key = get_cache_key(policy, request)
+            response = cache.get(key)
+            if response is None:
+                response = view(request, *args, **kwargs)
+                # Streamed and personalised responses can't be shared
+                if response.status_code == 200 and not response.cookies \
+                        and getattr(response, '_is_string', True):
+                    cache.set(key, response, timeout)
+            return response
+        return wraps(view)(wrapper)
+    return decorator
@@ -0,0 +1,175 @@
+"""Resolution of declared dependencies to packages
+
+Every dependency a PKGBUILD declares, e.g. ``foo>=1.2``, is stored as a
+:class:`aur.models.DependencySpec`, whether or not a package satisfies it.
+Specs are resolved to packages by name, or through the names packages
+provide, and the ``depends`` and ``make_depends`` relations of
+:class:`aur.models.Package` are kept in sync with the resolved specs.
+
+When a package is stored, :func:`relink_dependents` only re-resolves the
+specs naming it or one of its provisions, so the work done depends on the
+packages changed rather than on the size of the catalogue.
+"""
+import re
+
+from django.db.models import Q
+
+from aur.models import Package, Provision, DependencySpec, bulk_insert, \
+        bulk_delete, bulk_relate, bulk_unrelate, get_relations, touch_packages
+
+KINDS = ('depends', 'make_depends')
+
+DEPENDENCY_RE = re.compile(r'^([^<>=]+)(?:(<=|>=|<|>|=)(.+))?$')
+VERSION_SEGMENT_RE = re.compile(r'(\d+|[a-zA-Z]+)')
+
+def parse_dependency(dependency):
+    """Split a dependency such as ``foo>=1.2`` into a tuple of its name,
+    operator and version; the latter two are empty for unversioned
+    dependencies"""
+    match = DEPENDENCY_RE.match(dependency.strip())
+    if match is None:
+        return dependency.strip(), '', ''
+    name, operator, version = match.groups()
+    return name.strip(), operator or '', (version or '').strip()
+
+def _compare_segments(a, b):
+    a = VERSION_SEGMENT_RE.findall(a)
+    b = VERSION_SEGMENT_RE.findall(b)
+    for x, y in zip(a, b):
+        if x.isdigit() and y.isdigit():
+            result = cmp(int(x), int(y))
+        elif x.isdigit() or y.isdigit():
+            # Numbers are newer than letters, as in pacman
+            result = x.isdigit() and 1 or -1
+        else:
+            result = cmp(x, y)
+        if result:
+            return result
+    return cmp(len(a), len(b))
+
+def vercmp(a, b):
+    """Compare two versions, optionally with a release (``1.2-3``), like
+    pacman's ``vercmp``"""
+    a_version, a_release = (a.split('-', 1) + [''])[:2]
+    b_version, b_release = (b.split('-', 1) + [''])[:2]
+    result = _compare_segments(a_version, b_version)
+    if result or not a_release or not b_release:
+        return result
+    return _compare_segments(a_release, b_release)
+
+def satisfies(version, operator, required):
+    """Return whether *version* satisfies the constraint *operator*
+    *required*
+
+    *version* is ``None`` for unversioned provisions, which only satisfy
+    unversioned dependencies.
+    """
+    if not operator:
+        return True
+    if version is None:
+        return False
+    result = vercmp(version, required)
+    return {
+        '=': result == 0,
+        '<': result < 0,
+        '<=': result <= 0,
+        '>': result > 0,
+        '>=': result >= 0,
+    }[operator]
+
+def find_candidates(names):
+    """Return a dictionary mapping each of *names* to a list of (package id,
+    version) tuples of the packages which are, or provide, that name
+
+    Packages named *names* come first, with their ``version-release`` as
+    version. Provisions follow, with the version they were declared with,
+    or ``None``.
+    """
+    names = set(names)
+    candidates = dict([(name, []) for name in names])
+    if not names:
+        return candidates
+    for id, name, version, release in Package.objects.filter(
+            name__in=names).order_by('id').values_list('id', 'name',
+                    'version', 'release'):
+        candidates[name].append((id, '%s-%s' % (version, release)))
+    # Provisions are stored as declared, either "name" or "name=version"
+    query = Q(name__in=names)
+    for name in names:
+        query |= Q(name__startswith='%s=' % name)
+    provisions = dict(Provision.objects.filter(query).values_list('id',
+        'name'))
+    for id, provision in sorted(get_relations(Package, 'provides',
+            related_ids=provisions.keys())):
+        name, operator, version = parse_dependency(provisions[provision])
+        if name in candidates:
+            candidates[name].append((id, operator == '=' and version or None))
+    return candidates
+
+def resolve(name, operator, version, candidates):
+    """Return the id of the first package in *candidates*, as returned by
+    :func:`find_candidates`, satisfying the dependency, or ``None``"""
+    for id, candidate_version in candidates.get(name, ()):
+        # Package versions include the release, which is only compared if
+        # the dependency asks for one
+        if candidate_version is not None and '-' not in version:
+            candidate_version = candidate_version.rsplit('-', 1)[0]
+        if satisfies(candidate_version, operator, version):
+            return id
+    return None
+
+def relate_resolved(ids):
+    """Rebuild the ``depends`` and ``make_depends`` relations of the
+    packages with ids *ids* from their resolved specs"""
+    if not ids:
+        return
+    for kind in KINDS:
+        bulk_unrelate(Package, kind, ids)
+        bulk_relate(Package, kind, set(DependencySpec.objects.filter(
+            package__in=ids, kind=kind, target__isnull=False).values_list(
+                'package', 'target')))
+
+def store_dependencies(package, depends, make_depends):
+    """Replace the dependency specs of *package* with *depends* and
+    *make_depends*, lists of dependencies as declared in a PKGBUILD, and
+    relate it to the packages satisfying them"""
+    specs = []
+    for kind, dependencies in (('depends', depends),
+            ('make_depends', make_depends)):
+        for dependency in dependencies or ():
+            specs.append((kind,) + parse_dependency(dependency))
+    candidates = find_candidates([name for kind, name, operator, version
+        in specs])
+    bulk_delete(DependencySpec, 'package', [package.id])
+    bulk_insert(DependencySpec, ('package', 'kind', 'name', 'operator',
+        'version', 'target'), [(package.id, kind, name, operator, version,
+            resolve(name, operator, version, candidates))
+            for kind, name, operator, version in specs])
+    relate_resolved([package.id])
+
+def relink_dependents(package, provides=()):
+    """Re-resolve the specs of other packages which *package*, providing
+    *provides*, may now satisfy or no longer satisfy, and return the ids of
+    the packages whose relations changed"""
+    names = [package.name] + [parse_dependency(provision)[0]
+            for provision in provides]
+    specs = list(DependencySpec.objects.filter(Q(name__in=names) |
+        Q(target=package)).exclude(package=package).values_list('id',
+            'package', 'name', 'operator', 'version', 'target'))
+    candidates = find_candidates(names + [spec[2] for spec in specs])
+    changed = {}
+    dependents = set()
+    # Packages gaining or losing dependents, besides *package* itself
+    targets = set()
+    for id, dependent, name, operator, version, target in specs:
+        resolved = resolve(name, operator, version, candidates)
+        if resolved != target:
+            changed.setdefault(resolved, []).append(id)
+            dependents.add(dependent)
+            targets.update([target, resolved])
+    for target, ids in changed.items():
+        DependencySpec.objects.filter(id__in=ids).update(target=target)
+    relate_resolved(list(dependents))
+    targets.difference_update([None, package.id])
+    touch_packages(dependents | targets)
+    return dependents
@@ -1,18 +1,31 @@
 import tarfile
 import hashlib
 import os
+import struct
 import sys
-import tempfile
+import zlib
+from cStringIO import StringIO
 
 from django import forms
+from django.conf import settings
 from django.db import transaction
 from django.core.files import File
+from django.core.files.base import ContentFile
+from django.core.files.uploadhandler import FileUploadHandler, StopUpload
 
 import aur.Package as PKGBUILD
+from aur.cache import invalidate_packages
+from aur.dependencies import store_dependencies, relink_dependents
+from aur.graph import dependency_graph
+from aur.search import get_backend
 from aur.models import Architecture, Repository, Package, Provision, \
-    License, PackageFile, PackageHash
+    License, PackageFile, PackageHash, bulk_insert, bulk_add_related, \
+    bulk_delete, release_files
 
 class PackageSearchForm(forms.Form):
+    # Whether the results of search() are annotated with their relevance
+    ranked = False
+
     # Borrowed from AUR2-BR
     def __init__(self, *args, **kwargs):
         super(PackageSearchForm, self).__init__(*args, **kwargs)
@@ -52,15 +65,14 @@ class PackageSearchForm(forms.Form):
         query = self.get_or_default('query')
 
         # Find the packages by searching description and package name or maintainer
+        self.ranked = False
         if query:
             if self.get_or_default('searchby') == 'maintainer':
                 results = Package.objects.filter(maintainers__username__icontains=query)
             else:
-                results = Package.objects.filter(name__icontains=query)
-                results |= Package.objects.filter(description__icontains=query)
-                # Split query to search for each word as a tag
-                for keyword in query.split():
-                    results |= Package.objects.filter(tags__exact=keyword)
+                backend = get_backend()
+                results = backend.search(Package.objects.all(), query)
+                self.ranked = backend.ranked
         else:
             results = Package.objects.all()
         # Restrict results
@@ -71,6 +83,322 @@ class PackageSearchForm(forms.Form):
         return results
 
 
+def get_package_errors(pkg):
+    """Return a list of problems with a :class:`aur.Package.Package`
+
+    Only the package itself is inspected, so this doesn't require database
+    access. Warnings are reported as errors.
+    """
+    errors = []
+    pkg.validate()
+    if not pkg.is_valid() or pkg.has_warnings():
+        errors.extend(pkg.get_errors())
+        errors.extend(pkg.get_warnings())
+    if pkg['install']:
+        if not pkg.is_tarball():
+            errors.append('install files are missing')
+        else:
+            for file in pkg['install']:
+                if not pkg.has_file(file):
+                    errors.append('install file "%s" is missing' % file)
+    # Verify the checksums of local sources, the hashes are kept for
+    # store_package()
+    for index in range(len(pkg['source'])):
+        hashes = pkg.get_hashes(pkg['source'][index])
+        if hashes is None:
+            continue
+        for hash_type in PKGBUILD.HASH_TYPES:
+            sums = pkg[hash_type + 'sums']
+            if index >= len(sums) or sums[index] == 'SKIP':
+                continue
+            if sums[index].lower() != hashes[hash_type]:
+                errors.append('%ssum of "%s" does not match' % (hash_type,
+                    pkg['source'][index]))
+    return errors
+
+def get_architecture_errors(pkg, architectures):
+    """Return a list of the architectures of *pkg* which aren't in
+    *architectures*, a list of architecture names, as errors"""
+    errors = []
+    for arch in pkg['arch']:
+        if arch not in architectures:
+            errors.append('architecture %s does not exist' % arch)
+    return errors
+
+def _get_or_create_names(model, names):
+    """Return the ids of the *model* objects named *names*, creating those
+    which don't exist"""
+    if not names:
+        return []
+    existing = dict(model.objects.filter(name__in=names).values_list(
+        'name', 'id'))
+    missing = [name for name in set(names) if name not in existing]
+    if missing:
+        bulk_insert(model, ('name',), [(name,) for name in missing])
+        existing.update(model.objects.filter(name__in=missing).values_list(
+            'name', 'id'))
+    return existing.values()
+
+def _gzip(data):
+    """Return *data* gzip compressed, with a zero timestamp in the header
+
+    ``GzipFile`` only accepts a timestamp from Python 2.7 on, so the header
+    is written here.
+    """
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return ''.join([
+        # Magic, deflate, no flags, no timestamp, best compression, Unix
+        '\x1f\x8b\x08\x00', struct.pack('<I', 0), '\x02\x03',
+        compressor.compress(data), compressor.flush(),
+        struct.pack('<II', zlib.crc32(data) & 0xffffffffL,
+            len(data) & 0xffffffffL),
+    ])
+
+def _get_content(contents, hashes):
+    """Return a :class:`ContentFile` of *contents* carrying its SHA-256 hash
+    from *hashes*, so that the content storage doesn't compute it again"""
+    content = ContentFile(contents)
+    content.content_hash = hashes['sha256']
+    return content
+
+def store_package(pkg, repository, user=None, saved_files=None,
+        replaced_files=None):
+    """Create or update a :class:`Package` from a validated
+    :class:`aur.Package.Package` and store its files
+
+    *repository* should be a :class:`Repository`. *user* is added as a
+    maintainer of newly created packages. The names of the stored files are
+    appended to the list *saved_files*, if given. The names of the files an
+    updated package no longer uses are appended to the list
+    *replaced_files*, if given, and released right away otherwise.
+
+    .. note::
+
+        Transactions are left to the caller, so that several packages can be
+        stored in one transaction. If storing fails, the caller should roll
+        back and then pass *saved_files* to
+        :func:`aur.models.release_files`. Otherwise it should commit and
+        then pass *replaced_files* to it, so that a rollback doesn't leave
+        the old rows without their files.
+    """
+    if saved_files is None:
+        saved_files = []
+    updating = False
+    creating = False
+    try:
+        package = Package.objects.get(name=pkg['name'])
+    except Package.DoesNotExist:
+        package = Package(name=pkg['name'])
+        creating = True
+    else:
+        updating = True
+    package.version=pkg['version']
+    package.release=pkg['release']
+    package.description=pkg['description']
+    package.url=pkg['url']
+    package.repository=repository
+    # Save the package so we can reference it
+    package.save()
+    if creating:
+        if user is not None:
+            package.maintainers.add(user)
+    else:
+        # TODO: Check if user can upload/overwrite the package
+        pass
+    # Replace the relations of updated packages
+    if updating:
+        package.provides.clear()
+        package.licenses.clear()
+        package.architectures.clear()
+    # Record all dependencies, and relate the package to those which are
+    # already satisfied. Packages uploaded later are related to it by
+    # relink_dependents().
+    store_dependencies(package, pkg['depends'], pkg['makedepends'])
+    # Add provides and licenses, creating those which don't exist yet
+    bulk_add_related(package, 'provides',
+            _get_or_create_names(Provision, pkg['provides']))
+    bulk_add_related(package, 'licenses',
+            _get_or_create_names(License, pkg['licenses']))
+    # Add architectures
+    if pkg['arch']:
+        bulk_add_related(package, 'architectures',
+                Architecture.objects.filter(
+                    name__in=pkg['arch']).values_list('id', flat=True))
+    # Dependencies on this package, or on what it provides, may only now be
+    # satisfied, or no longer be. The ids of the packages they belong to are
+    # kept, so that their relations can be reloaded by the caller.
+    package.relinked_ids = relink_dependents(package, pkg['provides'])
+    # Remember the old files, they are removed once the new ones are stored.
+    # Files are stored by content, so unchanged files aren't written again
+    # and stay in place.
+    old_files = []
+    old_tarball = None
+    if updating:
+        old_files = list(PackageFile.objects.filter(
+            package=package).values_list('id', 'filename'))
+        old_tarball = package.tarball.name
+    old_ids = [id for id, name in old_files]
+    # Save the files to disk first, the database rows are inserted in bulk
+    # afterwards. Each entry is a PackageFile and a list of its hashes.
+    files = []
+    # Hash and save PKGBUILD
+    pkgbuild = pkg.get_pkgbuild()
+    hashes = pkg.get_hashes()
+    source = PackageFile(package=package)
+    source.filename.save('%(name)s/sources/PKGBUILD',
+            _get_content(pkgbuild, hashes), save=False)
+    saved_files.append(source.filename.name)
+    files.append((source, hashes.items()))
+    # Save tarball
+    # TODO: Tar the saved sources instead of using the uploaded one, for
+    # security
+    if pkg.is_tarball():
+        # Uploads are stored as they are, imported packages are read from
+        # disk
+        fp = pkg.get('upload') or File(open(pkg['filename'], "rb"))
+        package.tarball.save(os.path.join('%(name)s',
+            os.path.basename(pkg['filename'])), fp)
+        fp.close()
+        saved_files.append(package.tarball.name)
+    else:
+        # We only have the PKGBUILD, so lets make a tarball. Timestamps are
+        # left out, so that the same PKGBUILD results in the same tarball.
+        buffer = StringIO()
+        tar = tarfile.open(mode="w", fileobj=buffer)
+        info = tarfile.TarInfo('%s/PKGBUILD' % pkg['name'])
+        info.size = len(pkgbuild)
+        tar.addfile(info, StringIO(pkgbuild))
+        tar.close()
+        package.tarball.save(os.path.join('%(name)s',
+            '%s.tar.gz' % pkg['name']), ContentFile(_gzip(buffer.getvalue())))
+        saved_files.append(package.tarball.name)
+    # Save source files
+    for index in range(len(pkg['source'])):
+        source_filename = pkg['source'][index]
+        source = PackageFile(package=package)
+        # If it's a local file, save to disk with the hashes computed while
+        # validating it, otherwise record as url with the declared hashes
+        contents = pkg.get_file(source_filename)
+        if contents is not None:
+            hashes = pkg.get_hashes(source_filename)
+            source.filename.save('%(name)s/sources/' + source_filename,
+                    _get_content(contents, hashes), save=False)
+            saved_files.append(source.filename.name)
+            hashes = hashes.items()
+        else:
+            # TODO: Check that it _is_ a url, otherwise report an error
+            # that files are missing
+            source.url = source_filename
+            hashes = []
+            for hash_type in ('md5', 'sha1', 'sha256', 'sha384', 'sha512'):
+                if pkg[hash_type + 'sums']:
+                    hashes.append((hash_type,
+                        pkg[hash_type + 'sums'][index]))
+        files.append((source, hashes))
+    # Save install files
+    for file in pkg['install']:
+        hashes = pkg.get_hashes(file)
+        source = PackageFile(package=package)
+        source.filename.save('%(name)s/install/' + file,
+                _get_content(pkg.get_file(file), hashes), save=False)
+        saved_files.append(source.filename.name)
+        files.append((source, hashes.items()))
+    # Insert the files, then fetch their ids (in insertion order) to insert
+    # the hashes
+    bulk_insert(PackageFile, ('package', 'filename', 'url'),
+            [(package.id, source.filename.name or None, source.url)
+                for source, hashes in files])
+    ids = PackageFile.objects.filter(package=package)
+    if old_ids:
+        ids = ids.exclude(id__in=old_ids)
+    ids = ids.order_by('id').values_list('id', flat=True)
+    rows = []
+    for id, (source, hashes) in zip(ids, files):
+        for hash_type, hash in hashes:
+            rows.append((hash, hash_type, id))
+    bulk_insert(PackageHash, ('hash', 'type', 'file'), rows)
+    # Files still used by the new version, or by other packages, are kept
+    bulk_delete(PackageHash, 'file', old_ids)
+    bulk_delete(PackageFile, 'id', old_ids)
+    names = [name for id, name in old_files]
+    if old_tarball != package.tarball.name:
+        names.append(old_tarball)
+    if replaced_files is None:
+        release_files(names)
+    else:
+        replaced_files.extend(names)
+    return package
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+class UploadStream(object):
+    """A file-like object reading an uploaded file chunk by chunk
+
+    The SHA-256 hash of the upload is computed as it is read, and
+    :exc:`UploadTooLarge` is raised as soon as more than *max_size* bytes
+    have been read.
+    """
+    def __init__(self, file, max_size=None):
+        self.name = file.name
+        self.size = 0
+        self.max_size = max_size
+        self.sha256 = hashlib.sha256()
+        self._chunks = iter(file.chunks())
+        self._buffer = ''
+        self._offset = 0
+
+    def _fill(self):
+        """Read the next chunk into the buffer, return False at the end of
+        the upload"""
+        try:
+            chunk = self._chunks.next()
+        except StopIteration:
+            return False
+        self.size += len(chunk)
+        if self.max_size and self.size > self.max_size:
+            raise UploadTooLarge('file exceeds %d bytes' % self.max_size)
+        self.sha256.update(chunk)
+        self._buffer = self._buffer[self._offset:] + chunk
+        self._offset = 0
+        return True
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) - self._offset < size:
+            if not self._fill():
+                break
+        if size < 0:
+            size = len(self._buffer) - self._offset
+        data = self._buffer[self._offset:self._offset + size]
+        self._offset += len(data)
+        return data
+
+
+class UploadSizeLimitHandler(FileUploadHandler):
+    """An upload handler which stops receiving a file as soon as it exceeds
+    *max_size* bytes, before the handlers after it write it to disk
+
+    The rest of the request is read and discarded, and the file is left out
+    of ``request.FILES``. Whether this happened is kept in
+    :attr:`exceeded`.
+    """
+    def __init__(self, request=None, max_size=None):
+        super(UploadSizeLimitHandler, self).__init__(request)
+        self.max_size = max_size
+        self.exceeded = False
+
+    def receive_data_chunk(self, raw_data, start):
+        if self.max_size and start + len(raw_data) > self.max_size:
+            self.exceeded = True
+            raise StopUpload()
+        return raw_data
+
+    def file_complete(self, file_size):
+        return None
+
+
 class PackageField(forms.FileField):
     widget = forms.widgets.FileInput
     def __init__(self, *args, **kwargs):
@@ -80,44 +408,27 @@ class PackageField(forms.FileField):
         file = super(PackageField, self).clean(data, initial)
 
         errors = list()
-        # Save the uploaded file to disk
-        directory = tempfile.mkdtemp()
-        filename = os.path.join(directory, file.name)
-        fp = open(filename, "wb")
-        for chunk in file.chunks():
-            fp.write(chunk)
-        fp.close()
-
-        # Try to parse the PKGBUILD
+        max_size = getattr(settings, 'AUR_MAX_UPLOAD_SIZE', None)
+        if max_size and file.size > max_size:
+            raise forms.ValidationError('file exceeds %d bytes' % max_size)
+        # Parse the upload while reading it, the size limit also applies to
+        # the contents of tar files
+        stream = UploadStream(file, max_size)
         try:
-            pkg = PKGBUILD.Package(filename)
+            pkg = PKGBUILD.Package(stream, max_size=max_size)
+            # Hash the rest of the file, e.g. tar padding
+            while stream.read(65536):
+                pass
         except:
             raise forms.ValidationError(sys.exc_info()[1])
-        # Add path of the tarball/PKGBUILD so we can reference in other places
-        pkg['filename'] = filename
-        # Validate PKGBUILD
-        pkg.validate()
-        if not pkg.is_valid() or pkg.has_warnings():
-            errors.extend(pkg.get_errors())
-            errors.extend(pkg.get_warnings())
-        # Check if we have everything we need
-        for arch in pkg['arch']:
-            try:
-                Architecture.objects.get(name=arch)
-            except Architecture.DoesNotExist:
-                errors.append('architecture %s does not exist' % arch)
-        if pkg['install']:
-            try:
-                tar = tarfile.open(filename)
-            except tarfile.ReadError:
-                errors.append('install files are missing')
-            else:
-                files = tar.getnames()
-                for file in pkg['install']:
-                    filepath = os.path.join(pkg['name'], file)
-                    if not filepath in files:
-                        errors.append('install file "%s" is missing' % file)
-                del files
+        # Keep the upload, it's stored as the package's tarball. The
+        # content storage can use the hash instead of reading it again.
+        file.content_hash = stream.sha256.hexdigest()
+        pkg['filename'] = file.name
+        pkg['upload'] = file
+        errors.extend(get_package_errors(pkg))
+        errors.extend(get_architecture_errors(pkg,
+            set(Architecture.objects.values_list('name', flat=True))))
         # Report errors or return the validated package
         if errors:
             raise forms.ValidationError(errors)
@@ -138,127 +449,22 @@ class PackageSubmitForm(forms.Form):
     @transaction.commit_manually
     def save(self, user):
         pkg = self.cleaned_data['package']
-        tmpdir = os.path.dirname(pkg['filename'])
-        updating = False
-        creating = False
-        try:
-            package = Package.objects.get(name=pkg['name'])
-        except Package.DoesNotExist:
-            package = Package(name=pkg['name'])
-            creating = True
-        else:
-            updating = True
-        package.version=pkg['version']
-        package.release=pkg['release']
-        package.description=pkg['description']
-        package.url=pkg['url']
-        package.repository=Repository.objects.get(name__iexact=self.cleaned_data['repository'])
-        # Save the package so we can reference it
-        package.save()
-        if creating:
-            package.maintainers.add(user)
-        else:
-            # TODO: Check if user can upload/overwrite the package
-            pass
-        # Check for, and add dependencies
-        for dependency in pkg['depends']:
-            # This would be nice, but we don't have access to the official
-            # repositories
-            try:
-                dep = Package.objects.get(name=dependency)
-            except Package.DoesNotExist:
-                # Fail silently
-                pass
-            else:
-                package.depends.add(dep)
-        # Add provides
-        for provision in pkg['provides']:
-            object, created = Provision.objects.get_or_create(name=provision)
-            package.provides.add(object)
-        # Add licenses
-        for license in pkg['licenses']:
-            object, created = License.objects.get_or_create(name=license)
-            package.licenses.add(object)
-        # Add architectures
-        for arch in pkg['arch']:
-            object = Architecture.objects.get(name=arch)
-            package.architectures.add(object)
-        # Check if the uploaded file is a tar file or just a PKGBUILD
+        repository = Repository.objects.get(
+                name__iexact=self.cleaned_data['repository'])
+        saved_files = []
+        replaced_files = []
         try:
-            tar = tarfile.open(pkg['filename'], "r")
-        except tarfile.ReadError:
-            # It's not a tar file, so if must be a PKGBUILD since it validated
-            is_tarfile = False
-            pkgbuild = pkg['filename']
-        else:
-            is_tarfile = True
-            tmpdir_sources = os.path.join(tmpdir, 'sources')
-            tar.extractall(tmpdir_sources)
-            pkgbuild = os.path.join(tmpdir_sources, pkg['name'], 'PKGBUILD')
-        # Remove all sources. It's easier and cleaner this way.
-        if updating:
-            PackageFile.objects.filter(package=pkg['name']).delete()
-            package.tarball.delete()
-        # Hash and save PKGBUILD
-        fp = File(open(pkgbuild, "r"))
-        source = PackageFile(package=package)
-        source.filename.save('%(name)s/sources/PKGBUILD', fp)
-        source.save()
-        fp.seek(0)
-        md5hash = hashlib.md5(''.join(fp.readlines()))
-        hash = PackageHash(hash=md5hash.hexdigest(), file=source, type='md5')
-        hash.save()
-        fp.close()
-        # Save tarball
-        # TODO: Tar the saved sources instead of using the uploaded one, for
-        # security
-        if not is_tarfile:
-            # We only have the PKGBUILD, so lets make a tarball
-            try:
-                tarball_path = os.path.join(tmpdir, pkg['name'] + '.tar.gz')
-                tar = tarfile.open(str(tarball_path), "w|gz")
-                tar.add(pkg['filename'], '%s/PKGBUILD' % pkg['name'])
-                tar.close()
-                pkg['filename'] = os.path.join(tmpdir, '%s.tar.gz' % pkg['name'])
-            except:
-                transaction.rollback()
-                raise
-        fp = File(open(pkg['filename'], "rb"))
-        package.tarball.save(os.path.join('%(name)s', os.path.basename(pkg['filename'])), fp)
-        fp.close()
-        # Save source files
-        for index in range(len(pkg['source'])):
-            source_filename = pkg['source'][index]
-            source = PackageFile(package=package)
-            # If it's a local file, save to disk, otherwise record as url
-            source_file = os.path.join(tmpdir_sources, package.name, source_filename)
-            if is_tarfile and os.path.exists(source_file):
-                fp = File(open(source_file, "r"))
-                source.filename.save('%(name)s/sources/' + source_filename, fp)
-                fp.close()
-            else:
-                # TODO: Check that it _is_ a url, otherwise report an error
-                # that files are missing
-                source.url = source_filename
-            source.save()
-            # Check for, and save, any hashes this file may have
-            for hash_type in ('md5', 'sha1', 'sha256', 'sha384', 'sha512'):
-                if pkg[hash_type + 'sums']:
-                    PackageHash(hash=pkg[hash_type + 'sums'][index],
-                            file=source, type=hash_type).save()
-        # Save install files
-        for file in pkg['install']:
-            source = PackageFile(package=package)
-            source_path = os.path.join(tmpdir_sources, pkg['name'], file)
-            fp = File(open(source_path, "r"))
-            source.filename.save('%(name)s/install/' + file, fp)
-            fp.close()
-            source.save()
+            package = store_package(pkg, repository, user, saved_files,
+                    replaced_files)
+        except:
+            transaction.rollback()
+            release_files(saved_files)
+            transaction.commit()
+            raise
         transaction.commit()
-        # Remove temporary files
-        for root, dirs, files in os.walk(tmpdir, topdown=False):
-            for name in files:
-                os.remove(os.path.join(root, name))
-            for name in dirs:
-                os.rmdir(os.path.join(root, name))
-        os.rmdir(tmpdir)
+        # Invalidated on save too, but before the commit
+        invalidate_packages()
+        release_files(replaced_files)
+        dependency_graph.update(package)
+        dependency_graph.update_ids(package.relinked_ids)
+        pkg.close()
@@ -0,0 +1,254 @@
+"""In-memory package dependency graph
+
+Walking the self-referential many-to-many relations of :class:`Package`
+takes a query per package. :class:`DependencyGraph` loads all of the
+dependency relations with a few queries instead, and answers transitive
+and reverse dependency, build order and cycle queries from memory.
+"""
+import threading
+
+from aur.cache import get_generation, PACKAGES_GENERATION_KEY
+from aur.models import Package, get_relations
+
+# Relations followed by the graph, and whether they are needed to build
+RELATIONS = ('depends', 'make_depends', 'conflicts', 'replaces')
+BUILD_RELATIONS = ('depends', 'make_depends')
+
+class UnknownPackage(KeyError):
+    """Raised by the lookups of :class:`DependencyGraph` for names of
+    packages which aren't in the graph"""
+
+class DependencyGraph(object):
+    """A graph of the dependency relations of all packages
+
+    The graph is loaded when first used and kept up to date incrementally
+    with :meth:`update` and :meth:`remove`.
+
+    .. note::
+
+        Every process has its own graph. It is loaded again when the
+        packages generation of :mod:`aur.cache` changes, so changes made by
+        other processes are seen as long as the cache is shared between
+        them.
+    """
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._loaded = False
+        self._generation = None
+
+    def _load(self):
+        # Read first, so that changes made while loading cause another load
+        self._generation = get_generation(PACKAGES_GENERATION_KEY)
+        self._names = dict(Package.objects.values_list('id', 'name'))
+        self._ids = dict([(name, id) for id, name in self._names.items()])
+        self._edges = {}
+        self._reverse = {}
+        for relation in RELATIONS:
+            edges = {}
+            reverse = {}
+            for id, target in get_relations(Package, relation):
+                edges.setdefault(id, set()).add(target)
+                reverse.setdefault(target, set()).add(id)
+            self._edges[relation] = edges
+            self._reverse[relation] = reverse
+        self._provides = {}
+        for id, name in get_relations(Package, 'provides', attr='name'):
+            self._provides.setdefault(id, set()).add(name)
+        self._loaded = True
+
+    def _ensure_loaded(self):
+        if not self._loaded or self._generation != get_generation(
+                PACKAGES_GENERATION_KEY):
+            self._load()
+
+    def reset(self):
+        """Discard the graph, it is reloaded by the next lookup"""
+        self._lock.acquire()
+        try:
+            self._loaded = False
+        finally:
+            self._lock.release()
+
+    def _remove_edges(self, id):
+        for relation in RELATIONS:
+            for target in self._edges[relation].pop(id, ()):
+                sources = self._reverse[relation].get(target)
+                if sources is not None:
+                    sources.discard(id)
+        self._provides.pop(id, None)
+
+    def update(self, package):
+        """Reload the relations of *package*"""
+        self._lock.acquire()
+        try:
+            if not self._loaded:
+                return
+            self._remove_edges(package.id)
+            self._names[package.id] = package.name
+            self._ids[package.name] = package.id
+            missing = set()
+            for relation in RELATIONS:
+                targets = set([target for id, target
+                    in get_relations(Package, relation, [package.id])])
+                if targets:
+                    self._edges[relation][package.id] = targets
+                for target in targets:
+                    self._reverse[relation].setdefault(target,
+                            set()).add(package.id)
+                    if target not in self._names:
+                        missing.add(target)
+            # Targets may have been created by another process since the
+            # graph was loaded
+            if missing:
+                for id, name in Package.objects.filter(
+                        id__in=list(missing)).values_list('id', 'name'):
+                    self._names[id] = name
+                    self._ids[name] = id
+                    missing.discard(id)
+            # Any others have been deleted meanwhile
+            for target in missing:
+                for relation in RELATIONS:
+                    self._edges[relation].get(package.id, set()).discard(
+                            target)
+                    self._reverse[relation].pop(target, None)
+            provides = set(package.provides.values_list('name', flat=True))
+            if provides:
+                self._provides[package.id] = provides
+        finally:
+            self._lock.release()
+
+    def update_ids(self, ids):
+        """Reload the relations of the packages with ids *ids*"""
+        if not ids or not self._loaded:
+            return
+        for package in Package.objects.filter(id__in=list(ids)):
+            self.update(package)
+
+    def remove(self, package):
+        """Remove *package* from the graph"""
+        self._lock.acquire()
+        try:
+            if not self._loaded or package.id not in self._names:
+                return
+            self._remove_edges(package.id)
+            # Packages depending on the removed one lose the relation too
+            for relation in RELATIONS:
+                for source in self._reverse[relation].pop(package.id, ()):
+                    self._edges[relation].get(source, set()).discard(
+                            package.id)
+            del self._ids[self._names.pop(package.id)]
+        finally:
+            self._lock.release()
+
+    def _walk(self, id, edges, relations):
+        """Return the ids reachable from *id* through *relations* of
+        *edges*, without *id* itself"""
+        seen = set()
+        stack = [id]
+        while stack:
+            current = stack.pop()
+            for relation in relations:
+                for target in edges[relation].get(current, ()):
+                    if target not in seen and target != id:
+                        seen.add(target)
+                        stack.append(target)
+        return seen
+
+    def _sorted_names(self, ids):
+        return sorted([self._names[id] for id in ids])
+
+    def _get_id(self, name):
+        """Return the id of the package *name*, raising
+        :exc:`UnknownPackage` if there's no such package"""
+        self._ensure_loaded()
+        try:
+            return self._ids[name]
+        except KeyError:
+            raise UnknownPackage(name)
+
+    def direct(self, name, relation):
+        """Return the names of the packages *name* relates to through
+        *relation*"""
+        self._lock.acquire()
+        try:
+            return self._sorted_names(self._edges[relation].get(
+                self._get_id(name), ()))
+        finally:
+            self._lock.release()
+
+    def provides(self, name):
+        """Return the names provided by the package *name*"""
+        self._lock.acquire()
+        try:
+            return sorted(self._provides.get(self._get_id(name), ()))
+        finally:
+            self._lock.release()
+
+    def depends(self, name, relations=BUILD_RELATIONS):
+        """Return the names of the packages *name* depends on, directly or
+        indirectly, through *relations*"""
+        self._lock.acquire()
+        try:
+            return self._sorted_names(self._walk(self._get_id(name),
+                self._edges, relations))
+        finally:
+            self._lock.release()
+
+    def reverse_depends(self, name, relations=BUILD_RELATIONS):
+        """Return the names of the packages which depend on *name*, directly
+        or indirectly, through *relations*"""
+        self._lock.acquire()
+        try:
+            return self._sorted_names(self._walk(self._get_id(name),
+                self._reverse, relations))
+        finally:
+            self._lock.release()
+
+    def build_order(self, name, relations=BUILD_RELATIONS):
+        """Return a tuple of the names of *name* and its dependencies in the
+        order they can be built, dependencies first, and a list of the
+        dependency cycles found, each a list of names
+
+        The dependencies of a cycle can't all be built before each other,
+        so its packages are ordered as if the edge closing it didn't exist.
+        """
+        self._lock.acquire()
+        try:
+            root = self._get_id(name)
+            order = []
+            cycles = []
+            done = set()
+            # Iterative depth first search, a stack of (id, targets left)
+            path = [root]
+            stack = [(root, self._targets(root, relations))]
+            while stack:
+                id, targets = stack[-1]
+                if targets:
+                    target = targets.pop()
+                    if target in done:
+                        continue
+                    if target in path:
+                        cycles.append([self._names[cycle_id] for cycle_id
+                            in path[path.index(target):]])
+                        continue
+                    path.append(target)
+                    stack.append((target, self._targets(target, relations)))
+                else:
+                    stack.pop()
+                    path.pop()
+                    done.add(id)
+                    order.append(self._names[id])
+            return order, cycles
+        finally:
+            self._lock.release()
+
+    def _targets(self, id, relations):
+        """Return the ids *id* relates to through *relations*, sorted by
+        name in reverse so that they are visited in name order"""
+        targets = set()
+        for relation in relations:
+            targets.update(self._edges[relation].get(id, ()))
+        return sorted(targets, key=lambda target: self._names[target],
+                reverse=True)
+
+dependency_graph = DependencyGraph()
@@ -0,0 +1,36 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from aur.models import Package, Repository
+from aur.repodb import update_database
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--repository', dest='repository', default=None,
+            help='Only include the packages of this repository.'),
+        make_option('--full', dest='full', action='store_true',
+            default=False, help='Render all packages again, instead of only '
+                'those updated since the previous run.'),
+        make_option('--batch-size', dest='batch_size', type='int',
+            default=500, help='Number of packages rendered per query.'),
+    )
+    help = 'Writes the packages to a pacman sync database, updating only ' \
+            'the entries of changed packages.'
+    args = '<database.db.tar.gz>'
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Enter the filename of the database.')
+        queryset = Package.objects.filter(deleted=False)
+        if options.get('repository'):
+            try:
+                repository = Repository.objects.get(
+                        name__iexact=options['repository'])
+            except Repository.DoesNotExist:
+                raise CommandError('Repository "%s" does not exist.' %
+                        options['repository'])
+            queryset = queryset.filter(repository=repository)
+        written, removed = update_database(args[0], queryset,
+                options.get('full'), max(options.get('batch_size') or 1, 1))
+        print '%d entries written, %d removed' % (written, removed)
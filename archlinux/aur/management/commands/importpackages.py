@@ -0,0 +1,185 @@
+import os
+import sys
+import time
+from itertools import imap
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+
+import aur.Package as PKGBUILD
+from aur.cache import invalidate_packages
+from aur.forms import get_package_errors, get_architecture_errors, \
+        store_package
+from aur.graph import dependency_graph
+from aur.models import Architecture, Repository, release_files
+
+TARBALL_EXTENSIONS = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2')
+
+def load_package(filename):
+    """Parse and validate a tarball
+
+    Returns a tuple of the filename, the :class:`aur.Package.Package` (or
+    None if it couldn't be parsed) and a list of errors. This runs in the
+    worker processes, so it must not access the database.
+    """
+    try:
+        pkg = PKGBUILD.Package(filename)
+    except:
+        return (filename, None, [str(sys.exc_info()[1])])
+    pkg['filename'] = filename
+    errors = get_package_errors(pkg)
+    pkg.close()
+    return (filename, pkg, errors)
+
+def find_tarballs(paths):
+    """Return the tarballs in *paths*, searching directories recursively"""
+    tarballs = []
+    for path in paths:
+        if not os.path.isdir(path):
+            tarballs.append(path)
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                if name.endswith(TARBALL_EXTENSIONS):
+                    tarballs.append(os.path.join(root, name))
+    return tarballs
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--repository', dest='repository', default='unsupported',
+            help='Name of the repository packages are imported into.'),
+        make_option('--maintainer', dest='maintainer', default=None,
+            help='Username of the maintainer of newly created packages.'),
+        make_option('--processes', dest='processes', type='int', default=None,
+            help='Number of processes parsing packages. Defaults to the '
+                 'number of CPUs.'),
+        make_option('--batch-size', dest='batch_size', type='int',
+            default=100, help='Number of packages stored per transaction.'),
+    )
+    help = 'Imports package tarballs in bulk, parsing them in parallel.'
+    args = '<directory or tarball ...>'
+
+    def handle(self, *paths, **options):
+        if not paths:
+            raise CommandError('Enter at least one directory or tarball.')
+        tarballs = find_tarballs(paths)
+        processes = options.get('processes')
+        batch_size = max(options.get('batch_size') or 1, 1)
+
+        # Fork the workers before connecting to the database, so that they
+        # don't share the connection
+        pool = None
+        if processes != 1:
+            from multiprocessing import Pool
+            pool = Pool(processes)
+            results = pool.imap_unordered(load_package, tarballs, 8)
+        else:
+            results = imap(load_package, tarballs)
+
+        try:
+            try:
+                repository = Repository.objects.get(
+                        name__iexact=options.get('repository'))
+            except Repository.DoesNotExist:
+                raise CommandError('Repository "%s" does not exist.'
+                        % options.get('repository'))
+            user = None
+            if options.get('maintainer'):
+                try:
+                    user = User.objects.get(username=options['maintainer'])
+                except User.DoesNotExist:
+                    raise CommandError('User "%s" does not exist.'
+                            % options['maintainer'])
+            architectures = set(Architecture.objects.values_list('name',
+                flat=True))
+
+            start = time.time()
+            failures = []
+            imported = 0
+            batch = []
+            for filename, pkg, errors in results:
+                if pkg is not None:
+                    errors.extend(get_architecture_errors(pkg, architectures))
+                if errors:
+                    failures.append((filename, errors))
+                    continue
+                batch.append((filename, pkg))
+                if len(batch) >= batch_size:
+                    imported += self.store_batch(batch, repository, user,
+                            failures)
+                    batch = []
+            if batch:
+                imported += self.store_batch(batch, repository, user,
+                        failures)
+            elapsed = time.time() - start
+        finally:
+            # Also stops the workers if importing failed, e.g. with a
+            # CommandError
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+        for filename, errors in failures:
+            sys.stderr.write('%s: %s\n' % (filename, '; '.join(errors)))
+        rate = 0
+        if elapsed:
+            rate = imported / elapsed
+        print '%d packages imported, %d failed in %.1fs (%.1f packages/s)' % (
+                imported, len(failures), elapsed, rate)
+
+    def store_batch(self, batch, repository, user, failures):
+        """Store packages and return how many were stored. Packages which
+        fail are rolled back individually, their files are released and they
+        are added to *failures*. Files replaced by updated packages are
+        released once they are committed.
+
+        The batch is stored in a single transaction if the database supports
+        savepoints. Otherwise, e.g. on SQLite and MySQL, a failed package
+        can't be rolled back on its own, so each is stored in its own
+        transaction.
+        """
+        stored = []
+        replaced = []
+        savepoints = connection.features.uses_savepoints
+        transaction.enter_transaction_management()
+        transaction.managed(True)
+        try:
+            for filename, pkg in batch:
+                saved_files = []
+                replaced_files = []
+                if savepoints:
+                    sid = transaction.savepoint()
+                try:
+                    package = store_package(pkg, repository, user,
+                            saved_files, replaced_files)
+                except Exception:
+                    error = str(sys.exc_info()[1])
+                    if savepoints:
+                        transaction.savepoint_rollback(sid)
+                    else:
+                        transaction.rollback()
+                    # Files shared with stored packages are kept
+                    release_files(saved_files)
+                    failures.append((filename, [error]))
+                else:
+                    if savepoints:
+                        transaction.savepoint_commit(sid)
+                    else:
+                        transaction.commit()
+                    stored.append(package)
+                    replaced.extend(replaced_files)
+                pkg.close()
+            transaction.commit()
+            # Invalidated on save too, but before the commit
+            invalidate_packages()
+            release_files(replaced)
+        finally:
+            transaction.leave_transaction_management()
+        for package in stored:
+            dependency_graph.update(package)
+            dependency_graph.update_ids(package.relinked_ids)
+        return len(stored)
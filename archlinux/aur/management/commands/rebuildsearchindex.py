@@ -0,0 +1,11 @@
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from aur.search import get_backend
+
+class Command(NoArgsCommand):
+    help = 'Rebuilds the package search index.'
+
+    @transaction.commit_on_success
+    def handle_noargs(self, **options):
+        get_backend().rebuild()
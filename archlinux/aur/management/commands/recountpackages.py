@@ -0,0 +1,24 @@
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from django.db.models import Count
+
+from aur.cache import invalidate_cache
+from aur.models import Package, Vote, Comment
+
+class Command(NoArgsCommand):
+    help = 'Recalculates the vote and comment totals of all packages.'
+
+    @transaction.commit_on_success
+    def handle_noargs(self, **options):
+        Package.objects.update(vote_count=0, comment_count=0)
+        votes = Vote.objects.values('package').annotate(total=Count('id'))
+        for row in votes.order_by():
+            Package.objects.filter(id=row['package']).update(
+                    vote_count=row['total'])
+        comments = Comment.objects.filter(hidden=False).values(
+                'package').annotate(total=Count('id'))
+        for row in comments.order_by():
+            Package.objects.filter(id=row['package']).update(
+                    comment_count=row['total'])
+        # Updates don't send signals
+        invalidate_cache()
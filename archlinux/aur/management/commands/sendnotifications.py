@@ -0,0 +1,175 @@
+import sys
+from datetime import datetime, timedelta
+from optparse import make_option
+
+from django.conf import settings
+from django.core import mail
+from django.core.management.base import NoArgsCommand, CommandError
+from django.template import Context
+from django.template.loader import get_template
+
+from aur.models import NotificationPreference, QueuedNotification
+
+def get_message(notification, template):
+    """Return the :class:`EmailMessage` of a queued notification"""
+    if notification.deleted:
+        subject = "Archlinux AUR: %s deleted" % notification.package_name
+    else:
+        subject = "Archlinux AUR: %s updated" % notification.package_name
+    body = template.render(Context({
+        'package': notification.get_package(),
+        'user': notification.user,
+        'deleted': notification.deleted,
+    }))
+    return mail.EmailMessage(subject, body, settings.DEFAULT_FROM_EMAIL,
+            [notification.user.email])
+
+def get_digest_message(notifications, template):
+    """Return an :class:`EmailMessage` summarizing the queued notifications
+    of a user"""
+    user = notifications[0].user
+    subject = "Archlinux AUR: %d packages changed" % len(notifications)
+    body = template.render(Context({
+        'user': user,
+        'notifications': [(notification.get_package(), notification.deleted)
+            for notification in notifications],
+    }))
+    return mail.EmailMessage(subject, body, settings.DEFAULT_FROM_EMAIL,
+            [user.email])
+
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int',
+            default=100, help='Number of messages sent per SMTP connection.'),
+        make_option('--max-attempts', dest='max_attempts', type='int',
+            default=5, help='Number of times sending a message is attempted '
+                'before giving up on it and removing it from the queue.'),
+        make_option('--digest', dest='digest', default=None,
+            help='Send the "daily" or "weekly" digests instead of the '
+                'immediate notifications.'),
+    )
+    help = 'Sends the queued package update notifications.'
+
+    def handle_noargs(self, **options):
+        batch_size = max(options.get('batch_size') or 1, 1)
+        max_attempts = options.get('max_attempts')
+        digest = options.get('digest')
+        if digest not in (None, NotificationPreference.DAILY,
+                NotificationPreference.WEEKLY):
+            raise CommandError('Unknown digest "%s".' % digest)
+        queue = QueuedNotification.objects.filter(attempts__lt=max_attempts,
+                next_attempt__lte=datetime.now())
+        if digest:
+            sent, failed = self.send_digests(queue.filter(delivery=digest),
+                    batch_size)
+        else:
+            sent, failed = self.send_notifications(queue.filter(
+                delivery=NotificationPreference.IMMEDIATE), batch_size)
+        discarded = self.discard_exhausted(max_attempts)
+        print '%d notifications sent, %d failed, %d discarded' % (sent,
+                failed, discarded)
+
+    def discard_exhausted(self, max_attempts):
+        """Remove the notifications which failed *max_attempts* times from
+        the queue, log them and return how many there were"""
+        exhausted = QueuedNotification.objects.filter(
+                attempts__gte=max_attempts)
+        discarded = 0
+        for notification in exhausted.select_related('user').order_by('id'):
+            sys.stderr.write('%s: giving up on %s after %d attempts: %s\n' % (
+                notification.user.email, notification.package_name,
+                notification.attempts, notification.last_error))
+            discarded += 1
+        if discarded:
+            exhausted.delete()
+        return discarded
+
+    def send_notifications(self, queue, batch_size):
+        """Send a message per notification"""
+        template = get_template('aur/email_notification.txt')
+        sent = failed = 0
+        last_id = 0
+        while True:
+            # Failed notifications are only retried by the next run
+            batch = list(queue.filter(id__gt=last_id).select_related(
+                'user').order_by('id')[:batch_size])
+            if not batch:
+                break
+            last_id = batch[-1].id
+            batch_sent, batch_failed = self.send_batch([([notification],
+                get_message(notification, template))
+                for notification in batch])
+            sent += batch_sent
+            failed += batch_failed
+        return sent, failed
+
+    def send_digests(self, queue, batch_size):
+        """Send a message per user, listing all of their notifications"""
+        template = get_template('aur/email_digest.txt')
+        sent = failed = 0
+        users = list(queue.order_by('user').values_list('user',
+            flat=True).distinct())
+        for start in range(0, len(users), batch_size):
+            notifications = {}
+            for notification in queue.filter(user__in=users[start:start +
+                    batch_size]).select_related('user').order_by(
+                            'package_name'):
+                notifications.setdefault(notification.user_id,
+                        []).append(notification)
+            batch_sent, batch_failed = self.send_batch([(group,
+                get_digest_message(group, template))
+                for group in notifications.values()])
+            sent += batch_sent
+            failed += batch_failed
+        return sent, failed
+
+    def send_batch(self, batch):
+        """Send a batch of messages over a single connection and return how
+        many were sent and how many failed
+
+        *batch* is a list of tuples of the notifications a message covers and
+        the message. Sent notifications are removed from the queue and failed
+        ones are retried later."""
+        sent = []
+        failed = 0
+        # Users without an address have nothing to be sent
+        skipped = [notification.id for notifications, message in batch
+                for notification in notifications
+                if not notification.user.email]
+        batch = [(notifications, message)
+                for notifications, message in batch if message.to[0]]
+        connection = mail.SMTPConnection(fail_silently=False)
+        try:
+            # Opening the connection here keeps it open for all messages
+            if hasattr(connection, 'open'):
+                connection.open()
+            for notifications, message in batch:
+                try:
+                    connection.send_messages([message])
+                except Exception:
+                    failed += 1
+                    self.retry_later(notifications, sys.exc_info()[1])
+                else:
+                    sent.extend([notification.id
+                        for notification in notifications])
+        except Exception:
+            # The connection failed, retry all unsent messages
+            for notifications, message in batch:
+                if notifications[0].id not in sent:
+                    failed += 1
+                    self.retry_later(notifications, sys.exc_info()[1])
+        if hasattr(connection, 'close'):
+            connection.close()
+        QueuedNotification.objects.filter(id__in=sent + skipped).delete()
+        return len(batch) - failed, failed
+
+    def retry_later(self, notifications, error):
+        """Record a failed attempt and back off exponentially"""
+        for notification in notifications:
+            notification.attempts += 1
+            notification.last_error = str(error)
+            notification.next_attempt = datetime.now() + timedelta(
+                    minutes=2 ** notification.attempts)
+            notification.save()
+        sys.stderr.write('%s: %s\n' % (notifications[0].user.email, error))
@@ -1,16 +1,19 @@
 from django.db import models
+from django.db import connection
 from django.db import transaction
 from django.db import IntegrityError
 from django.contrib.auth.models import User
-from django.core.mail import send_mass_mail
-from django.db.models import signals, permalink
-from django.dispatch import dispatcher
-from django.template.loader import render_to_string
+from django.db.models import signals, permalink, F, Q
+from django.db.models.query import QuerySet
+from django.dispatch import dispatcher, Signal
 from django.utils.encoding import smart_unicode
 
 from tagging.fields import TagField
 
-from datetime import datetime
+from aur.cache import invalidate_cache, invalidate_packages
+from aur.storage import content_storage
+
+from datetime import datetime, timedelta
 import os
 
 def _get_package_upload_to(instance, filename):
@@ -32,6 +35,191 @@ def _get_package_upload_to(instance, filename):
         package = instance
     return os.path.join('packages', filename % {'name': package.name})
 
+def _set_dirty():
+    """Make sure raw queries get committed, whether or not they run under
+    transaction management"""
+    if transaction.is_managed():
+        transaction.set_dirty()
+    else:
+        transaction.commit_unless_managed()
+
+def bulk_insert(model, fields, rows):
+    """Insert several rows into the table of *model* with a single query
+
+    *fields* should be a sequence of field names and *rows* a sequence of
+    value sequences in the same order. Values are passed to the database
+    as-is, so foreign keys should be given as primary keys. Signals aren't
+    sent and no primary keys are returned.
+    """
+    if not rows:
+        return
+    qn = connection.ops.quote_name
+    columns = [qn(model._meta.get_field(field).column) for field in fields]
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (qn(model._meta.db_table),
+            ', '.join(columns), ', '.join(['%s'] * len(columns)))
+    cursor = connection.cursor()
+    cursor.executemany(sql, [tuple(row) for row in rows])
+    _set_dirty()
+
+def bulk_relate(model, field_name, pairs):
+    """Insert (object id, related object id) *pairs* into the table of the
+    many-to-many field *field_name* of *model*, with a single query
+
+    Existing relations aren't checked.
+    """
+    if not pairs:
+        return
+    field = model._meta.get_field(field_name)
+    qn = connection.ops.quote_name
+    sql = 'INSERT INTO %s (%s, %s) VALUES (%%s, %%s)' % (
+            qn(field.m2m_db_table()), qn(field.m2m_column_name()),
+            qn(field.m2m_reverse_name()))
+    cursor = connection.cursor()
+    cursor.executemany(sql, list(pairs))
+    _set_dirty()
+
+def bulk_unrelate(model, field_name, ids):
+    """Remove all relations of the objects of *model* with primary keys
+    *ids* through the many-to-many field *field_name*, with a single query
+    """
+    if not ids:
+        return
+    field = model._meta.get_field(field_name)
+    qn = connection.ops.quote_name
+    sql = 'DELETE FROM %s WHERE %s IN (%s)' % (qn(field.m2m_db_table()),
+            qn(field.m2m_column_name()), ', '.join(['%s'] * len(ids)))
+    cursor = connection.cursor()
+    cursor.execute(sql, list(ids))
+    _set_dirty()
+
+def bulk_delete(model, field_name, values):
+    """Delete the rows of *model* whose field *field_name* is one of
+    *values* with a single query
+
+    Unlike ``QuerySet.delete()``, related objects aren't collected and no
+    signals are sent, so related rows should have been deleted first.
+    """
+    if not values:
+        return
+    qn = connection.ops.quote_name
+    sql = 'DELETE FROM %s WHERE %s IN (%s)' % (qn(model._meta.db_table),
+            qn(model._meta.get_field(field_name).column),
+            ', '.join(['%s'] * len(values)))
+    cursor = connection.cursor()
+    cursor.execute(sql, list(values))
+    _set_dirty()
+
+def bulk_add_related(instance, field_name, ids):
+    """Relate *instance* to the objects with primary keys *ids* through its
+    many-to-many field *field_name*, with a single query
+
+    Unlike the related manager's ``add()``, existing relations aren't
+    checked, so the relation should have been cleared first.
+    """
+    bulk_relate(type(instance), field_name, [(instance.pk, id)
+        for id in set(ids)])
+
+
+def get_relations(model, field_name, ids=None, related_ids=None, attr=None):
+    """Return (object id, related object id) tuples of the relations of the
+    objects of *model* through the many-to-many field *field_name*, with a
+    single query
+
+    The relations are limited to objects with primary keys *ids* and related
+    objects with primary keys *related_ids*, if given. If *attr* is given,
+    the *attr* attribute of each related object is returned instead of its
+    id.
+    """
+    # Django 1.1 can't follow many-to-many fields in values_list(), so the
+    # join table is queried directly
+    field = model._meta.get_field(field_name)
+    qn = connection.ops.quote_name
+    column = 'm.%s' % qn(field.m2m_column_name())
+    related_column = 'm.%s' % qn(field.m2m_reverse_name())
+    if attr is None:
+        sql = 'SELECT %s, %s FROM %s m' % (column, related_column,
+                qn(field.m2m_db_table()))
+    else:
+        related = field.rel.to._meta
+        sql = 'SELECT %s, r.%s FROM %s m INNER JOIN %s r ON r.%s = %s' % (
+                column, qn(related.get_field(attr).column),
+                qn(field.m2m_db_table()), qn(related.db_table),
+                qn(related.pk.column), related_column)
+    conditions = []
+    params = []
+    for name, values in ((column, ids), (related_column, related_ids)):
+        if values is not None:
+            values = list(values)
+            if not values:
+                return []
+            conditions.append('%s IN (%s)' % (name,
+                ', '.join(['%s'] * len(values))))
+            params.extend(values)
+    if conditions:
+        sql += ' WHERE ' + ' AND '.join(conditions)
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+    return cursor.fetchall()
+
+def get_related_names(packages, field, attr='name'):
+    """Return a dictionary mapping the ids of *packages* to lists of the
+    *attr* attributes of the objects related through *field*
+
+    *packages* may be :class:`Package` instances or ids. All relations are
+    loaded with a single query, e.g. ``get_related_names(packages,
+    'maintainers', 'username')``.
+    """
+    ids = [getattr(package, 'id', package) for package in packages]
+    names = dict([(id, []) for id in ids])
+    for id, name in get_relations(Package, field, ids, attr=attr):
+        if name is not None:
+            names[id].append(name)
+    for values in names.values():
+        values.sort()
+    return names
+
+
+def get_user_package_ids(user):
+    """Return a dictionary with the sets of ids of the packages *user*
+    maintains (``'maintained'``), voted for (``'voted'``) and is subscribed
+    to (``'subscribed'``)
+
+    The ids are loaded with a single query and kept on the user object, so
+    they're loaded once per request. Anonymous users have empty sets.
+    """
+    if hasattr(user, '_aur_package_ids'):
+        return user._aur_package_ids
+    ids = {'maintained': set(), 'voted': set(), 'subscribed': set()}
+    if user.is_authenticated():
+        qn = connection.ops.quote_name
+        field = Package._meta.get_field('maintainers')
+        sql = ' UNION ALL '.join([
+            "SELECT 'maintained', %s FROM %s WHERE %s = %%s" % (
+                qn(field.m2m_column_name()), qn(field.m2m_db_table()),
+                qn(field.m2m_reverse_name())),
+            "SELECT 'voted', %s FROM %s WHERE %s = %%s" % (
+                qn('package_id'), qn(Vote._meta.db_table), qn('user_id')),
+            "SELECT 'subscribed', %s FROM %s WHERE %s = %%s" % (
+                qn('package_id'), qn(PackageNotification._meta.db_table),
+                qn('user_id')),
+        ])
+        cursor = connection.cursor()
+        cursor.execute(sql, [user.id] * 3)
+        for kind, id in cursor.fetchall():
+            ids[kind].add(id)
+    user._aur_package_ids = ids
+    return ids
+
+def reset_user_package_ids(user):
+    """Discard the package ids loaded by :func:`get_user_package_ids`"""
+    if hasattr(user, '_aur_package_ids'):
+        del user._aur_package_ids
+
+
+# Sent once by bulk changes of packages which don't save each package, with
+# the list of changed packages, the name of the action and the user
+packages_changed = Signal(providing_args=['packages', 'action', 'user'])
+
 
 class Architecture(models.Model):
     name = models.CharField(max_length=10)
@@ -71,6 +259,44 @@ class Provision(models.Model):
         return self.name
 
 
+def touch_packages(ids):
+    """Mark the packages with ids *ids* as updated and increment their
+    revision
+
+    This should be done whenever relations shown with a package change
+    without the package being saved, so that the ETag and Last-Modified
+    validators derived from the package change too. The revision changes
+    the ETag even if the update time doesn't, e.g. on databases storing
+    whole seconds.
+    """
+    if ids:
+        Package.objects.filter(id__in=list(ids)).update(
+                revision=F('revision') + 1, updated=datetime.now())
+
+def unlink_dependents(ids):
+    """Mark the dependency specs resolved to the packages with ids *ids* as
+    unresolved, before the packages are deleted"""
+    specs = DependencySpec.objects.filter(target__in=ids)
+    touch_packages(set(specs.values_list('package', flat=True)))
+    specs.update(target=None)
+
+
+class PackageQuerySet(QuerySet):
+    def delete(self):
+        # Deleting would cascade to the dependency specs of other packages
+        # resolved to these, which should only become unresolved
+        ids = list(self.values_list('id', flat=True))
+        if ids:
+            unlink_dependents(ids)
+        super(PackageQuerySet, self).delete()
+    delete.alters_data = True
+
+
+class PackageManager(models.Manager):
+    def get_query_set(self):
+        return PackageQuerySet(self.model)
+
+
 class Package(models.Model):
     name = models.CharField(unique=True, max_length=30, editable=False)
     version = models.CharField(max_length=20)
@@ -81,7 +307,8 @@ class Package(models.Model):
     repository = models.ForeignKey(Repository)
     tags = TagField()
     slug = models.SlugField(editable=False)
-    tarball = models.FileField(upload_to=_get_package_upload_to)
+    tarball = models.FileField(upload_to=_get_package_upload_to,
+            storage=content_storage)
     licenses = models.ManyToManyField(License, null=True, blank=True)
     architectures = models.ManyToManyField(Architecture)
     depends = models.ManyToManyField('self', null=True, blank=True,
@@ -96,8 +323,18 @@ class Package(models.Model):
     deleted = models.BooleanField(default=False)
     outdated = models.BooleanField(default=False)
     added = models.DateTimeField(editable=False, default=datetime.now)
-    updated = models.DateTimeField(editable=False)
+    updated = models.DateTimeField(editable=False, db_index=True)
     groups = models.ManyToManyField(Group, null=True, blank=True)
+    # Denormalized totals, maintained by the Vote and Comment signal handlers
+    # and recalculated by the recountpackages command
+    vote_count = models.IntegerField(default=0, editable=False)
+    comment_count = models.IntegerField(default=0, editable=False)
+    # Incremented by touch_packages() when relations such as maintainers or
+    # dependencies change without the package being saved, see the ETags of
+    # aur.views and aur.api.handlers
+    revision = models.IntegerField(default=0, editable=False)
+
+    objects = PackageManager()
 
     def __unicode__(self):
         return u'%s %s' % (self.name, self.version)
@@ -123,15 +360,44 @@ class Package(models.Model):
             self.slug = slug
         super(Package, self).save()
 
+    def delete(self):
+        # See PackageQuerySet.delete()
+        unlink_dependents([self.id])
+        super(Package, self).delete()
+
     class Meta:
         ordering = ('-updated',)
         get_latest_by = 'updated'
 
 
+class DependencySpec(models.Model):
+    """A dependency declared by a package, e.g. ``foo>=1.2``
+
+    Every declared dependency is recorded, whether or not a package
+    satisfies it yet. *target* is the package resolved to satisfy it, see
+    :mod:`aur.dependencies`.
+    """
+    KIND_CHOICES = (
+        ('depends', 'Dependency'),
+        ('make_depends', 'Build dependency'),
+    )
+    package = models.ForeignKey(Package, related_name='dependency_specs')
+    kind = models.CharField(max_length=12, choices=KIND_CHOICES)
+    name = models.CharField(max_length=30, db_index=True)
+    operator = models.CharField(max_length=2, blank=True)
+    version = models.CharField(max_length=20, blank=True)
+    target = models.ForeignKey(Package, null=True, blank=True,
+            related_name='dependent_specs')
+
+    def __unicode__(self):
+        return u'%s%s%s' % (self.name, self.operator, self.version)
+
+
 class PackageFile(models.Model):
     package = models.ForeignKey(Package)
     # filename for local sources and url for external
-    filename = models.FileField(upload_to=_get_package_upload_to, null=True, blank=True)
+    filename = models.FileField(upload_to=_get_package_upload_to,
+            storage=content_storage, null=True, blank=True)
     url = models.URLField(null=True, blank=True)
 
     def get_absolute_url(self):
@@ -151,7 +417,9 @@ class PackageFile(models.Model):
 
 class PackageHash(models.Model):
     # sha512 hashes are 128 characters
-    hash = models.CharField(max_length=128, primary_key=True)
+    # Identical files (e.g. patches shared between packages) have identical
+    # hashes, so this can't be the primary key
+    hash = models.CharField(max_length=128, db_index=True)
     type = models.CharField(max_length=12)
     file = models.ForeignKey(PackageFile)
 
@@ -162,6 +430,17 @@ class PackageHash(models.Model):
         verbose_name_plural = 'package hashes'
 
 
+class SearchTerm(models.Model):
+    """An entry of the inverted index of :class:`aur.search.DatabaseSearchBackend`"""
+    MAX_LENGTH = 50
+    term = models.CharField(max_length=MAX_LENGTH, db_index=True)
+    package = models.ForeignKey(Package)
+    weight = models.IntegerField()
+
+    def __unicode__(self):
+        return self.term
+
+
 class Comment(models.Model):
     package = models.ForeignKey(Package)
     parent = models.ForeignKey('self', null=True, blank=True)
@@ -184,6 +463,56 @@ class PackageNotification(models.Model):
                 self.package.name)
 
 
+class NotificationPreference(models.Model):
+    """How a user wants to receive package update notifications"""
+    IMMEDIATE = 'immediate'
+    DAILY = 'daily'
+    WEEKLY = 'weekly'
+    DELIVERY_CHOICES = (
+        (IMMEDIATE, 'As they happen'),
+        (DAILY, 'Daily digest'),
+        (WEEKLY, 'Weekly digest'),
+    )
+    user = models.OneToOneField(User)
+    delivery = models.CharField(max_length=10, choices=DELIVERY_CHOICES,
+            default=IMMEDIATE)
+
+    def __unicode__(self):
+        return u"%s's notification preference" % self.user.username
+
+
+class QueuedNotification(models.Model):
+    """An email notifying a user of a change to a package, waiting to be
+    sent by the sendnotifications command
+
+    The package is copied rather than referenced, so that notifications of
+    deleted packages can be sent.
+    """
+    user = models.ForeignKey(User)
+    package_name = models.CharField(max_length=30)
+    package_version = models.CharField(max_length=20)
+    package_release = models.SmallIntegerField()
+    package_slug = models.SlugField()
+    deleted = models.BooleanField(default=False)
+    # Copied from the user's NotificationPreference
+    delivery = models.CharField(max_length=10,
+            choices=NotificationPreference.DELIVERY_CHOICES,
+            default=NotificationPreference.IMMEDIATE, db_index=True)
+    created = models.DateTimeField(default=datetime.now)
+    attempts = models.SmallIntegerField(default=0)
+    next_attempt = models.DateTimeField(default=datetime.now, db_index=True)
+    last_error = models.TextField(blank=True)
+
+    def get_package(self):
+        """Return an unsaved :class:`Package` with the copied fields"""
+        return Package(name=self.package_name, version=self.package_version,
+                release=self.package_release, slug=self.package_slug)
+
+    def __unicode__(self):
+        return u'Notification of %s about %s' % (self.user.username,
+                self.package_name)
+
+
 class Vote(models.Model):
     user = models.ForeignKey(User)
     package = models.ForeignKey(Package)
@@ -196,40 +525,207 @@ class Vote(models.Model):
         unique_together = (("user", "package"),)
 
 
-# Should this be here?
-def email_package_updates(sender, instance, signal, *args, **kwargs):
+def queue_notifications(packages, deleted=False):
+    """Queue notifications of modifications to *packages* for their
+    subscribers
+
+    The mail is sent by the sendnotifications command, so that saving a
+    package doesn't wait for the mail server.
+
+    Immediate notifications are held back for ``AUR_NOTIFICATION_WINDOW``
+    seconds, and digest notifications until the digest is sent. Further
+    changes in the meantime update the pending notification instead of
+    queueing another one, so several saves result in a single mail.
+    """
     from django.conf import settings
-    """Send notification to users of modification to a Package"""
-    subject = "Archlinux AUR: %s updated" % instance.name
-    mail_list = []
-    notifications = PackageNotification.objects.filter(package=instance)
-    for notification in notifications:
-        if not notification.user.email:
+    packages = dict([(package.id, package) for package in packages])
+    subscriptions = list(PackageNotification.objects.filter(
+        package__in=packages.keys()).exclude(user__email='').values_list(
+            'user', 'package'))
+    if not subscriptions:
+        return
+    users = set([user for user, package in subscriptions])
+    now = datetime.now()
+    pending = QueuedNotification.objects.filter(user__in=users,
+            package_name__in=[package.name for package in packages.values()],
+            attempts=0).filter(Q(next_attempt__gt=now) |
+                    ~Q(delivery=NotificationPreference.IMMEDIATE))
+    coalesced = set(pending.values_list('user', 'package_name'))
+    for name in set([name for user, name in coalesced]):
+        package = [package for package in packages.values()
+                if package.name == name][0]
+        pending.filter(package_name=name).update(
+                package_version=package.version,
+                package_release=package.release, package_slug=package.slug,
+                deleted=deleted)
+    delivery = dict(NotificationPreference.objects.filter(
+        user__in=users).values_list('user', 'delivery'))
+    window = timedelta(seconds=getattr(settings, 'AUR_NOTIFICATION_WINDOW',
+        0))
+    rows = []
+    for user, id in subscriptions:
+        package = packages[id]
+        if (user, package.name) in coalesced:
             continue
-        message = render_to_string('aur/email_notification.txt', {
-            'package': instance,
-            'user': notification.user,
-        })
-        mail_list.append((subject, message, settings.DEFAULT_FROM_EMAIL,
-            (notification.user.email,)))
-    return send_mass_mail(mail_list)
+        rows.append((user, package.name, package.version, package.release,
+            package.slug, deleted,
+            delivery.get(user, NotificationPreference.IMMEDIATE), now, 0,
+            now + window, ''))
+    bulk_insert(QueuedNotification, ('user', 'package_name',
+        'package_version', 'package_release', 'package_slug', 'deleted',
+        'delivery', 'created', 'attempts', 'next_attempt', 'last_error'),
+        rows)
+
+def queue_package_updates(sender, instance, signal, *args, **kwargs):
+    """Queue notifications of modification to a Package for its subscribers
+
+    Deletions are queued before the package's subscriptions are deleted
+    with it.
+    """
+    queue_notifications([instance], deleted=signal == signals.pre_delete)
+
+def queue_changed_packages(sender, packages, action, **kwargs):
+    """Queue notifications of packages flagged or unflagged in bulk"""
+    if action in ('flag-ood', 'unflag-ood'):
+        queue_notifications(packages)
 
 
+def update_vote_count(sender, instance, signal, *args, **kwargs):
+    """Update the vote total of a Vote's package"""
+    if signal == signals.post_delete:
+        change = -1
+    elif kwargs.get('created'):
+        change = 1
+    else:
+        return
+    # Update the column in place, so that concurrent votes aren't lost
+    Package.objects.filter(id=instance.package_id).update(
+            vote_count=F('vote_count') + change)
+
+def update_comment_count(sender, instance, signal, *args, **kwargs):
+    """Update the total of visible comments of a Comment's package"""
+    # Comments can be hidden, so recount instead of incrementing
+    total = Comment.objects.filter(package=instance.package_id,
+            hidden=False).count()
+    Package.objects.filter(id=instance.package_id).update(
+            comment_count=total)
+
+def update_search_index(sender, instance, signal, *args, **kwargs):
+    """Add a saved Package to the search indexes, or remove a deleted one"""
+    from aur.search import get_backend, name_index
+    if signal == signals.post_delete:
+        get_backend().remove(instance)
+        name_index.remove(instance)
+    else:
+        get_backend().update(instance)
+        name_index.update(instance)
+
+def reset_voter_package_ids(sender, instance, signal, *args, **kwargs):
+    """Discard the package ids loaded for the user of a Vote or
+    PackageNotification, if it was loaded along with it"""
+    user = getattr(instance, '_user_cache', None)
+    if user is not None:
+        reset_user_package_ids(user)
+
+def remove_from_dependency_graph(sender, instance, signal, *args, **kwargs):
+    """Remove a deleted Package from the dependency graph"""
+    from aur.graph import dependency_graph
+    dependency_graph.remove(instance)
+
+def get_file_references(name):
+    """Return how many package tarballs and files refer to the stored file
+    *name*"""
+    return PackageFile.objects.filter(filename=name).count() + \
+            Package.objects.filter(tarball=name).count()
+
+def release_file(name):
+    """Delete the stored file *name* if no package tarball or file refers to
+    it
+
+    Stored files are shared by identical uploads, see
+    :class:`aur.storage.ContentAddressedStorage`.
+    """
+    if name and not get_file_references(name):
+        content_storage.delete(name)
+
+def release_files(names):
+    """Delete the stored files *names* which no package tarball or file
+    refers to, with a fixed number of queries"""
+    names = set([name for name in names if name])
+    if not names:
+        return
+    used = set(PackageFile.objects.filter(filename__in=names).values_list(
+        'filename', flat=True))
+    used.update(Package.objects.filter(tarball__in=names).values_list(
+        'tarball', flat=True))
+    for name in names - used:
+        content_storage.delete(name)
+
 def remove_packagefile_filename(sender, instance, signal, *args, **kwargs):
-    """Remove PackageFile's file"""
+    """Remove PackageFile's file, unless other packages share it"""
     if instance.filename:
-        instance.filename.delete()
+        release_file(instance.filename.name)
 
 def remove_package_tarball(sender, instance, signal, *args, **kwargs):
-    """Remove Package's tarball"""
-    instance.tarball.delete()
-
-# Send notifications of updates to users on saves and deltion of packages
-signals.post_save.connect(email_package_updates, sender=Package)
-signals.post_delete.connect(email_package_updates, sender=Package)
+    """Remove Package's tarball, unless other packages share it"""
+    release_file(instance.tarball.name)
+
+# Queue notifications of updates to users on saves and deletion of packages
+signals.post_save.connect(queue_package_updates, sender=Package,
+        dispatch_uid='aur.models.queue_package_updates')
+signals.pre_delete.connect(queue_package_updates, sender=Package,
+        dispatch_uid='aur.models.queue_package_updates')
+packages_changed.connect(queue_changed_packages,
+        dispatch_uid='aur.models.queue_changed_packages')
+# Keep the search index up to date
+signals.post_save.connect(update_search_index, sender=Package,
+        dispatch_uid='aur.models.update_search_index')
+signals.post_delete.connect(update_search_index, sender=Package,
+        dispatch_uid='aur.models.update_search_index')
+# Keep the dependency graph up to date, saves are handled where the
+# relations are stored
+signals.post_delete.connect(remove_from_dependency_graph, sender=Package,
+        dispatch_uid='aur.models.remove_from_dependency_graph')
+# Keep the denormalized vote and comment totals up to date
+signals.post_save.connect(update_vote_count, sender=Vote,
+        dispatch_uid='aur.models.update_vote_count')
+signals.post_delete.connect(update_vote_count, sender=Vote,
+        dispatch_uid='aur.models.update_vote_count')
+signals.post_save.connect(update_comment_count, sender=Comment,
+        dispatch_uid='aur.models.update_comment_count')
+signals.post_delete.connect(update_comment_count, sender=Comment,
+        dispatch_uid='aur.models.update_comment_count')
+# Keep the package ids loaded for users up to date
+signals.post_save.connect(reset_voter_package_ids, sender=Vote,
+        dispatch_uid='aur.models.reset_voter_package_ids')
+signals.post_delete.connect(reset_voter_package_ids, sender=Vote,
+        dispatch_uid='aur.models.reset_voter_package_ids')
+signals.post_save.connect(reset_voter_package_ids, sender=PackageNotification,
+        dispatch_uid='aur.models.reset_voter_package_ids')
+signals.post_delete.connect(reset_voter_package_ids,
+        sender=PackageNotification,
+        dispatch_uid='aur.models.reset_voter_package_ids')
+# Invalidate cached pages, API responses and data loaded from packages
+packages_changed.connect(invalidate_packages,
+        dispatch_uid='aur.models.invalidate_packages')
+signals.post_save.connect(invalidate_packages, sender=Package,
+        dispatch_uid='aur.models.invalidate_packages')
+signals.post_delete.connect(invalidate_packages, sender=Package,
+        dispatch_uid='aur.models.invalidate_packages')
+signals.post_save.connect(invalidate_cache, sender=Comment,
+        dispatch_uid='aur.models.invalidate_cache')
+signals.post_delete.connect(invalidate_cache, sender=Comment,
+        dispatch_uid='aur.models.invalidate_cache')
+signals.post_save.connect(invalidate_cache, sender=Vote,
+        dispatch_uid='aur.models.invalidate_cache')
+signals.post_delete.connect(invalidate_cache, sender=Vote,
+        dispatch_uid='aur.models.invalidate_cache')
 # Remove files when packages get deleted
 # Django doesn't call each instance's delete() on cascade, but it does send
-# pre_delete signals
-signals.pre_delete.connect(remove_packagefile_filename, sender=PackageFile)
-signals.pre_delete.connect(remove_package_tarball, sender=Package)
+# post_delete signals. They are sent once all rows of a model have been
+# deleted, so files shared by several of the deleted rows are removed too.
+signals.post_delete.connect(remove_packagefile_filename, sender=PackageFile,
+        dispatch_uid='aur.models.remove_packagefile_filename')
+signals.post_delete.connect(remove_package_tarball, sender=Package,
+        dispatch_uid='aur.models.remove_package_tarball')
 
@@ -0,0 +1,183 @@
+"""Keyset (cursor based) pagination
+
+:class:`django.core.paginator.Paginator` counts all results and skips pages
+with OFFSET, which gets slower the deeper the page. :class:`KeysetPaginator`
+instead continues after the sort key of the last row of the previous page,
+which costs the same for every page when the ordering is indexed.
+
+Pages are identified by opaque cursor tokens, which are safe to use in URLs.
+"""
+import base64
+from datetime import datetime
+
+from django.db.models import Q
+from django.utils import simplejson
+
+class InvalidCursor(Exception):
+    pass
+
+
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return {'datetime': value.isoformat()}
+    return value
+
+def _decode_value(value):
+    if isinstance(value, dict):
+        string = value['datetime']
+        microseconds = 0
+        if '.' in string:
+            string, fraction = string.split('.', 1)
+            microseconds = int(fraction.ljust(6, '0')[:6])
+        return datetime.strptime(string, '%Y-%m-%dT%H:%M:%S').replace(
+                microsecond=microseconds)
+    return value
+
+def encode_cursor(direction, ordering, values):
+    """Return a token to continue in *direction* (``'next'`` or
+    ``'previous'``) from a row with the sort key *values* in *ordering*"""
+    data = simplejson.dumps([direction, list(ordering),
+        [_encode_value(value) for value in values]])
+    return base64.urlsafe_b64encode(data).rstrip('=')
+
+def decode_cursor(token):
+    """Return the direction, ordering and sort key values encoded in *token*
+
+    Raises :exc:`InvalidCursor` if the token is malformed.
+    """
+    try:
+        token = str(token)
+        data = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        direction, ordering, values = simplejson.loads(data)
+        if direction not in ('next', 'previous'):
+            raise ValueError
+        return direction, ordering, [_decode_value(value) for value in values]
+    except (TypeError, ValueError, KeyError, IndexError, AttributeError):
+        raise InvalidCursor('invalid cursor "%s"' % token)
+
+
+class Page(object):
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+class KeysetPaginator(object):
+    """Paginates *queryset* by *ordering*, a sequence of field names as
+    accepted by ``order_by()``
+
+    The combination of the fields in *ordering* must be unique, e.g. by
+    ending with a unique field such as ``name``. Aggregates can't be used,
+    as they can't be compared in an OR.
+    """
+    def __init__(self, queryset, per_page, ordering):
+        self.queryset = queryset
+        self.per_page = int(per_page)
+        self.ordering = list(ordering)
+        self.fields = [field.lstrip('-') for field in self.ordering]
+
+    def get_values(self, object):
+        """Return the sort key of *object*"""
+        values = []
+        for field in self.fields:
+            value = object
+            for attr in field.split('__'):
+                value = getattr(value, attr)
+            values.append(value)
+        return values
+
+    def _after(self, values, reverse):
+        """Return a Q object selecting the rows after *values*, or before if
+        *reverse* is true"""
+        condition = None
+        for index, field in enumerate(self.ordering):
+            descending = field.startswith('-')
+            if descending != reverse:
+                lookup = '%s__lt' % self.fields[index]
+            else:
+                lookup = '%s__gt' % self.fields[index]
+            clause = Q(**{lookup: values[index]})
+            for previous in range(index):
+                clause &= Q(**{self.fields[previous]: values[previous]})
+            if condition is None:
+                condition = clause
+            else:
+                condition |= clause
+        return condition
+
+    def page(self, cursor=None):
+        """Return the :class:`Page` identified by *cursor*, or the first page
+
+        Raises :exc:`InvalidCursor` if the cursor is invalid.
+        """
+        direction = 'next'
+        values = None
+        if cursor:
+            direction, ordering, values = decode_cursor(cursor)
+            # Cursors of other orderings can't be continued
+            if ordering != self.ordering or len(values) != len(self.fields):
+                raise InvalidCursor('invalid cursor "%s"' % cursor)
+        reverse = direction == 'previous'
+        if reverse:
+            ordering = [field.startswith('-') and field[1:] or '-' + field
+                    for field in self.ordering]
+        else:
+            ordering = self.ordering
+        queryset = self.queryset.order_by(*ordering)
+        if values is not None:
+            queryset = queryset.filter(self._after(values, reverse))
+        # Fetch an extra row to find out whether there's another page
+        objects = list(queryset[:self.per_page + 1])
+        more = len(objects) > self.per_page
+        objects = objects[:self.per_page]
+        if reverse:
+            objects.reverse()
+        next_cursor = previous_cursor = None
+        if objects:
+            if more or reverse:
+                next_cursor = encode_cursor('next', self.ordering,
+                        self.get_values(objects[-1]))
+            if (more and reverse) or (values is not None and not reverse):
+                previous_cursor = encode_cursor('previous', self.ordering,
+                        self.get_values(objects[0]))
+        return Page(objects, next_cursor, previous_cursor)
+
+
+class OffsetPaginator(object):
+    """Paginates with OFFSET, for orderings :class:`KeysetPaginator` can't
+    handle, using the same cursor tokens and pages"""
+    def __init__(self, queryset, per_page, ordering):
+        self.queryset = queryset.order_by(*ordering)
+        self.per_page = int(per_page)
+        self.ordering = list(ordering)
+
+    def page(self, cursor=None):
+        offset = 0
+        if cursor:
+            direction, ordering, values = decode_cursor(cursor)
+            if ordering != self.ordering or len(values) != 1 or \
+                    not isinstance(values[0], int) or values[0] < 0:
+                raise InvalidCursor('invalid cursor "%s"' % cursor)
+            offset = values[0]
+        objects = list(self.queryset[offset:offset + self.per_page + 1])
+        next_cursor = previous_cursor = None
+        if len(objects) > self.per_page:
+            next_cursor = encode_cursor('next', self.ordering,
+                    [offset + self.per_page])
+        if offset > 0:
+            previous_cursor = encode_cursor('previous', self.ordering,
+                    [max(offset - self.per_page, 0)])
+        return Page(objects[:self.per_page], next_cursor, previous_cursor)
@@ -0,0 +1,173 @@
+"""Generation of pacman sync databases
+
+A sync database is a compressed tarball with a ``<name>-<ver>-<rel>/``
+directory per package, holding a ``desc`` and a ``depends`` file. Rather
+than rendering every package on each run, the entries are kept unpacked in
+a cache directory next to the database, ``<database>.d``. Only the entries
+of packages updated since the previous run are rewritten, entries of
+packages which no longer exist are removed, and the database is then packed
+from the cache.
+"""
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+from datetime import datetime
+
+from django.utils.encoding import smart_str
+
+from aur.models import Package, DependencySpec, get_related_names
+
+# Name of the file in the cache directory recording the time of the last run
+TIMESTAMP_FILE = '.timestamp'
+
+def format_section(name, values):
+    """Return a section of a ``desc`` or ``depends`` file, or an empty
+    string if there are no *values*"""
+    values = [smart_str(value) for value in values if value]
+    if not values:
+        return ''
+    return '%%%s%%\n%s\n\n' % (name, '\n'.join(values))
+
+def get_entry_name(package):
+    """Return the name of the directory of *package* in the database"""
+    return '%s-%s-%s' % (package.name, package.version, package.release)
+
+def get_entries(packages):
+    """Return a list of tuples of the entry name, ``desc`` and ``depends``
+    contents of *packages*
+
+    The related objects of all packages are loaded with a query per
+    relation.
+    """
+    related = {}
+    for field in ('licenses', 'architectures', 'groups', 'provides',
+            'conflicts', 'replaces'):
+        related[field] = get_related_names(packages, field)
+    specs = {}
+    for spec in DependencySpec.objects.filter(package__in=[package.id
+            for package in packages]).order_by('id'):
+        specs.setdefault((spec.package_id, spec.kind), []).append(
+                unicode(spec))
+    entries = []
+    for package in packages:
+        filename = package.tarball and os.path.basename(
+                package.tarball.name) or ''
+        desc = ''.join([
+            format_section('FILENAME', [filename]),
+            format_section('NAME', [package.name]),
+            format_section('VERSION', ['%s-%s' % (package.version,
+                package.release)]),
+            format_section('DESC', [package.description]),
+            format_section('GROUPS', related['groups'][package.id]),
+            format_section('URL', [package.url]),
+            format_section('LICENSE', related['licenses'][package.id]),
+            format_section('ARCH', related['architectures'][package.id]),
+            format_section('BUILDDATE', ['%d' % time.mktime(
+                package.updated.timetuple())]),
+            format_section('REPLACES', related['replaces'][package.id]),
+        ])
+        depends = ''.join([
+            format_section('DEPENDS', specs.get((package.id, 'depends'),
+                [])),
+            format_section('MAKEDEPENDS', specs.get((package.id,
+                'make_depends'), [])),
+            format_section('CONFLICTS', related['conflicts'][package.id]),
+            format_section('PROVIDES', related['provides'][package.id]),
+        ])
+        entries.append((get_entry_name(package), desc, depends))
+    return entries
+
+def read_timestamp(directory):
+    """Return the time of the last run which used the cache *directory*, or
+    ``None``"""
+    try:
+        fp = open(os.path.join(directory, TIMESTAMP_FILE))
+    except IOError:
+        return None
+    try:
+        return datetime.fromtimestamp(float(fp.read().strip()))
+    finally:
+        fp.close()
+
+def write_timestamp(directory, timestamp):
+    fp = open(os.path.join(directory, TIMESTAMP_FILE), 'w')
+    try:
+        fp.write('%f' % (time.mktime(timestamp.timetuple()) +
+            timestamp.microsecond / 1000000.0))
+    finally:
+        fp.close()
+
+def update_database(filename, queryset=None, full=False, chunk_size=500):
+    """Bring the sync database *filename* up to date with the packages in
+    *queryset* and return the number of entries written and removed
+
+    Only packages updated since the previous run are rendered again, unless
+    *full* is true or there is no previous run.
+    """
+    if queryset is None:
+        queryset = Package.objects.filter(deleted=False)
+    directory = filename + '.d'
+    if full and os.path.isdir(directory):
+        shutil.rmtree(directory)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    # Changes made while the database is being written are picked up by the
+    # next run. Some databases (MySQL) store whole seconds, so packages
+    # saved in the same second as the run started are written again.
+    started = datetime.now().replace(microsecond=0)
+    since = read_timestamp(directory)
+    # Existing entries, by package name. Versions contain no dashes, so the
+    # name is everything before the last two.
+    cached = {}
+    for entry in os.listdir(directory):
+        if entry != TIMESTAMP_FILE:
+            cached[entry.rsplit('-', 2)[0]] = entry
+    current = dict(queryset.values_list('name', 'updated'))
+    removed = 0
+    for name, entry in cached.items():
+        if name not in current:
+            shutil.rmtree(os.path.join(directory, entry))
+            removed += 1
+    changed = [name for name, updated in current.items()
+            if since is None or name not in cached or updated >= since]
+    written = 0
+    for start in range(0, len(changed), chunk_size):
+        packages = list(queryset.filter(name__in=changed[start:start +
+            chunk_size]))
+        for name, desc, depends in get_entries(packages):
+            old = cached.get(name.rsplit('-', 2)[0])
+            if old is not None:
+                shutil.rmtree(os.path.join(directory, old))
+            os.mkdir(os.path.join(directory, name))
+            for part, contents in (('desc', desc), ('depends', depends)):
+                fp = open(os.path.join(directory, name, part), 'w')
+                fp.write(contents)
+                fp.close()
+            written += 1
+    if written or removed or not os.path.exists(filename):
+        write_archive(filename, directory)
+    write_timestamp(directory, started)
+    return written, removed
+
+def write_archive(filename, directory):
+    """Pack the entries in *directory* into the database *filename*,
+    replacing it atomically"""
+    fd, temporary = tempfile.mkstemp(dir=os.path.dirname(
+        os.path.abspath(filename)))
+    os.close(fd)
+    try:
+        tar = tarfile.open(temporary, 'w:gz')
+        for entry in sorted(os.listdir(directory)):
+            if entry == TIMESTAMP_FILE:
+                continue
+            for part in ('desc', 'depends'):
+                tar.add(os.path.join(directory, entry, part),
+                        '%s/%s' % (entry, part))
+        tar.close()
+        os.chmod(temporary, 0644)
+        os.rename(temporary, filename)
+    except:
+        os.remove(temporary)
+        raise
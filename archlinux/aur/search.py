@@ -0,0 +1,228 @@
+"""Package search backends
+
+The backend used by :class:`aur.forms.PackageSearchForm` is set with the
+``AUR_SEARCH_BACKEND`` setting, the dotted path of a
+:class:`BaseSearchBackend` subclass. Backends are kept up to date through
+the :class:`Package` post_save and post_delete signals.
+"""
+import re
+import threading
+from bisect import bisect_left, insort
+
+from django.conf import settings
+from django.db.models import Q, Sum
+from django.utils.importlib import import_module
+
+from aur.cache import get_generation, PACKAGES_GENERATION_KEY
+from aur.models import Package, SearchTerm, bulk_insert
+
+DEFAULT_BACKEND = 'aur.search.DatabaseSearchBackend'
+
+_term_re = re.compile(r'[\w-]+', re.UNICODE)
+_word_re = re.compile(r'[^\W_]+', re.UNICODE)
+
+def tokenize(text):
+    """Split *text* into lower case search terms
+
+    Words joined by hyphens or underscores are returned both as a whole and
+    as their parts, e.g. ``'lib32-foo'`` yields ``'lib32-foo'``, ``'lib32'``
+    and ``'foo'``.
+    """
+    terms = []
+    for term in _term_re.findall(text.lower()):
+        terms.append(term[:SearchTerm.MAX_LENGTH])
+        words = _word_re.findall(term)
+        if len(words) > 1 or (words and words[0] != term):
+            terms.extend([word[:SearchTerm.MAX_LENGTH] for word in words])
+    return terms
+
+
+class BaseSearchBackend(object):
+    """Interface of search backends"""
+    # Whether search() annotates results with a relevance score
+    ranked = False
+
+    def search(self, queryset, query):
+        """Restrict *queryset* to packages matching *query*"""
+        raise NotImplementedError
+
+    def update(self, package):
+        """Add *package* to the index, or refresh its entry"""
+        pass
+
+    def remove(self, package):
+        """Remove *package* from the index"""
+        pass
+
+    def rebuild(self):
+        """Index all packages from scratch"""
+        for package in Package.objects.all():
+            self.update(package)
+
+
+class SimpleSearchBackend(BaseSearchBackend):
+    """Substring matching of names and descriptions and exact matching of
+    tags, without an index"""
+    def search(self, queryset, query):
+        results = queryset.filter(name__icontains=query)
+        results |= queryset.filter(description__icontains=query)
+        # Split query to search for each word as a tag
+        for keyword in query.split():
+            results |= queryset.filter(tags__exact=keyword)
+        return results
+
+
+class DatabaseSearchBackend(BaseSearchBackend):
+    """An inverted index of names, tags and descriptions stored in the
+    database
+
+    Terms are looked up by prefix, which the term index can satisfy, and
+    results are annotated with a ``relevance`` score: the sum of the weights
+    of the matching terms.
+    """
+    ranked = True
+    # Weight of terms found in each field
+    weights = (
+        ('name', 10),
+        ('tags', 5),
+        ('description', 1),
+    )
+
+    def get_terms(self, package):
+        """Return a dictionary mapping the terms of *package* to weights"""
+        terms = {}
+        for field, weight in self.weights:
+            value = getattr(package, field) or u''
+            if isinstance(value, (list, tuple)):
+                value = u' '.join(value)
+            for term in tokenize(value):
+                terms[term] = terms.get(term, 0) + weight
+        return terms
+
+    def search(self, queryset, query):
+        terms = tokenize(query)
+        if not terms:
+            return queryset.none()
+        condition = Q()
+        for term in set(terms):
+            condition |= Q(searchterm__term__startswith=term)
+        return queryset.filter(condition).annotate(
+                relevance=Sum('searchterm__weight'))
+
+    def update(self, package):
+        self.remove(package)
+        bulk_insert(SearchTerm, ('package', 'term', 'weight'),
+                [(package.id, term, weight) for term, weight
+                    in self.get_terms(package).items()])
+
+    def remove(self, package):
+        SearchTerm.objects.filter(package=package.id).delete()
+
+    def rebuild(self):
+        SearchTerm.objects.all().delete()
+        for package in Package.objects.all():
+            bulk_insert(SearchTerm, ('package', 'term', 'weight'),
+                    [(package.id, term, weight) for term, weight
+                        in self.get_terms(package).items()])
+
+
+class NameIndex(object):
+    """A sorted in-memory index of package names for prefix lookups
+
+    The index is loaded with a single query when first used and kept up to
+    date incrementally through the :class:`Package` signals, so lookups
+    don't touch the database.
+
+    .. note::
+
+        Every process has its own index. Like :mod:`aur.graph`, it is loaded
+        again when the packages generation of :mod:`aur.cache` changes, so
+        changes made by other processes or commands are seen as long as the
+        cache is shared between them.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys = None
+        self._versions = {}
+        self._generation = None
+
+    def _load(self):
+        # Read first, so that changes made while loading cause another load
+        self._generation = get_generation(PACKAGES_GENERATION_KEY)
+        keys = []
+        versions = {}
+        for name, version, release in Package.objects.values_list('name',
+                'version', 'release'):
+            keys.append((name.lower(), name))
+            versions[name] = u'%s-%s' % (version, release)
+        keys.sort()
+        self._keys = keys
+        self._versions = versions
+
+    def reset(self):
+        """Discard the index, it is reloaded by the next lookup"""
+        self._lock.acquire()
+        try:
+            self._keys = None
+            self._versions = {}
+        finally:
+            self._lock.release()
+
+    def update(self, package):
+        """Add *package* to the index, or update its version"""
+        self._lock.acquire()
+        try:
+            if self._keys is None:
+                return
+            if package.name not in self._versions:
+                insort(self._keys, (package.name.lower(), package.name))
+            self._versions[package.name] = u'%s-%s' % (package.version,
+                    package.release)
+        finally:
+            self._lock.release()
+
+    def remove(self, package):
+        """Remove *package* from the index"""
+        self._lock.acquire()
+        try:
+            if self._keys is None or package.name not in self._versions:
+                return
+            key = (package.name.lower(), package.name)
+            del self._keys[bisect_left(self._keys, key)]
+            del self._versions[package.name]
+        finally:
+            self._lock.release()
+
+    def suggest(self, prefix, limit):
+        """Return up to *limit* (name, version) tuples of the packages whose
+        names start with *prefix*, case insensitively, sorted by name"""
+        self._lock.acquire()
+        try:
+            if self._keys is None or self._generation != get_generation(
+                    PACKAGES_GENERATION_KEY):
+                self._load()
+            prefix = prefix.lower()
+            results = []
+            index = bisect_left(self._keys, (prefix,))
+            while len(results) < limit and index < len(self._keys):
+                key, name = self._keys[index]
+                if not key.startswith(prefix):
+                    break
+                results.append((name, self._versions[name]))
+                index += 1
+            return results
+        finally:
+            self._lock.release()
+
+name_index = NameIndex()
+
+_backend = None
+
+def get_backend():
+    """Return an instance of the configured search backend"""
+    global _backend
+    if _backend is None:
+        path = getattr(settings, 'AUR_SEARCH_BACKEND', DEFAULT_BACKEND)
+        module, name = path.rsplit('.', 1)
+        _backend = getattr(import_module(module), name)()
+    return _backend
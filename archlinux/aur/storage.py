@@ -0,0 +1,65 @@
+"""Content addressed file storage
+
+Files are stored under the SHA-256 hash of their contents, so a file which
+is uploaded again, whether by an update of the same package or by another
+package, isn't written a second time and only takes space once.
+
+Several database rows can therefore share a stored file. Files are removed
+with :func:`aur.models.release_file` and :func:`aur.models.release_files`,
+which only delete them once nothing refers to them anymore.
+"""
+import errno
+import hashlib
+import os
+import sys
+
+from django.core.files.storage import FileSystemStorage
+
+class ContentAddressedStorage(FileSystemStorage):
+    """Stores files as ``blobs/<ab>/<hash>/<basename>``, where ``<hash>`` is
+    the SHA-256 hash of the contents and ``<ab>`` its first two characters
+
+    The base name of the requested name is kept, so that files are still
+    downloaded under their own name.
+    """
+    prefix = 'blobs'
+
+    def get_content_name(self, name, content):
+        """Return the name *content* is stored under
+
+        The hash is taken from the ``content_hash`` attribute of *content* if
+        it was already computed, e.g. while the upload was validated.
+        """
+        hash = getattr(content, 'content_hash', None)
+        if hash is None:
+            digest = hashlib.sha256()
+            content.seek(0)
+            for chunk in content.chunks():
+                digest.update(chunk)
+            content.seek(0)
+            hash = digest.hexdigest()
+        return os.path.join(self.prefix, hash[:2], hash,
+                os.path.basename(name))
+
+    def get_available_name(self, name):
+        # Names are derived from the contents in _save(), and an existing
+        # file with the same name has the same contents.
+        # FileSystemStorage._save() asks for another name when the file was
+        # created meanwhile, by a concurrent upload of the same contents,
+        # and would retry forever, so it's stopped in that case.
+        if name.startswith(self.prefix + os.sep) and self.exists(name):
+            raise OSError(errno.EEXIST, os.strerror(errno.EEXIST), name)
+        return name
+
+    def _save(self, name, content):
+        name = self.get_content_name(name, content)
+        if self.exists(name):
+            return name
+        try:
+            return super(ContentAddressedStorage, self)._save(name, content)
+        except OSError:
+            if sys.exc_info()[1].errno != errno.EEXIST:
+                raise
+            return name
+
+content_storage = ContentAddressedStorage()
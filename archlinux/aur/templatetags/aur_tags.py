@@ -1,7 +1,7 @@
 from django.template import Library
 from django.template.defaultfilters import stringfilter
 from django.contrib.auth.models import User
-from aur.models import Package, PackageNotification, Vote
+from aur.models import Package, get_user_package_ids
 import re
 
 register = Library()
@@ -10,16 +10,13 @@ register = Library()
 def has_update_notification(user, package):
     if not isinstance(user, User):
         return False
-    total = PackageNotification.objects.filter(user=user,
-        package=package).count()
-    return total != 0
+    return package.id in get_user_package_ids(user)['subscribed']
 
 @register.filter
 def has_vote(user, package):
     if not isinstance(user, User):
         return False
-    total = Vote.objects.filter(user=user, package=package).count()
-    return total != 0
+    return package.id in get_user_package_ids(user)['voted']
 
 @register.filter
 @stringfilter
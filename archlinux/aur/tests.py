@@ -1,16 +1,100 @@
 from datetime import datetime
+import hashlib
+import os
+import shutil
+import tarfile
+import tempfile
+from StringIO import StringIO
+from django import forms
+from django.conf import settings
+from django.db import connection
 from django.test import TestCase
 from django.core.urlresolvers import reverse
 from django.contrib.auth.models import User
 from django.core import mail
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
 from django.template import Template, Context
+from django.utils import simplejson
+
+import aur.Package as PKGBUILD
+from aur.cache import get_generation, invalidate_packages
+from aur.forms import PackageSearchForm, PackageField, store_package, \
+        get_package_errors
+from aur.graph import dependency_graph
+from aur.repodb import update_database
+from aur.search import name_index
+from aur.models import Package, PackageNotification, Vote, Repository, \
+        Comment, NotificationPreference, QueuedNotification
+
+def count_queries(function, *args, **kwargs):
+    """Call *function* and return the number of database queries it ran"""
+    debug = settings.DEBUG
+    settings.DEBUG = True
+    connection.queries = []
+    try:
+        function(*args, **kwargs)
+        return len(connection.queries)
+    finally:
+        settings.DEBUG = debug
+
+def make_tarball(directory, name, sources=0, depends=(), provides=()):
+    """Create a tarball of a valid package with *sources* local sources in
+    *directory* and return its path"""
+    filename = os.path.join(directory, '%s.tar.gz' % name)
+    tar = tarfile.open(filename, 'w:gz')
+    source_names = ['source%d.patch' % i for i in range(sources)]
+    sums = {'md5': [], 'sha1': [], 'sha256': []}
+    for source_name in source_names:
+        contents = 'source %s\n' % source_name
+        info = tarfile.TarInfo('%s/%s' % (name, source_name))
+        info.size = len(contents)
+        tar.addfile(info, StringIO(contents))
+        for hash_type in sums:
+            sums[hash_type].append(hashlib.new(hash_type,
+                contents).hexdigest())
+    pkgbuild = '\n'.join([
+        'pkgname=%s' % name,
+        'pkgver=1.0',
+        'pkgrel=1',
+        'pkgdesc="Test package"',
+        "arch=('i686' 'x86_64')",
+        "license=('GPL' 'LGPL')",
+        'depends=(%s)' % ' '.join(["'%s'" % depend for depend in depends]),
+        'provides=(%s)' % ' '.join(["'%s'" % provision
+            for provision in provides]),
+        'source=(%s)' % ' '.join(source_names),
+        'md5sums=(%s)' % ' '.join(sums['md5']),
+        'sha1sums=(%s)' % ' '.join(sums['sha1']),
+        'sha256sums=(%s)' % ' '.join(sums['sha256']),
+    ]) + '\n'
+    info = tarfile.TarInfo('%s/PKGBUILD' % name)
+    info.size = len(pkgbuild)
+    tar.addfile(info, StringIO(pkgbuild))
+    tar.close()
+    return filename
 
-from aur.forms import PackageSearchForm
-from aur.models import Package, PackageNotification, Vote
 
 class AurTestCase(TestCase):
     fixtures = ['test/users', 'test/packages']
 
+    # Cached responses would hide the queries of views, and notifications
+    # should be sent right away
+    settings_overrides = {
+        'AUR_CACHE_POLICIES': {},
+        'AUR_NOTIFICATION_WINDOW': 0,
+    }
+
+    def setUp(self):
+        self.original_settings = {}
+        for name, value in self.settings_overrides.items():
+            self.original_settings[name] = getattr(settings, name, None)
+            setattr(settings, name, value)
+
+    def tearDown(self):
+        for name, value in self.original_settings.items():
+            setattr(settings, name, value)
+
 
 class AurViewTests(AurTestCase):
     def test_index_view(self):
@@ -29,10 +113,159 @@ class AurViewTests(AurTestCase):
             'slug': 'unique_package',
         }))
 
+    def test_search_view_queries(self):
+        data = {'limit': 50}
+        one = count_queries(self.client.get, reverse('aur-search'), data)
+        repository = Repository.objects.get(pk=1)
+        user = User.objects.get(username='normal_user')
+        for i in range(30):
+            package = Package(name='package%d' % i, version='1', release=1,
+                    description='Package %d' % i, repository=repository)
+            package.save()
+            package.maintainers.add(user)
+        many = count_queries(self.client.get, reverse('aur-search'), data)
+        self.assertEquals(one, many)
+
+    def test_search_view_pagination(self):
+        repository = Repository.objects.get(pk=1)
+        for i in range(30):
+            Package(name='paged%02d' % i, version='1', release=1,
+                    description='Paged package', repository=repository).save()
+        data = {'query': 'paged', 'searchby': 'name', 'limit': 25,
+                'sortby': 'name'}
+        names = []
+        cursor = None
+        while True:
+            if cursor:
+                data['cursor'] = cursor
+            response = self.client.get(reverse('aur-search'), data)
+            page = response.context['page']
+            names.extend([package.name for package in page.object_list])
+            if not page.has_next():
+                break
+            cursor = page.next_cursor
+        self.assertEqual(names, ['paged%02d' % i for i in range(30)])
+        # Going back from the last page returns the previous one
+        data['cursor'] = page.previous_cursor
+        response = self.client.get(reverse('aur-search'), data)
+        self.assertEqual([p.name for p in response.context['page'].object_list],
+                ['paged%02d' % i for i in range(25)])
+        # Deep pages take as many queries as the first
+        del data['cursor']
+        first = count_queries(self.client.get, reverse('aur-search'), data)
+        data['cursor'] = cursor
+        last = count_queries(self.client.get, reverse('aur-search'), data)
+        self.assertEqual(first, last)
+
+    def test_cached_views(self):
+        settings.AUR_CACHE_POLICIES = {'search': 60, 'package_detail': 60}
+        search_url = reverse('aur-search')
+        detail_url = reverse('aur-package_detail', kwargs={
+            'slug': 'unique_package'})
+        self.client.get(search_url)
+        self.client.get(detail_url)
+        self.assertEquals(count_queries(self.client.get, search_url), 0)
+        # Only the ETag is queried
+        self.assertEquals(count_queries(self.client.get, detail_url), 1)
+        # Comments invalidate the cache
+        package = Package.objects.get(name='unique_package')
+        Comment(package=package, user=User.objects.get(
+            username='normal_user'), message='Cached comment',
+            ip='127.0.0.1').save()
+        self.assertContains(self.client.get(detail_url), 'Cached comment')
+        # Logged in users aren't served from the cache
+        self.client.login(username='normal_user', password='normal_user')
+        self.assertNotEquals(count_queries(self.client.get, search_url), 0)
+        # Changes are invalidated again once committed, as responses cached
+        # by concurrent requests in the meantime are from before the commit
+        generation = get_generation()
+        self.client.get(reverse('aur-vote', kwargs={'slug': package.slug}))
+        self.assertEquals(get_generation(), generation + 2)
+        self.client.logout()
+
+    def test_manage_packages_view(self):
+        user = User.objects.get(username='normal_user')
+        repository = Repository.objects.get(pk=1)
+        names = []
+        for i in range(5):
+            package = Package(name='managed%d' % i, version='1', release=1,
+                    description='Managed %d' % i, repository=repository)
+            package.save()
+            package.maintainers.add(user)
+            names.append(package.name)
+        self.client.login(username='normal_user', password='normal_user')
+        url = reverse('aur-manage_packages')
+        response = self.client.post(url, {'packages': names,
+            'action': 'flag-ood'}, HTTP_REFERER='/')
+        self.assertEqual(response.status_code, 302)
+        self.assertEquals(Package.objects.filter(name__in=names,
+            outdated=True).count(), 5)
+        # The number of queries doesn't depend on the number of packages
+        one = count_queries(self.client.post, url, {'packages': names[:1],
+            'action': 'unflag-ood'}, HTTP_REFERER='/')
+        many = count_queries(self.client.post, url, {'packages': names[1:],
+            'action': 'unflag-ood'}, HTTP_REFERER='/')
+        self.assertEquals(one, many)
+        self.assertEquals(Package.objects.filter(name__in=names,
+            outdated=True).count(), 0)
+        # Nothing is changed if any package may not be changed
+        Package.objects.get(name='managed0').maintainers.clear()
+        response = self.client.post(url, {'packages': names,
+            'action': 'disown'}, HTTP_REFERER='/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEquals(Package.objects.filter(name__in=names,
+            maintainers=user).count(), 4)
+        response = self.client.post(url, {'packages': names[:1],
+            'action': 'adopt'}, HTTP_REFERER='/')
+        self.assertEquals(Package.objects.filter(name__in=names,
+            maintainers=user).count(), 5)
+        self.client.logout()
+
+    def test_logged_in_view_queries(self):
+        user = User.objects.get(username='normal_user')
+        self.client.login(username='normal_user', password='normal_user')
+        url = reverse('aur-package_detail', kwargs={'slug': 'unique_package'})
+        one = count_queries(self.client.get, url)
+        repository = Repository.objects.get(pk=1)
+        for i in range(10):
+            package = Package(name='voted%d' % i, version='1', release=1,
+                    description='Voted %d' % i, repository=repository)
+            package.save()
+            package.maintainers.add(user)
+            Vote(package=package, user=user).save()
+            PackageNotification(package=package, user=user).save()
+        package = Package.objects.get(name='unique_package')
+        Vote(package=package, user=user).save()
+        PackageNotification(package=package, user=user).save()
+        response = self.client.get(url)
+        self.assertTrue(response.context['has_vote'])
+        self.assertTrue(response.context['has_update_notification'])
+        self.assertEquals(count_queries(self.client.get, url), one)
+        self.client.logout()
+
     def test_submit_view(self):
         self.client.login(username='normal_user', password='normal_user')
         response = self.client.get(reverse('aur-submit_package'))
         self.assertEqual(response.status_code, 200)
+        # Oversized uploads are rejected while they are received
+        directory = tempfile.mkdtemp()
+        max_size = getattr(settings, 'AUR_MAX_UPLOAD_SIZE', None)
+        settings.AUR_MAX_UPLOAD_SIZE = 100
+        try:
+            filename = os.path.join(directory, 'PKGBUILD')
+            fp = open(filename, 'w')
+            fp.write('#' * 200)
+            fp.close()
+            fp = open(filename)
+            try:
+                response = self.client.post(reverse('aur-submit_package'),
+                        {'repository': 'unsupported', 'package': fp})
+            finally:
+                fp.close()
+        finally:
+            settings.AUR_MAX_UPLOAD_SIZE = max_size
+            shutil.rmtree(directory)
+        self.assertContains(response, 'Upload too large')
         self.client.logout()
 
     def test_package_view(self):
@@ -46,6 +279,60 @@ class AurViewTests(AurTestCase):
         }))
         self.assertEqual(response.status_code, 404)
 
+    def test_package_view_conditional(self):
+        url = reverse('aur-package_detail', kwargs={'slug': 'unique_package'})
+        response = self.client.get(url)
+        etag = response['ETag']
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEquals(count_queries(self.client.get, url,
+            HTTP_IF_NONE_MATCH=etag), 1)
+        # A new vote changes the page
+        package = Package.objects.get(name='unique_package')
+        Vote(package=package,
+                user=User.objects.get(username='normal_user')).save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        # Pages of logged in users aren't conditional
+        self.client.login(username='normal_user', password='normal_user')
+        response = self.client.get(url)
+        self.assertFalse(response.has_header('ETag'))
+        self.client.logout()
+
+    def test_package_view_conditional_relations(self):
+        user = User.objects.get(username='normal_user')
+        package = Package(name='watched', version='1', release=1,
+                description='Watched', repository=Repository.objects.get(
+                    pk=1))
+        package.save()
+        package.maintainers.add(user)
+        url = reverse('aur-package_detail', kwargs={'slug': 'watched'})
+        etag = self.client.get(url)['ETag']
+        # Changing the maintainers doesn't save the package, but changes
+        # the page
+        self.client.login(username='normal_user', password='normal_user')
+        self.client.post(reverse('aur-manage_packages'), {
+            'packages': ['watched'], 'action': 'disown'}, HTTP_REFERER='/')
+        self.client.logout()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_package_view_queries(self):
+        url = reverse('aur-package_detail', kwargs={'slug': 'unique_package'})
+        before = count_queries(self.client.get, url)
+        package = Package.objects.get(name='unique_package')
+        user = User.objects.get(username='normal_user')
+        for i in range(10):
+            dependency = Package(name='dependency%d' % i, version='1',
+                    release=1, description='Dependency %d' % i,
+                    repository=package.repository)
+            dependency.save()
+            package.depends.add(dependency)
+            Comment(package=package, user=user, message='Comment %d' % i,
+                    ip='127.0.0.1').save()
+        after = count_queries(self.client.get, url)
+        self.assertEquals(before, after)
+
     def test_vote_view(self):
         user = User.objects.get(username='normal_user')
         package = Package.objects.get(name='unique_package')
@@ -106,7 +393,199 @@ class AurAPITests(AurTestCase):
         self.assertEqual(response.status_code, 404)
 
 
+    def test_suggest_view(self):
+        name_index.reset()
+        url = reverse('aur-api_suggest', kwargs={'query': 'UNIQUE'})
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEquals(simplejson.loads(response.content), [
+            {'name': 'unique_package', 'version': '1-1'}])
+        # The index is reloaded once packages change, which may happen in
+        # other processes, and lookups don't query the database otherwise
+        repository = Repository.objects.get(pk=1)
+        for i in range(3):
+            Package(name='unique%d' % i, version='2', release=1,
+                    description='Unique %d' % i, repository=repository).save()
+        self.assertEquals(count_queries(self.client.get, url,
+            {'limit': 2}), 1)
+        self.assertEquals(count_queries(self.client.get, url,
+            {'limit': 2}), 0)
+        response = self.client.get(url, {'limit': 2})
+        self.assertEquals([entry['name'] for entry in
+            simplejson.loads(response.content)], ['unique0', 'unique1'])
+        Package.objects.get(name='unique0').delete()
+        response = self.client.get(url, {'limit': 2})
+        self.assertEquals([entry['name'] for entry in
+            simplejson.loads(response.content)], ['unique1', 'unique2'])
+
+
+    def test_export_view(self):
+        url = reverse('aur-api_export')
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        # The packages are read while the response is iterated, after the
+        # request
+        self.failUnless(count_queries(lambda: response.content))
+        response = self.client.get(url)
+        packages = simplejson.loads(response.content)
+        self.assertEquals([package['name'] for package in packages],
+                list(Package.objects.order_by('id').values_list('name',
+                    flat=True)))
+        # Related objects are loaded per chunk, not per package
+        one = count_queries(self.client.get, url)
+        repository = Repository.objects.get(pk=1)
+        user = User.objects.get(username='normal_user')
+        for i in range(10):
+            package = Package(name='export%d' % i, version='1', release=1,
+                    description='Export %d' % i, repository=repository)
+            package.save()
+            package.maintainers.add(user)
+        many = count_queries(self.client.get, url)
+        self.assertEquals(one, many)
+        packages = simplejson.loads(self.client.get(url).content)
+        self.assertEquals(packages[-1]['maintainers'], ['normal_user'])
+
+    def test_package_api_queries(self):
+        detail = '/api/package/unique_package'
+        listing = '/api/packages'
+        # The site domain is only queried by the first request
+        self.client.get(detail)
+        one_detail = count_queries(self.client.get, detail)
+        one_listing = count_queries(self.client.get, listing)
+        repository = Repository.objects.get(pk=1)
+        user = User.objects.get(username='normal_user')
+        package = Package.objects.get(name='unique_package')
+        for i in range(10):
+            other = Package(name='api%d' % i, version='1', release=1,
+                    description='API %d' % i, repository=repository)
+            other.save()
+            other.maintainers.add(user)
+            package.depends.add(other)
+        self.assertEquals(count_queries(self.client.get, detail), one_detail)
+        self.assertEquals(count_queries(self.client.get, listing),
+                one_listing)
+        data = simplejson.loads(self.client.get(detail).content)
+        self.assertEquals(data['depends'], ['api%d' % i for i in range(10)])
+
+    def test_package_api_conditional(self):
+        url = '/api/package/unique_package'
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertEquals(count_queries(self.client.get, url,
+            HTTP_IF_NONE_MATCH=etag,
+            HTTP_IF_MODIFIED_SINCE=response['Last-Modified']), 1)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        # The listing is validated without querying the packages
+        url = '/api/packages'
+        etag = self.client.get(url)['ETag']
+        self.assertEquals(count_queries(self.client.get, url,
+            HTTP_IF_NONE_MATCH=etag), 0)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        Package.objects.get(name='unique_package').save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_package_batch_api(self):
+        url = '/api/packages/info'
+        response = self.client.get(url, {'names': 'unique_package,missing'})
+        self.assertEqual(response.status_code, 200)
+        packages = simplejson.loads(response.content)
+        self.assertEquals([package['name'] for package in packages],
+                ['unique_package'])
+        response = self.client.get(url, {'name': ['unique_package',
+            'missing'], 'versions': 1})
+        self.assertEquals(simplejson.loads(response.content),
+                {'unique_package': '1-1'})
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 400)
+        # Looking up more packages takes no more queries
+        one = count_queries(self.client.get, url, {'name': 'unique_package'})
+        repository = Repository.objects.get(pk=1)
+        names = ['unique_package']
+        for i in range(10):
+            Package(name='batch%d' % i, version='1', release=1,
+                    description='Batch %d' % i, repository=repository).save()
+            names.append('batch%d' % i)
+        self.assertEquals(count_queries(self.client.get, url,
+            {'name': names}), one)
+
+    def test_dependencies_view(self):
+        dependency_graph.reset()
+        repository = Repository.objects.get(pk=1)
+        packages = {}
+        for name in ('app', 'lib', 'base', 'tool'):
+            packages[name] = Package(name=name, version='1', release=1,
+                    description=name, repository=repository)
+            packages[name].save()
+        packages['app'].depends.add(packages['lib'])
+        packages['app'].make_depends.add(packages['tool'])
+        packages['lib'].depends.add(packages['base'])
+        url = reverse('aur-api_dependencies', kwargs={'name': 'app'})
+        data = simplejson.loads(self.client.get(url).content)
+        self.assertEquals(data['all_depends'], ['base', 'lib', 'tool'])
+        self.assertEquals(data['build_order'], ['base', 'lib', 'tool', 'app'])
+        self.assertEquals(data['cycles'], [])
+        url = reverse('aur-api_dependencies', kwargs={'name': 'base'})
+        data = simplejson.loads(self.client.get(url).content)
+        self.assertEquals(data['all_required_by'], ['app', 'lib'])
+        # Cycles are reported after the graph is updated
+        packages['base'].depends.add(packages['app'])
+        dependency_graph.update(packages['base'])
+        self.assertEquals(count_queries(self.client.get, url), 0)
+        data = simplejson.loads(self.client.get(url).content)
+        self.assertEquals(data['cycles'], [['base', 'app', 'lib']])
+        url = reverse('aur-api_dependencies', kwargs={'name': 'missing'})
+        self.assertEquals(self.client.get(url).status_code, 404)
+        # Dependencies the graph hasn't seen yet, e.g. created by another
+        # process, are loaded when a package relating to them is updated
+        other = Package(name='other', version='1', release=1,
+                description='other', repository=repository)
+        other.save()
+        packages['tool'].depends.add(other)
+        dependency_graph.update(packages['tool'])
+        url = reverse('aur-api_dependencies', kwargs={'name': 'tool'})
+        data = simplejson.loads(self.client.get(url).content)
+        self.assertEquals(data['build_order'], ['other', 'tool'])
+        # Relations changed by other processes are loaded once they
+        # invalidate the packages
+        packages['lib'].depends.add(packages['tool'])
+        invalidate_packages()
+        data = simplejson.loads(self.client.get(url).content)
+        self.assertEquals(data['required_by'], ['app', 'base', 'lib'])
+
 class AurModelTests(AurTestCase):
+    def test_vote_count(self):
+        user = User.objects.get(username='normal_user')
+        package = Package.objects.get(name='unique_package')
+        vote = Vote(package=package, user=user)
+        vote.save()
+        self.assertEquals(Package.objects.get(id=package.id).vote_count, 1)
+        vote.delete()
+        self.assertEquals(Package.objects.get(id=package.id).vote_count, 0)
+
+    def test_vote_count_with_api_loaded(self):
+        # Resolving URLs imports the API modules, which must not register
+        # the signal handlers of aur.models a second time
+        reverse('aur-api_export')
+        user = User.objects.get(username='normal_user')
+        package = Package.objects.get(name='unique_package')
+        Vote(package=package, user=user).save()
+        self.assertEquals(Package.objects.get(id=package.id).vote_count, 1)
+
+    def test_comment_count(self):
+        user = User.objects.get(username='normal_user')
+        package = Package.objects.get(name='unique_package')
+        comment = Comment(package=package, user=user, message='Comment',
+                ip='127.0.0.1')
+        comment.save()
+        self.assertEquals(Package.objects.get(id=package.id).comment_count, 1)
+        comment.hidden = True
+        comment.save()
+        self.assertEquals(Package.objects.get(id=package.id).comment_count, 0)
+
     def test_update_notification(self):
         user = User.objects.get(username='normal_user')
         package = Package.objects.get(name='unique_package')
@@ -114,19 +593,141 @@ class AurModelTests(AurTestCase):
         # Update version and save
         package.version = unicode(float(package.version) + 1)
         package.save()
+        # Mail is queued, not sent while saving
+        self.assertEquals(len(mail.outbox), 0)
+        self.assertEquals(QueuedNotification.objects.count(), 1)
+        call_command('sendnotifications')
         # Check that the mail was sent out
         self.assertEquals(len(mail.outbox), 1)
+        self.assertEquals(mail.outbox[0].to, [user.email])
+        self.assertEquals(QueuedNotification.objects.count(), 0)
+
+    def test_coalesced_notifications(self):
+        user = User.objects.get(username='normal_user')
+        package = Package.objects.get(name='unique_package')
+        PackageNotification(package=package, user=user).save()
+        settings.AUR_NOTIFICATION_WINDOW = 60
+        package.outdated = True
+        package.save()
+        package.outdated = False
+        package.version = '2'
+        package.save()
+        self.assertEquals(QueuedNotification.objects.count(), 1)
+        self.assertEquals(QueuedNotification.objects.get().package_version,
+                '2')
+        # Not sent before the window has passed
+        call_command('sendnotifications')
+        self.assertEquals(len(mail.outbox), 0)
+
+    def test_digest_notifications(self):
+        user = User.objects.get(username='normal_user')
+        NotificationPreference(user=user,
+                delivery=NotificationPreference.DAILY).save()
+        repository = Repository.objects.get(pk=1)
+        for i in range(3):
+            package = Package(name='digest%d' % i, version='1', release=1,
+                    description='Digest %d' % i, repository=repository)
+            package.save()
+            PackageNotification(package=package, user=user).save()
+            package.save()
+            package.save()
+        self.assertEquals(QueuedNotification.objects.count(), 3)
+        call_command('sendnotifications')
+        self.assertEquals(len(mail.outbox), 0)
+        call_command('sendnotifications', digest='daily')
+        self.assertEquals(len(mail.outbox), 1)
+        self.assertTrue('digest2-1-1' in mail.outbox[0].body)
+        self.assertEquals(QueuedNotification.objects.count(), 0)
+
+    def test_exhausted_notifications(self):
+        user = User.objects.get(username='normal_user')
+        package = Package.objects.get(name='unique_package')
+        PackageNotification(package=package, user=user).save()
+        package.save()
+        self.assertEquals(QueuedNotification.objects.update(attempts=5,
+            last_error='refused'), 1)
+        # Notifications which failed too often are dropped, not sent
+        call_command('sendnotifications', max_attempts=5)
+        self.assertEquals(len(mail.outbox), 0)
+        self.assertEquals(QueuedNotification.objects.count(), 0)
 
     def test_delete_notification(self):
         user = User.objects.get(username='normal_user')
         package = Package.objects.get(name='unique_package')
         PackageNotification(package=package, user=user).save()
         package.delete()
+        call_command('sendnotifications')
         # Check that the mail was sent out
         # FIXME: This currently fails because tarball doesn't actually exist,
         # and its removal is attempted
         self.assertEquals(len(mail.outbox), 1)
 
+class AurCommandTests(AurTestCase):
+    def test_recountpackages(self):
+        package = Package.objects.get(name='unique_package')
+        user = User.objects.get(username='normal_user')
+        Vote(package=package, user=user).save()
+        Comment(package=package, user=user, message='Visible',
+                ip='127.0.0.1').save()
+        Comment(package=package, user=user, message='Hidden',
+                ip='127.0.0.1', hidden=True).save()
+        Package.objects.update(vote_count=10, comment_count=10)
+        call_command('recountpackages')
+        package = Package.objects.get(name='unique_package')
+        self.assertEquals(package.vote_count, 1)
+        self.assertEquals(package.comment_count, 1)
+
+    def test_importpackages(self):
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'PKGBUILD')
+            fp = open(filename, 'w')
+            fp.write(PKGBUILDTests.pkgbuild)
+            fp.close()
+            tar = tarfile.open(os.path.join(directory, 'parser_test.tar.gz'),
+                    'w:gz')
+            tar.add(filename, 'parser_test/PKGBUILD')
+            # The PKGBUILD declares the checksums of an empty patch
+            tar.addfile(tarfile.TarInfo('parser_test/fix.patch'))
+            tar.close()
+            os.remove(filename)
+            call_command('importpackages', directory, processes=1,
+                    batch_size=10, repository='unsupported',
+                    maintainer='normal_user')
+        finally:
+            shutil.rmtree(directory)
+        package = Package.objects.get(name='parser_test')
+        self.assertEquals(package.maintainers.all()[0].username,
+                'normal_user')
+        package.delete()
+
+    def test_repository_database(self):
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'aur.db.tar.gz')
+            count = Package.objects.filter(deleted=False).count()
+            self.assertEquals(update_database(filename), (count, 0))
+            tar = tarfile.open(filename)
+            desc = tar.extractfile('unique_package-%s-%s/desc' %
+                    Package.objects.filter(name='unique_package').values_list(
+                        'version', 'release')[0]).read()
+            tar.close()
+            self.assertTrue('%NAME%\nunique_package\n' in desc)
+            # Only changed packages are written again
+            self.assertEquals(update_database(filename), (0, 0))
+            package = Package.objects.get(name='unique_package')
+            package.version = '2.0'
+            package.save()
+            self.assertEquals(update_database(filename), (1, 0))
+            package.delete()
+            self.assertEquals(update_database(filename), (0, 1))
+            tar = tarfile.open(filename)
+            self.assertEquals(len(tar.getnames()), (count - 1) * 2)
+            tar.close()
+        finally:
+            shutil.rmtree(directory)
+
+
 class AurFormTests(AurTestCase):
     def test_search_form(self):
         form = PackageSearchForm(data={
@@ -137,6 +738,190 @@ class AurFormTests(AurTestCase):
         self.assertEquals(results.count(), 1)
         self.assertEquals(results[0].name, 'unique_package')
 
+    def test_search_relevance(self):
+        repository = Repository.objects.get(pk=1)
+        Package(name='libfoo', version='1', release=1,
+                description='Library used by bar',
+                repository=repository).save()
+        Package(name='bar', version='1', release=1,
+                description='Uses libfoo', repository=repository).save()
+        form = PackageSearchForm(data={'query': 'bar'})
+        self.failUnless(form.is_valid())
+        results = form.search()
+        self.failUnless(form.ranked)
+        self.assertEquals([package.name for package in
+            results.order_by('-relevance')], ['bar', 'libfoo'])
+        # The index is updated when packages change
+        package = Package.objects.get(name='bar')
+        package.description = 'Something else'
+        package.save()
+        self.assertEquals(PackageSearchForm(data={'query': 'libfoo'}
+            ).search().count(), 1)
+        package.delete()
+        self.assertEquals(PackageSearchForm(data={'query': 'bar'}
+            ).search().count(), 1)
+
+    def test_store_package_queries(self):
+        repository = Repository.objects.get(pk=1)
+        user = User.objects.get(username='normal_user')
+        directory = tempfile.mkdtemp()
+        try:
+            packages = []
+            for name, sources, depends in (
+                    ('small', 1, ['unique_package']),
+                    ('large', 40, ['unique_package', 'small', 'missing'])):
+                filename = make_tarball(directory, name, sources, depends)
+                pkg = PKGBUILD.Package(filename)
+                pkg['filename'] = filename
+                packages.append(pkg)
+            small, large = packages
+            # Creating and updating shouldn't depend on the number of files
+            # or relations
+            created = [count_queries(store_package, pkg, repository, user)
+                    for pkg in packages]
+            updated = [count_queries(store_package, pkg, repository, user)
+                    for pkg in packages]
+        finally:
+            shutil.rmtree(directory)
+        self.assertEquals(created[0], created[1])
+        self.assertEquals(updated[0], updated[1])
+        package = Package.objects.get(name='large')
+        self.assertEquals(package.packagefile_set.count(), 41)
+        self.assertEquals(package.depends.count(), 2)
+        self.assertEquals(package.licenses.count(), 2)
+        for package in Package.objects.filter(name__in=['small', 'large']):
+            package.delete()
+
+
+    def test_shared_files(self):
+        repository = Repository.objects.get(pk=1)
+        directory = tempfile.mkdtemp()
+        try:
+            for name in ('first', 'second'):
+                filename = make_tarball(directory, name, 1)
+                pkg = PKGBUILD.Package(filename)
+                pkg['filename'] = filename
+                store_package(pkg, repository)
+            # Both packages have a source0.patch with the same contents
+            first, second = [Package.objects.get(name=name).packagefile_set.get(
+                filename__endswith='source0.patch') for name in ('first',
+                    'second')]
+            self.assertEquals(first.filename.name, second.filename.name)
+            path = first.filename.path
+            # Updating with the same file doesn't write it again
+            mtime = os.stat(path).st_mtime
+            store_package(pkg, repository)
+            self.assertEquals(os.stat(path).st_mtime, mtime)
+        finally:
+            shutil.rmtree(directory)
+        # The file is only removed with the last package using it
+        Package.objects.get(name='first').delete()
+        self.assertTrue(os.path.exists(path))
+        Package.objects.get(name='second').delete()
+        self.assertFalse(os.path.exists(path))
+        # Also when the packages sharing it are deleted at once
+        directory = tempfile.mkdtemp()
+        try:
+            for name in ('first', 'second'):
+                filename = make_tarball(directory, name, 1)
+                pkg = PKGBUILD.Package(filename)
+                pkg['filename'] = filename
+                store_package(pkg, repository)
+        finally:
+            shutil.rmtree(directory)
+        self.assertTrue(os.path.exists(path))
+        Package.objects.filter(name__in=['first', 'second']).delete()
+        self.assertFalse(os.path.exists(path))
+
+    def test_package_upload(self):
+        directory = tempfile.mkdtemp()
+        try:
+            fp = open(make_tarball(directory, 'upload', 2), 'rb')
+            data = fp.read()
+            fp.close()
+        finally:
+            shutil.rmtree(directory)
+        field = PackageField()
+        pkg = field.clean(SimpleUploadedFile('upload.tar.gz', data))
+        self.failUnless(pkg.is_tarball())
+        self.assertEquals(pkg.get_file('source1.patch'),
+                'source source1.patch\n')
+        self.assertEquals(pkg['upload'].content_hash,
+                hashlib.sha256(data).hexdigest())
+        # Files which aren't packages and oversized uploads are rejected
+        self.assertRaises(forms.ValidationError, field.clean,
+                SimpleUploadedFile('upload.tar.gz', 'not a tarball' * 100))
+        max_size = getattr(settings, 'AUR_MAX_UPLOAD_SIZE', None)
+        settings.AUR_MAX_UPLOAD_SIZE = len(data) - 1
+        try:
+            self.assertRaises(forms.ValidationError, field.clean,
+                    SimpleUploadedFile('upload.tar.gz', data))
+        finally:
+            settings.AUR_MAX_UPLOAD_SIZE = max_size
+        # PKGBUILDs read from other streams are limited too
+        stream = StringIO('#' * 1000)
+        stream.name = 'PKGBUILD'
+        self.assertRaises(PKGBUILD.InvalidPackage, PKGBUILD.Package, stream,
+                max_size=999)
+
+    def test_source_hashes(self):
+        repository = Repository.objects.get(pk=1)
+        directory = tempfile.mkdtemp()
+        try:
+            filename = make_tarball(directory, 'hashed', 1)
+            pkg = PKGBUILD.Package(filename)
+            pkg['filename'] = filename
+            self.assertEquals(get_package_errors(pkg), [])
+            store_package(pkg, repository)
+            # Declared checksums have to match the local sources
+            pkg['sha1sums'] = ['0' * 40]
+            self.assertEquals(get_package_errors(pkg),
+                    ['sha1sum of "source0.patch" does not match'])
+            pkg['sha1sums'] = []
+            pkg['sha384sums'] = ['0' * 96]
+            self.assertEquals(get_package_errors(pkg),
+                    ['sha384sum of "source0.patch" does not match'])
+        finally:
+            shutil.rmtree(directory)
+        contents = 'source source0.patch\n'
+        source = Package.objects.get(name='hashed').packagefile_set.get(
+                filename__endswith='source0.patch')
+        self.assertEquals(dict(source.packagehash_set.values_list('type',
+            'hash')), dict([(hash_type, hashlib.new(hash_type,
+                contents).hexdigest()) for hash_type in PKGBUILD.HASH_TYPES]))
+
+    def test_dependency_specs(self):
+        repository = Repository.objects.get(pk=1)
+        directory = tempfile.mkdtemp()
+        try:
+            for name, depends, provides in (
+                    ('app', ['lib>=1.0', 'virtual=2', 'old<1'], []),
+                    ('lib', [], []),
+                    ('impl', [], ['virtual=2']),
+                    ('old', [], [])):
+                filename = make_tarball(directory, name, depends=depends,
+                        provides=provides)
+                pkg = PKGBUILD.Package(filename)
+                pkg['filename'] = filename
+                package = store_package(pkg, repository)
+                if name == 'app':
+                    # Nothing satisfies the dependencies yet
+                    self.assertEquals(package.depends.count(), 0)
+        finally:
+            shutil.rmtree(directory)
+        app = Package.objects.get(name='app')
+        self.assertEquals(app.dependency_specs.count(), 3)
+        # Dependencies are related as the packages satisfying them appear
+        self.assertEquals(sorted([package.name for package
+            in app.depends.all()]), ['impl', 'lib'])
+        self.assertEquals(app.dependency_specs.get(name='old').target, None)
+        # Deleting a dependency leaves its spec unresolved
+        Package.objects.filter(name='lib').delete()
+        spec = app.dependency_specs.get(name='lib')
+        self.assertEquals((spec.operator, spec.version, spec.target),
+                ('>=', '1.0', None))
+        self.assertEquals([package.name for package in app.depends.all()],
+                ['impl'])
 
 class AurTemplateTagTests(AurTestCase):
     def test_has_update_notification(self):
@@ -177,3 +962,87 @@ class AurTemplateTagTests(AurTestCase):
         Vote(package=package, user=user).save()
         self.assertEquals(template.render(context).strip(), "True")
 
+
+class PKGBUILDTests(TestCase):
+    pkgbuild = r"""
+# Maintainer: Someone <someone@example.com>
+pkgname=parser_test
+_realname=parser-test
+pkgver=1.0
+pkgrel=2
+pkgdesc="A \"quoted\" description of $pkgname"
+arch=('i686' 'x86_64')
+url="http://example.com/${_realname}"
+license=('GPL')
+depends=('glibc' "bash>=3.2" \
+         zlib)
+source=(http://example.com/$_realname-$pkgver.tar.gz
+        fix.patch) # comment
+md5sums=('d41d8cd98f00b204e9800998ecf8427e'
+         'd41d8cd98f00b204e9800998ecf8427e')
+
+build() {
+  cd "$srcdir/$_realname-$pkgver"
+  cat > config <<EOF
+}
+EOF
+  ./configure --prefix=/usr || return 1
+}
+"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_pkgbuild(self, script):
+        filename = os.path.join(self.directory, 'PKGBUILD')
+        fp = open(filename, 'w')
+        fp.write(script)
+        fp.close()
+        return filename
+
+    def test_python_parser(self):
+        pkg = PKGBUILD.Package(self.write_pkgbuild(self.pkgbuild),
+                parser='python')
+        self.assertEquals(pkg['name'], 'parser_test')
+        self.assertEquals(pkg['release'], 2)
+        self.assertEquals(pkg['description'],
+                'A "quoted" description of parser_test')
+        self.assertEquals(pkg['url'], 'http://example.com/parser-test')
+        self.assertEquals(pkg['depends'], ['glibc', 'bash>=3.2', 'zlib'])
+        self.assertEquals(pkg['source'], [
+            'http://example.com/parser-test-1.0.tar.gz', 'fix.patch'])
+        self.assertEquals(pkg['makedepends'], [])
+        self.assertEquals(pkg['install'], [])
+        self.failUnless(pkg.is_valid())
+
+    def test_parsers_agree(self):
+        filename = self.write_pkgbuild(self.pkgbuild)
+        self.assertEquals(dict(PKGBUILD.Package(filename, parser='python')),
+                dict(PKGBUILD.Package(filename, parser='bash')))
+
+    def test_bash_fallback(self):
+        filename = self.write_pkgbuild(
+                self.pkgbuild.replace('pkgrel=2', 'pkgrel=$(echo 3)'))
+        self.assertRaises(PKGBUILD.InvalidPackage, PKGBUILD.Package,
+                filename, parser='python')
+        self.assertEquals(PKGBUILD.Package(filename)['release'], 3)
+
+    def test_tarball(self):
+        pkgbuild = self.write_pkgbuild(self.pkgbuild)
+        filename = os.path.join(self.directory, 'parser_test.tar.gz')
+        tar = tarfile.open(filename, 'w:gz')
+        tar.add(pkgbuild, 'parser_test/PKGBUILD')
+        tar.add(pkgbuild, 'parser_test/fix.patch')
+        tar.close()
+        pkg = PKGBUILD.Package(filename)
+        self.failUnless(pkg.is_tarball())
+        self.assertEquals(pkg['name'], 'parser_test')
+        self.assertEquals(pkg.get_pkgbuild(), self.pkgbuild)
+        self.failUnless(pkg.has_file('fix.patch'))
+        self.assertEquals(pkg.get_file('fix.patch'), self.pkgbuild)
+        self.assertEquals(pkg.get_file(pkg['source'][0]), None)
+        pkg.close()
+
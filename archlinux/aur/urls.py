@@ -1,15 +1,11 @@
 from django.conf.urls.defaults import *
-from aur.models import Package
-
-detail_dict = {
-    'queryset': Package.objects.all(),
-    'template_object_name': 'pkg',
-}
 
 urlpatterns = patterns('aur.views',
     url(r'^$', 'search', name='aur-main'),
     url(r'^search/$', 'search', name='aur-search'),
     url(r'^submit/$', 'submit', name='aur-submit_package'),
+    url(r'^package/(?P<slug>[\w_-]+)/$', 'package_detail',
+        name='aur-package_detail'),
     url(r'^package/(?P<object_id>[\w_-]+)/comment/$', 'comment',
         name='aur-comment_on_package'),
     url(r'^package/(?P<object_id>[\w_-]+)/flag_out_of_date/$',
@@ -24,13 +20,11 @@ urlpatterns = patterns('aur.views',
         'notify_of_updates', name='aur-notify_of_updates'),
     url(r'^package/(?P<object_id>[\w_-]+)/denotify_of_updates/$',
         'denotify_of_updates', name='aur-denotify_of_updates'),
-    (r'^api/', include('archlinux.aur.api.urls')),
+    url(r'^api/suggest/(?P<query>[\w_-]+)$', 'api_suggest',
+        name='aur-api_suggest'),
+    url(r'^api/depends/(?P<name>[\w_-]+)$', 'api_dependencies',
+        name='aur-api_dependencies'),
+    (r'^api/', include('aur.api.urls')),
     url(r'^manage_packages/$', 'manage_packages', name='aur-manage_packages'),
 )
 
-# Generic views
-# These will probably be removed at a later stage
-urlpatterns += patterns('django.views.generic',
-    (r'^package/(?P<slug>[\w_-]+)/$', 'list_detail.object_detail',
-        dict(detail_dict), 'aur-package_detail'),
-)
@@ -1,14 +1,30 @@
+from datetime import datetime
+
 from django.shortcuts import render_to_response, get_object_or_404
-from django.http import HttpResponse, HttpResponseRedirect
-from django.core.paginator import Paginator, EmptyPage, InvalidPage
+from django.template import RequestContext
+from django.http import HttpResponse, HttpResponseRedirect, \
+        HttpResponseNotFound
 from django.contrib.auth.decorators import login_required
 from django.core.urlresolvers import reverse
 from django.core import serializers
+from django.conf import settings
+from django.utils import simplejson
 from django.utils.translation import ugettext
-from django.db import IntegrityError
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Count
+from django.views.decorators.http import condition
 
-from aur.models import Package, Comment, PackageNotification, Vote
-from aur.forms import PackageSearchForm, PackageSubmitForm
+from aur.api.handlers import package_info_etag, package_info_last_modified
+from aur.cache import cache_anonymous, invalidate_after_commit, \
+        invalidate_packages
+from aur.models import Package, Comment, PackageNotification, Vote, \
+        bulk_relate, bulk_unrelate, get_related_names, get_user_package_ids, \
+        packages_changed, touch_packages
+from aur.forms import PackageSearchForm, PackageSubmitForm, \
+        UploadSizeLimitHandler
+from aur.graph import dependency_graph, UnknownPackage
+from aur.pagination import KeysetPaginator, OffsetPaginator, InvalidCursor
+from aur.search import name_index
 
 # Helper functions for permissions
 # This should perhaps be elsewhere. In the future Django may support
@@ -36,18 +52,43 @@ def _user_is_maintainer(user, package):
     """
     if not isinstance(package, Package):
         package = Package.objects.get(name=package)
-    return package.maintainers.filter(username=user.username).count() > 0
+    return package.id in get_user_package_ids(user)['maintained']
 
 def _user_is_moderator(user):
     """Returns whether a user is a package moderator
     *user* should be a :class:`User`
+
+    The result is kept on the user object for the rest of the request.
     """
-    return user.has_perms((
-        'package.can_add_package',
-        'package.can_delete_package',
-        'package.can_change_package',
-    ))
+    if not hasattr(user, '_aur_is_moderator'):
+        user._aur_is_moderator = user.is_authenticated() and \
+                user.has_perms((
+                    'package.can_add_package',
+                    'package.can_delete_package',
+                    'package.can_change_package',
+                ))
+    return user._aur_is_moderator
+
+# Fields the search results can be sorted by
+SEARCH_SORT_FIELDS = {
+    'name': 'name',
+    'maintainer': 'name',
+    'repository': 'repository__name',
+    'description': 'description',
+    'votes': 'vote_count',
+    'updated': 'updated',
+}
 
+def _get_cursor_url(request, cursor):
+    """Return the query string of the current page with *cursor* set, or
+    None if there is no cursor"""
+    if cursor is None:
+        return None
+    query = request.GET.copy()
+    query['cursor'] = cursor
+    return '?' + query.urlencode()
+
+@cache_anonymous('search')
 def search(request, query = ''):
     if request.method == 'GET' and request.GET.has_key('query'):
         form = PackageSearchForm(request.GET)
@@ -63,41 +104,128 @@ def search(request, query = ''):
     # Execute the search
     results = form.search()
     # Get sorting variables from query string or fallback on defaults
-    if request.GET.has_key('sortby'):
-        sortby = request.GET['sortby']
-        if sortby == 'maintainer':
-            sortby = 'name'
+    # Ranked results are sorted by relevance unless requested otherwise
+    sortby = request.GET.get('sortby')
+    if sortby == 'relevance' and form.ranked:
+        sortby = 'relevance'
+    elif sortby in SEARCH_SORT_FIELDS:
+        sortby = SEARCH_SORT_FIELDS[sortby]
+    elif form.ranked:
+        sortby = 'relevance'
     else:
         sortby = 'name'
-    if request.GET.has_key('order') and request.GET['order'] == 'desc':
+    if sortby == 'relevance':
+        sortby = '-relevance'
+    elif request.GET.get('order') == 'desc':
         sortby = "".join(('-', sortby))
-    # Sort the results
-    results = results.order_by(sortby, 'repository', 'name')
+    # Names are unique, so they make the ordering total
+    ordering = [sortby]
+    if sortby.lstrip('-') != 'name':
+        ordering.append('name')
+    results = results.select_related('repository')
     # If we only got one hit, just go to the package's detail page
-    if form.is_bound and results.count() == 1:
-        return HttpResponseRedirect(reverse('aur-package_detail',
-            args=[results[0].name,]))
-    # Initialise the pagination
-    paginator = Paginator(results, int(form.get_or_default('limit')))
-    # Use last page if page number is out of range
+    if form.is_bound:
+        hits = list(results[:2])
+        if len(hits) == 1:
+            return HttpResponseRedirect(reverse('aur-package_detail',
+                args=[hits[0].name,]))
+    # Initialise the pagination. The relevance is an aggregate, which can't
+    # be used in keyset conditions.
+    if sortby == '-relevance':
+        paginator = OffsetPaginator(results, form.get_or_default('limit'),
+                ordering)
+    else:
+        paginator = KeysetPaginator(results, form.get_or_default('limit'),
+                ordering)
+    # Start over if the cursor is invalid
     try:
-        page = paginator.page(int(request.GET.get('page', '1')))
-    except (EmptyPage, InvalidPage):
-        page = paginator.page(paginator.num_pages)
+        page = paginator.page(request.GET.get('cursor'))
+    except InvalidCursor:
+        page = paginator.page()
+    # Load the maintainers of all packages on the page at once
+    packages = list(page.object_list)
+    maintainers = get_related_names(packages, 'maintainers', 'username')
+    for package in packages:
+        package.maintainer_names = maintainers[package.id]
 
     return render_to_response('aur/search.html', {
         'form': form,
-        'packages': page.object_list,
+        'packages': packages,
         'page': page,
+        'next_url': _get_cursor_url(request, page.next_cursor),
+        'previous_url': _get_cursor_url(request, page.previous_cursor),
         'user': request.user,
         'request': request,
         'is_moderator': _user_is_moderator(request.user),
     })
 
+def _package_detail_etag(request, slug):
+    """Return the ETag of a package's detail page, derived from when it was
+    updated, its revision and its vote, comment and reverse dependency
+    totals
+
+    Pages of logged in users differ per user and get no ETag.
+    """
+    if request.user.is_authenticated():
+        return None
+    rows = Package.objects.filter(slug=slug).annotate(
+            required_by=Count('reverse_depends')).values_list('updated',
+                    'revision', 'vote_count', 'comment_count',
+                    'required_by')[:1]
+    if not rows:
+        return None
+    updated, revision, votes, comments, required_by = rows[0]
+    return '%s-%d-%d-%d-%d' % (updated.isoformat(), revision, votes,
+            comments, required_by)
+
+@condition(etag_func=_package_detail_etag)
+@cache_anonymous('package_detail')
+def package_detail(request, slug):
+    """Display a package
+
+    Related objects are loaded with one query per relation, so the number
+    of queries doesn't grow with the number of comments, dependencies or
+    sources.
+    """
+    package = get_object_or_404(Package.objects.select_related('repository'),
+            slug=slug)
+    context = {
+        'pkg': package,
+        'depends': list(package.depends.all()),
+        'required_by': list(package.reverse_depends.all()),
+        'sources': list(package.packagefile_set.all()),
+        'comments': list(Comment.objects.filter(package=package,
+            hidden=False).select_related('user')),
+        'votes': package.vote_count,
+        'has_vote': False,
+        'has_update_notification': False,
+    }
+    for key, field, attr in (
+            ('licenses', 'licenses', 'name'),
+            ('maintainers', 'maintainers', 'username'),
+            ('architectures', 'architectures', 'name')):
+        context[key] = get_related_names([package], field, attr)[package.id]
+    if request.user.is_authenticated():
+        ids = get_user_package_ids(request.user)
+        context['has_vote'] = package.id in ids['voted']
+        context['has_update_notification'] = package.id in ids['subscribed']
+    return render_to_response('aur/package_detail.html', context,
+            context_instance=RequestContext(request))
+
 @login_required
 def submit(request):
     if request.method == 'POST':
+        # Stop receiving uploads which are too large before they are
+        # written to disk
+        max_size = getattr(settings, 'AUR_MAX_UPLOAD_SIZE', None)
+        limit = UploadSizeLimitHandler(request, max_size)
+        request.upload_handlers.insert(0, limit)
         form = PackageSubmitForm(request.POST, request.FILES)
+        if limit.exceeded:
+            return render_to_response('aur/error.html', dict(
+                heading = ugettext("Upload too large"),
+                error = "The file exceeds %d bytes" % max_size,
+            ))
         if form.is_valid():
             form.save(request.user)
             return HttpResponseRedirect(reverse('aur-package_detail',
@@ -109,6 +237,8 @@ def submit(request):
         'form': form,
     })
 
+@invalidate_after_commit()
+@transaction.commit_on_success
 def comment(request, object_id):
     if request.POST and 'message' in request.POST:
         package = get_object_or_404(Package, name=object_id)
@@ -156,6 +286,8 @@ def denotify_of_updates(request, object_id):
         args=[object_id,]))
 
 @login_required
+@invalidate_after_commit()
+@transaction.commit_on_success
 def vote(request, slug):
     """Record a user's vote for a package"""
     package = get_object_or_404(Package, slug=slug)
@@ -166,6 +298,8 @@ def vote(request, slug):
     return HttpResponseRedirect(reverse('aur-package_detail', args=[slug,]))
 
 @login_required
+@invalidate_after_commit()
+@transaction.commit_on_success
 def unvote(request, slug):
     """Remove a user's vote for a package"""
     package = get_object_or_404(Package, slug=slug)
@@ -175,6 +309,44 @@ def unvote(request, slug):
         pass
     return HttpResponseRedirect(reverse('aur-package_detail', args=[slug,]))
 
+def api_suggest(request, query):
+    """Return the names and versions of packages starting with *query* as
+    JSON, for autocompletion"""
+    limit = getattr(settings, 'AUR_SUGGEST_LIMIT', 10)
+    try:
+        limit = max(1, min(int(request.GET.get('limit', limit)), limit))
+    except ValueError:
+        pass
+    data = simplejson.dumps([{'name': name, 'version': version}
+        for name, version in name_index.suggest(query, limit)])
+    return HttpResponse(data, mimetype="application/json")
+
+def api_dependencies(request, name):
+    """Return the dependency graph around the package *name* as JSON: its
+    transitive dependencies, the packages depending on it, its build order
+    and any dependency cycles"""
+    try:
+        order, cycles = dependency_graph.build_order(name)
+        data = {
+            'name': name,
+            'depends': dependency_graph.direct(name, 'depends'),
+            'make_depends': dependency_graph.direct(name, 'make_depends'),
+            'conflicts': dependency_graph.direct(name, 'conflicts'),
+            'replaces': dependency_graph.direct(name, 'replaces'),
+            'provides': dependency_graph.provides(name),
+            'all_depends': dependency_graph.depends(name),
+            'required_by': dependency_graph.reverse_depends(name,
+                ('depends',)),
+            'all_required_by': dependency_graph.reverse_depends(name),
+            'build_order': order,
+            'cycles': cycles,
+        }
+    except UnknownPackage:
+        return HttpResponseNotFound(simplejson.dumps({
+            'error': 'Package %s was not found.' % name}),
+            mimetype="application/json")
+    return HttpResponse(simplejson.dumps(data), mimetype="application/json")
+
 def api_search(request, query, format):
     results = Package.objects.filter(name__icontains=query)
     data = serializers.serialize(format, results,
@@ -187,67 +359,94 @@ def api_search(request, query, format):
     )
     return HttpResponse(data, mimetype="application/%s" % format)
 
+def _get_packages_with_permissions(user, names):
+    """Return the packages named *names*, annotated with their number of
+    maintainers (``maintainer_count``) and whether *user* is one of them
+    (``is_maintainer``), using a single query"""
+    field = Package._meta.get_field('maintainers')
+    qn = connection.ops.quote_name
+    table = qn(field.m2m_db_table())
+    package_column = '%s.%s' % (table, qn(field.m2m_column_name()))
+    package_id = '%s.%s' % (qn(Package._meta.db_table), qn('id'))
+    return list(Package.objects.filter(name__in=names).extra(select={
+        'maintainer_count': 'SELECT COUNT(*) FROM %s WHERE %s = %s' % (
+            table, package_column, package_id),
+        'is_maintainer': 'SELECT COUNT(*) FROM %s WHERE %s = %s AND %s.%s '
+            '= %%s' % (table, package_column, package_id, table,
+                qn(field.m2m_reverse_name())),
+    }, select_params=(user.id,)))
+
 @login_required
+@invalidate_after_commit(invalidate_packages)
+@transaction.commit_on_success
 def manage_packages(request):
+    """Apply an action to several packages at once
+
+    Permissions of all packages are checked before anything is changed, and
+    changes are made with set-based queries in a single transaction.
+    """
     if request.method != 'POST':
         return HttpResponseRedirect(reverse('aur-search'))
-    packages = request.POST.getlist('packages')
-    if request.POST['action'] == 'unflag-ood':
-        for package_name in packages:
-            package = Package.objects.get(name=package_name)
-            if _user_can_modify_package(request.user, package):
-                package.outdated = False
-                package.save()
-            else:
-                return render_to_response('aur/error.html', dict(
-                    heading = ugettext("Permission denied"),
-                    error = "You are not allowed to edit %s" % package_name,
-                ))
-    elif request.POST['action'] == 'flag-ood':
-        for package_name in packages:
-            package = Package.objects.get(name=package_name)
-            if _user_can_modify_package(request.user, package):
-                package.outdated = True
-                package.save()
-            else:
-                return render_to_response('aur/error.html', dict(
-                    heading = ugettext("Permission denied"),
-                    error = "You are not allowed to edit %s" % package_name,
-                ))
-    elif request.POST['action'] == 'disown':
-        for package_name in packages:
-            package = Package.objects.get(name=package_name)
-            if _user_can_modify_package(request.user, package):
-                package.maintainers.clear()
-            else:
-                return render_to_response('aur/error.html', dict(
-                    heading = ugettext("Permission denied"),
-                    error = "You cannot disown %s" % package_name,
-                ))
-    elif request.POST['action'] == 'adopt':
-        for package_name in packages:
-            package = Package.objects.get(name=package_name)
-            if package.maintainers.count() == 0:
-                package.maintainers.add(request.user)
-            elif _user_is_moderator(request.user):
-                package.maintainers.add(request.user)
-            else:
-                return render_to_response('aur/error.html', dict(
-                    heading = ugettext("Permission denied"),
-                    error = "You cannot adopt %s" % package_name,
-                ))
-    elif request.POST['action'] == 'delete':
-        for package_name in packages:
-            package = Package.objects.get(name=package_name)
-            if _user_can_delete_package(request.user, package):
-                package.delete()
-            else:
-                return render_to_response('aur/error.html', dict(
-                    heading = ugettext("Permission denied"),
-                    error = "You are not allowed to delete %s" % package_name,
-                ))
-    return HttpResponseRedirect(request.META['HTTP_REFERER'])
+    names = set(request.POST.getlist('packages'))
+    action = request.POST.get('action')
+    packages = _get_packages_with_permissions(request.user, names)
+    missing = names - set([package.name for package in packages])
+    if missing:
+        return render_to_response('aur/error.html', dict(
+            heading = ugettext("Package not found"),
+            error = "%s does not exist" % sorted(missing)[0],
+        ))
+    can_change = request.user.has_perm('package.can_change_package')
+    for package in packages:
+        if action in ('flag-ood', 'unflag-ood', 'disown'):
+            allowed = package.is_maintainer or can_change
+        elif action == 'adopt':
+            allowed = not package.maintainer_count or \
+                    _user_is_moderator(request.user)
+        elif action == 'delete':
+            allowed = _user_can_delete_package(request.user, package)
+        else:
+            allowed = False
+        if not allowed:
+            return render_to_response('aur/error.html', dict(
+                heading = ugettext("Permission denied"),
+                error = "You are not allowed to %s %s" % (action,
+                    package.name),
+            ))
+    ids = [package.id for package in packages]
+    if action in ('flag-ood', 'unflag-ood'):
+        outdated = action == 'flag-ood'
+        now = datetime.now()
+        Package.objects.filter(id__in=ids).update(outdated=outdated,
+                updated=now)
+        for package in packages:
+            package.outdated = outdated
+            package.updated = now
+    elif action == 'disown':
+        bulk_unrelate(Package, 'maintainers', ids)
+        touch_packages(ids)
+    elif action == 'adopt':
+        bulk_relate(Package, 'maintainers', [(package.id, request.user.id)
+            for package in packages if not package.is_maintainer])
+        touch_packages(ids)
+    elif action == 'delete':
+        # The queryset delete sends the per-object signals which remove the
+        # files of each package
+        Package.objects.filter(id__in=ids).delete()
+    if packages:
+        packages_changed.send(sender=Package, packages=packages,
+                action=action, user=request.user)
+    return HttpResponseRedirect(request.META.get('HTTP_REFERER',
+        reverse('aur-search')))
+
+def _package_info_etag(request, object_id, format):
+    return package_info_etag(request, object_id)
+
+def _package_info_last_modified(request, object_id, format):
+    return package_info_last_modified(request, object_id)
 
+@condition(etag_func=_package_info_etag,
+        last_modified_func=_package_info_last_modified)
 def api_package_info(request, object_id, format):
     package = get_object_or_404(Package, name=object_id)
     data = serializers.serialize(format, [package,])
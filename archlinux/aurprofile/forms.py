@@ -1,7 +1,14 @@
 from django.contrib.auth.models import User
 from django.forms import ModelForm
 
+from aur.models import NotificationPreference
+
 class ProfileUpdateForm(ModelForm):
     class Meta:
         model = User
         fields = ('username', 'first_name', 'last_name', 'email')
+
+class NotificationPreferenceForm(ModelForm):
+    class Meta:
+        model = NotificationPreference
+        fields = ('delivery',)
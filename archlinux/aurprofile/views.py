@@ -3,22 +3,31 @@ from django.contrib.auth.decorators import login_required
 from django.shortcuts import render_to_response
 from django.template import RequestContext
 
-from aurprofile.forms import ProfileUpdateForm
-from aur.models import Package
+from aurprofile.forms import ProfileUpdateForm, NotificationPreferenceForm
+from aur.models import Package, NotificationPreference
 
 @login_required
 def profile(request):
     packages = Package.objects.filter(maintainers=request.user)
+    try:
+        preference = NotificationPreference.objects.get(user=request.user)
+    except NotificationPreference.DoesNotExist:
+        preference = NotificationPreference(user=request.user)
     if request.method == 'POST':
         form = ProfileUpdateForm(request.POST, instance=request.user)
-        if form.is_valid():
+        notification_form = NotificationPreferenceForm(request.POST,
+                instance=preference)
+        if form.is_valid() and notification_form.is_valid():
             form.save()
+            notification_form.save()
     else:
         form = ProfileUpdateForm(instance=request.user)
+        notification_form = NotificationPreferenceForm(instance=preference)
     count_packages_ood = packages.filter(outdated=True).count()
     context = RequestContext(request, {
         'packages': packages,
         'form': form,
+        'notification_form': notification_form,
         'packages_out_of_date': count_packages_ood,
     })
     return render_to_response('aurprofile/profile.html', context)
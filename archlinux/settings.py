@@ -62,6 +62,34 @@ INSTALLED_APPS = (
     'tagging',
 )
 
+# Any backend supported by Django, e.g. 'memcached://127.0.0.1:11211/' or
+# 'file:///var/tmp/aur_cache'
+CACHE_BACKEND = 'locmem://'
+
+# AUR settings
+
+# Dotted path of the search backend class, see aur.search
+AUR_SEARCH_BACKEND = 'aur.search.DatabaseSearchBackend'
+# Maximum number of names returned by the suggestion API
+AUR_SUGGEST_LIMIT = 10
+# Maximum number of packages per page of the package listing API
+AUR_API_PAGE_SIZE = 100
+# Number of packages read per query by the streaming package export
+AUR_API_EXPORT_CHUNK_SIZE = 500
+# Maximum number of packages looked up by name in one API request
+AUR_API_BATCH_LIMIT = 250
+# Seconds package update notifications are held back, so that further
+# changes are sent with them
+AUR_NOTIFICATION_WINDOW = 300
+# Maximum size in bytes of uploaded packages, and of the files they contain
+AUR_MAX_UPLOAD_SIZE = 10 * 1024 * 1024
+# Seconds anonymous responses of each view are cached, see aur.cache
+AUR_CACHE_POLICIES = {
+    'search': 300,
+    'package_detail': 600,
+    'api': 300,
+}
+
 # Third party settings
 
 # django-registration
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+"""Compare the time taken to parse PKGBUILDs with each parser
+
+Usage: benchmark_pkgbuild.py [-n ITERATIONS] PKGBUILD|TARBALL...
+"""
+import os
+import sys
+import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..', 'archlinux'))
+
+from aur.Package import Package
+
+def time_parser(filename, parser, iterations):
+    """Return the average time in milliseconds to parse *filename*"""
+    start = time.time()
+    for i in xrange(iterations):
+        Package(filename, parser=parser)
+    return (time.time() - start) * 1000 / iterations
+
+def main():
+    option_parser = OptionParser(usage='%prog [-n ITERATIONS] FILE...')
+    option_parser.add_option('-n', '--iterations', type='int', default=100,
+            help='number of times each file is parsed (default: 100)')
+    options, files = option_parser.parse_args()
+    if not files:
+        option_parser.error('no PKGBUILDs given')
+
+    print '%-40s %10s %10s %8s' % ('file', 'bash (ms)', 'python (ms)',
+            'speedup')
+    total_bash = total_python = 0.0
+    for filename in files:
+        bash = time_parser(filename, 'bash', options.iterations)
+        try:
+            python = time_parser(filename, 'python', options.iterations)
+        except Exception:
+            print '%-40s %10.3f %10s %8s' % (filename[-40:], bash,
+                    'fallback', '-')
+            continue
+        total_bash += bash
+        total_python += python
+        print '%-40s %10.3f %10.3f %7.1fx' % (filename[-40:], bash, python,
+                bash / python)
+    if total_python:
+        print '%-40s %10.3f %10.3f %7.1fx' % ('total', total_bash,
+                total_python, total_bash / total_python)
+
+if __name__ == '__main__':
+    main()